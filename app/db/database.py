@@ -1,12 +1,188 @@
+import asyncio
+import html
+import logging
+import os
+import re
 import sqlite3
-from datetime import datetime
-from typing import List, Tuple, Optional
+import time
+import unicodedata
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Tuple, Optional, TypeVar, Union
 
 DB_NAME = "sessions.db"
+ARCHIVE_DB_NAME = os.getenv("DB_ARCHIVE_NAME", "sessions_archive.db")
+# Сессии старше стольких дней переезжают в архивную базу; 0 — не архивировать
+ARCHIVE_AFTER_DAYS = float(os.getenv("DB_ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_INTERVAL = float(os.getenv("DB_ARCHIVE_INTERVAL", str(6 * 3600)))
+# Первый проход — не сразу при старте, а когда бот уже принимает сообщения
+ARCHIVE_START_DELAY = float(os.getenv("DB_ARCHIVE_START_DELAY", "300"))
+ARCHIVE_BATCH = 500
+# Пауза между пачками: запросы, вставшие в очередь к базе, выполняются между ними
+ARCHIVE_BATCH_PAUSE = 0.05
 
+T = TypeVar("T")
 
-def init_db() -> None:
-    with sqlite3.connect(DB_NAME) as conn:
+logger = logging.getLogger(__name__)
+
+# Одно долгоживущее соединение и один поток, в котором выполняются все запросы:
+# SQLite всё равно пишет последовательно, а event loop не ждёт диска.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+_conn: Optional[sqlite3.Connection] = None
+
+
+def _compress(text: Optional[str]) -> bytes:
+    return zlib.compress((text or "").encode("utf-8"), 6)
+
+
+def _decompress(body: Optional[bytes]) -> Optional[str]:
+    return zlib.decompress(body).decode("utf-8") if body is not None else None
+
+
+def _db() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # FULL: коммит подтверждается после fsync; сохранения копятся пачками, так что это недорого
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        _conn = conn
+    return _conn
+
+
+async def _run(fn: Callable[..., T], *args: Any) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, fn, *args)
+
+
+def _move_replies_out(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+        CREATE TABLE session_replies (
+            session_id INTEGER PRIMARY KEY,
+            body BLOB NOT NULL
+        )
+    """)
+    rows = conn.execute("SELECT id, gpt_reply FROM sessions")
+    conn.executemany(
+        "INSERT INTO session_replies (session_id, body) VALUES (?, ?)",
+        ((sid, _compress(reply)) for sid, reply in rows),
+    )
+
+
+def _fts_rows(conn: sqlite3.Connection, where: str = "", params: Iterable[Any] = ()) -> List[tuple]:
+    # строки индекса в порядке колонок sessions_fts; ответ распаковывается здесь, в Python
+    rows = conn.execute(f"""
+        SELECT s.id, s.symptoms, s.context, s.psycho_state, s.life_events, r.body
+        FROM sessions s
+        JOIN session_replies r ON r.session_id = s.id
+        {where}
+    """, tuple(params)).fetchall()
+    return [(*row[:5], _decompress(row[5])) for row in rows]
+
+
+def _fts_insert(conn: sqlite3.Connection, rows: Iterable[tuple]) -> None:
+    conn.executemany("""
+        INSERT INTO sessions_fts (rowid, symptoms, context, psycho_state, life_events, gpt_reply)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, rows)
+
+
+def _fts_delete(conn: sqlite3.Connection, rows: Iterable[tuple]) -> None:
+    # у индекса без содержимого строка удаляется только с теми же значениями, что вставлялись
+    conn.executemany("""
+        INSERT INTO sessions_fts (sessions_fts, rowid, symptoms, context, psycho_state, life_events, gpt_reply)
+        VALUES ('delete', ?, ?, ?, ?, ?, ?)
+    """, rows)
+
+
+def _index_all(conn: sqlite3.Connection) -> None:
+    _fts_insert(conn, _fts_rows(conn))
+
+
+# Миграции схемы по порядку; применённые считаются по PRAGMA user_version.
+# Шаг — SQL-строка или функция, если без Python не обойтись.
+_MIGRATIONS: List[List[Union[str, Callable[[sqlite3.Connection], None]]]] = [
+    # 1: сортируемая числовая метка времени (микросекунды UTC) и индексы под выборки истории
+    [
+        "ALTER TABLE sessions ADD COLUMN created_ts INTEGER",
+        "UPDATE sessions SET created_ts = CAST((julianday(created_at) - 2440587.5) * 86400000000 AS INTEGER)",
+        "CREATE INDEX IF NOT EXISTS sessions_user_ts ON sessions (user_id, created_ts)",
+        "CREATE INDEX IF NOT EXISTS sessions_ts ON sessions (created_ts)",
+    ],
+    # 2: полнотекстовый поиск по сессиям; индекс поддерживается триггерами
+    [
+        """
+        CREATE VIRTUAL TABLE sessions_fts USING fts5(
+            symptoms, context, psycho_state, life_events, gpt_reply,
+            content='sessions', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER sessions_fts_ai AFTER INSERT ON sessions BEGIN
+            INSERT INTO sessions_fts (rowid, symptoms, context, psycho_state, life_events, gpt_reply)
+            VALUES (new.id, new.symptoms, new.context, new.psycho_state, new.life_events, new.gpt_reply);
+        END
+        """,
+        """
+        CREATE TRIGGER sessions_fts_ad AFTER DELETE ON sessions BEGIN
+            INSERT INTO sessions_fts (sessions_fts, rowid, symptoms, context, psycho_state, life_events, gpt_reply)
+            VALUES ('delete', old.id, old.symptoms, old.context, old.psycho_state, old.life_events, old.gpt_reply);
+        END
+        """,
+        """
+        CREATE TRIGGER sessions_fts_au AFTER UPDATE ON sessions BEGIN
+            INSERT INTO sessions_fts (sessions_fts, rowid, symptoms, context, psycho_state, life_events, gpt_reply)
+            VALUES ('delete', old.id, old.symptoms, old.context, old.psycho_state, old.life_events, old.gpt_reply);
+            INSERT INTO sessions_fts (rowid, symptoms, context, psycho_state, life_events, gpt_reply)
+            VALUES (new.id, new.symptoms, new.context, new.psycho_state, new.life_events, new.gpt_reply);
+        END
+        """,
+        "INSERT INTO sessions_fts (sessions_fts) VALUES ('rebuild')",
+    ],
+    # 3: ответы GPT — в отдельной таблице и сжатые zlib; в sessions остаются только
+    # небольшие поля, по которым строятся списки. FTS-индекс без содержимого (content='')
+    # пишется из Python в той же транзакции, что и сессия: распаковать ответ внутри
+    # SQLite (триггером или представлением) можно только функцией, зарегистрированной
+    # в соединении приложения, и любой другой клиент падал бы на записи
+    [
+        _move_replies_out,
+        "DROP TRIGGER sessions_fts_ai",
+        "DROP TRIGGER sessions_fts_ad",
+        "DROP TRIGGER sessions_fts_au",
+        "DROP TABLE sessions_fts",
+        "ALTER TABLE sessions DROP COLUMN gpt_reply",
+        """
+        CREATE VIRTUAL TABLE sessions_fts USING fts5(
+            symptoms, context, psycho_state, life_events, gpt_reply,
+            content='', tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        _index_all,
+    ],
+    # 4: диагноз из анкеты; у старых сессий он не сохранялся и остаётся NULL — «неизвестен»
+    [
+        "ALTER TABLE sessions ADD COLUMN diagnosis TEXT",
+    ],
+]
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(_MIGRATIONS[version:], start=version + 1):
+        with conn:
+            conn.execute("BEGIN")
+            for step in statements:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {number}")
+
+
+def _init_db() -> None:
+    with _db() as conn:
         conn.execute("""
             CREATE TABLE IF NOT EXISTS sessions (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -22,36 +198,483 @@ def init_db() -> None:
                 gpt_reply TEXT
             )
         """)
+    _migrate(_db())
 
 
-def save_session(user_id: int, data: dict, gpt_reply: str) -> None:
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.execute("""
-            INSERT INTO sessions (
-                user_id, created_at, symptoms, onset, context, analyses,
-                analysis_details, psycho_state, life_events, gpt_reply
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            user_id,
-            datetime.utcnow().isoformat(),
-            data.get("symptoms"),
-            data.get("onset"),
-            data.get("context"),
-            data.get("analyses"),
-            data.get("analysis_details"),
-            data.get("psycho_state"),
-            data.get("life_events"),
-            gpt_reply
-        ))
-
-
-def get_last_sessions(user_id: int, limit: int = 5) -> List[Tuple[int, str, str]]:
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.execute("""
-            SELECT id, created_at, gpt_reply
-            FROM sessions
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-            LIMIT ?
-        """, (user_id, limit))
-        return cursor.fetchall()
+def _session_row(user_id: int, data: dict, gpt_reply: str) -> Tuple[tuple, str]:
+    now = datetime.now(timezone.utc)
+    return (
+        user_id,
+        now.replace(tzinfo=None).isoformat(),
+        int(now.timestamp() * 1_000_000),
+        data.get("symptoms"),
+        data.get("onset"),
+        data.get("context"),
+        data.get("analyses"),
+        data.get("analysis_details"),
+        data.get("psycho_state"),
+        data.get("life_events"),
+        data.get("diagnosis") or "",
+    ), gpt_reply
+
+
+def _insert_sessions(rows: List[Tuple[tuple, str]]) -> List[int]:
+    ids = []
+    with _db() as conn:
+        for row, gpt_reply in rows:
+            cur = conn.execute("""
+                INSERT INTO sessions (
+                    user_id, created_at, created_ts, symptoms, onset, context, analyses,
+                    analysis_details, psycho_state, life_events, diagnosis
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, row)
+            conn.execute(
+                "INSERT INTO session_replies (session_id, body) VALUES (?, ?)",
+                (cur.lastrowid, _compress(gpt_reply)),
+            )
+            _fts_insert(conn, [(cur.lastrowid, row[3], row[5], row[8], row[9], gpt_reply)])
+            ids.append(cur.lastrowid)
+    return ids
+
+
+def _load_replies(ids: Iterable[int]) -> Dict[int, str]:
+    ids = list(ids)
+    if not ids:
+        return {}
+    cursor = _db().execute(
+        f"SELECT session_id, body FROM session_replies WHERE session_id IN ({','.join('?' * len(ids))})",
+        ids,
+    )
+    return {sid: _decompress(body) for sid, body in cursor.fetchall()}
+
+
+# Колонки get_sessions_after() после id
+SESSION_FIELDS = (
+    "symptoms", "onset", "context", "analyses", "analysis_details", "psycho_state", "life_events", "diagnosis",
+)
+
+
+def _get_sessions_after(after_id: int, limit: int) -> List[Tuple]:
+    return _db().execute(f"""
+        SELECT id, {", ".join(SESSION_FIELDS)}
+        FROM sessions
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?
+    """, (after_id, limit)).fetchall()
+
+
+def _get_last_sessions(user_id: int, limit: int) -> List[Tuple[int, str, str]]:
+    rows = _db().execute("""
+        SELECT id, created_at
+        FROM sessions
+        WHERE user_id = ?
+        ORDER BY created_ts DESC, id DESC
+        LIMIT ?
+    """, (user_id, limit)).fetchall()
+    replies = _load_replies(sid for sid, _ in rows)
+    return [(sid, created_at, replies.get(sid)) for sid, created_at in rows]
+
+
+SessionPageRow = Tuple[int, int, int, str, str, str, str]
+
+
+def _get_sessions_page(user_id: Optional[int], before: Optional[Tuple[int, int]],
+                       limit: int) -> List[SessionPageRow]:
+    # keyset-пагинация: следующая страница начинается строго после (created_ts, id) последней строки
+    where, params = [], []
+    if user_id is not None:
+        where.append("user_id = ?")
+        params.append(user_id)
+    if before is not None:
+        where.append("(created_ts, id) < (?, ?)")
+        params.extend(before)
+    rows = _db().execute(f"""
+        SELECT id, created_ts, user_id, created_at, symptoms, psycho_state
+        FROM sessions
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY created_ts DESC, id DESC
+        LIMIT ?
+    """, (*params, limit)).fetchall()
+    # ответы GPT читаются только для строк, которые будут показаны
+    replies = _load_replies(row[0] for row in rows)
+    return [(*row, replies.get(row[0])) for row in rows]
+
+
+def _get_latest_session(user_id: int) -> Optional[Tuple[str, str, str, str, str, str, str]]:
+    row = _db().execute("""
+        SELECT id, symptoms, onset, context, analyses, psycho_state, life_events
+        FROM sessions
+        WHERE user_id = ?
+        ORDER BY created_ts DESC, id DESC
+        LIMIT 1
+    """, (user_id,)).fetchone()
+    if row is None:
+        return None
+    return (*row[1:], _load_replies([row[0]]).get(row[0]))
+
+
+def _get_session_reply(session_id: int) -> Optional[str]:
+    return _load_replies([session_id]).get(session_id)
+
+
+SearchRow = Tuple[int, int, str, str]
+
+# Маркеры подсветки в snippet(): управляющие символы, которых нет в тексте, чтобы
+# сначала экранировать HTML, а потом заменить их на теги
+_HL_START, _HL_END = "\x02", "\x03"
+
+
+SNIPPET_WORDS = 16
+_WORD = re.compile(r"\w+")
+
+
+def _fold(word: str) -> str:
+    # как токенизатор unicode61 с remove_diacritics: регистр не различается, диакритика
+    # снимается только у латиницы — «й» и «ё» для него отдельные буквы, не «и» и «е»
+    out = []
+    for c in word.lower():
+        base = unicodedata.normalize("NFD", c)[0]
+        out.append(base if ord(base) < 0x250 else c)
+    return "".join(out)
+
+
+def _query_terms(text: str) -> List[str]:
+    return [_fold(w) for w in _WORD.findall(text)]
+
+
+def _fts_query(terms: List[str]) -> str:
+    # каждое слово — префиксный поиск в кавычках: без стемминга «головн» найдёт «головная»,
+    # а служебный синтаксис FTS5 из пользовательского ввода не интерпретируется
+    return " ".join(f'"{t}"*' for t in terms)
+
+
+def _snippet(columns: Iterable[Optional[str]], terms: List[str]) -> str:
+    # snippet() у индекса без содержимого недоступен — фрагмент строится здесь:
+    # колонка, где больше всего совпадений, окно в SNIPPET_WORDS слов вокруг первого
+    best = None
+    for text in columns:
+        words = list(_WORD.finditer(text or ""))
+        hits = {i for i, m in enumerate(words) if any(_fold(m.group()).startswith(t) for t in terms)}
+        if hits and (best is None or len(hits) > len(best[2])):
+            best = (text, words, hits)
+    if best is None:
+        return ""
+    text, words, hits = best
+    start = max(0, min(min(hits) - 2, len(words) - SNIPPET_WORDS))
+    end = min(len(words), start + SNIPPET_WORDS)
+    parts, pos = [], words[start].start()
+    for i in range(start, end):
+        m = words[i]
+        parts.append(text[pos:m.start()])
+        parts.append(f"{_HL_START}{m.group()}{_HL_END}" if i in hits else m.group())
+        pos = m.end()
+    return ("…" if start > 0 else "") + "".join(parts) + ("…" if end < len(words) else "")
+
+
+def _search_sessions(query: str, limit: int, offset: int) -> List[SearchRow]:
+    terms = _query_terms(query)
+    if not terms:
+        return []
+    conn = _db()
+    ids = [r[0] for r in conn.execute("""
+        SELECT rowid
+        FROM sessions_fts
+        WHERE sessions_fts MATCH ?
+        ORDER BY bm25(sessions_fts, 4.0, 1.0, 2.0, 1.0, 0.5)
+        LIMIT ? OFFSET ?
+    """, (_fts_query(terms), limit, offset))]
+    if not ids:
+        return []
+    marks = ",".join("?" * len(ids))
+    sessions = {row[0]: row for row in conn.execute(f"""
+        SELECT id, user_id, created_at, symptoms, context, psycho_state, life_events
+        FROM sessions WHERE id IN ({marks})
+    """, ids)}
+    replies = _load_replies(ids)
+    results = []
+    for sid in ids:
+        row = sessions.get(sid)
+        if row is None:
+            continue
+        snippet = _snippet((*row[3:], replies.get(sid)), terms)
+        results.append((sid, row[1], row[2],
+                        html.escape(snippet).replace(_HL_START, "<b>").replace(_HL_END, "</b>")))
+    return results
+
+
+def _archive_batch(cutoff_ts: int) -> int:
+    # одна пачка за вызов: между вызовами executor успевает выполнить остальные запросы
+    conn = _db()
+    conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_NAME,))
+    try:
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS archive.sessions (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    created_at TEXT,
+                    created_ts INTEGER,
+                    symptoms TEXT,
+                    onset TEXT,
+                    context TEXT,
+                    analyses TEXT,
+                    analysis_details TEXT,
+                    psycho_state TEXT,
+                    life_events TEXT,
+                    diagnosis TEXT
+                )
+            """)
+            columns = {row[1] for row in conn.execute("PRAGMA archive.table_info(sessions)")}
+            if "diagnosis" not in columns:
+                conn.execute("ALTER TABLE archive.sessions ADD COLUMN diagnosis TEXT")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS archive.session_replies (
+                    session_id INTEGER PRIMARY KEY,
+                    body BLOB NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS archive.sessions_user_ts ON sessions (user_id, created_ts)")
+
+        ids = [r[0] for r in conn.execute(
+            "SELECT id FROM main.sessions WHERE created_ts < ? ORDER BY created_ts LIMIT ?",
+            (cutoff_ts, ARCHIVE_BATCH),
+        )]
+        if not ids:
+            return 0
+        marks = ",".join("?" * len(ids))
+        with conn:
+            _fts_delete(conn, _fts_rows(conn, f"WHERE s.id IN ({marks})", ids))
+            conn.execute(f"""
+                INSERT OR IGNORE INTO archive.sessions (
+                    id, user_id, created_at, created_ts, symptoms, onset, context, analyses,
+                    analysis_details, psycho_state, life_events, diagnosis
+                )
+                SELECT id, user_id, created_at, created_ts, symptoms, onset, context, analyses,
+                       analysis_details, psycho_state, life_events, diagnosis
+                FROM main.sessions WHERE id IN ({marks})
+            """, ids)
+            conn.execute(f"""
+                INSERT OR IGNORE INTO archive.session_replies (session_id, body)
+                SELECT session_id, body FROM main.session_replies WHERE session_id IN ({marks})
+            """, ids)
+            conn.execute(f"DELETE FROM main.session_replies WHERE session_id IN ({marks})", ids)
+            conn.execute(f"DELETE FROM main.sessions WHERE id IN ({marks})", ids)
+        return len(ids)
+    finally:
+        conn.execute("DETACH DATABASE archive")
+
+
+async def _archive_sessions(cutoff_ts: int) -> int:
+    # небольшими пачками, каждая — отдельным заданием executor'а, чтобы сохранения
+    # и выборки не ждали весь проход
+    moved = 0
+    while True:
+        batch = await _run(_archive_batch, cutoff_ts)
+        moved += batch
+        if batch < ARCHIVE_BATCH:
+            return moved
+        await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
+
+
+def _close_db() -> None:
+    global _conn
+    if _conn is not None:
+        _conn.close()
+        _conn = None
+
+
+class _Archiver:
+    def __init__(self) -> None:
+        self._task: Optional[asyncio.Task] = None
+        self.moved = 0
+
+    def start(self) -> None:
+        if ARCHIVE_AFTER_DAYS > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        await asyncio.sleep(ARCHIVE_START_DELAY)
+        while True:
+            cutoff_ts = int((time.time() - ARCHIVE_AFTER_DAYS * 86400) * 1_000_000)
+            try:
+                self.moved += await _archive_sessions(cutoff_ts)
+            except sqlite3.Error:
+                pass
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+_archiver = _Archiver()
+
+
+async def archive_old_sessions(older_than_days: float = ARCHIVE_AFTER_DAYS) -> int:
+    cutoff_ts = int((time.time() - older_than_days * 86400) * 1_000_000)
+    return await _archive_sessions(cutoff_ts)
+
+
+SAVE_BATCH_SIZE = int(os.getenv("DB_SAVE_BATCH_SIZE", "100"))
+SAVE_FLUSH_INTERVAL = float(os.getenv("DB_SAVE_FLUSH_INTERVAL", "0.05"))
+
+
+class _SessionWriter:
+    """
+    Write-behind очередь для save_session: сохранения, пришедшие почти одновременно,
+    пишутся одной транзакцией (до SAVE_BATCH_SIZE строк или раз в SAVE_FLUSH_INTERVAL).
+    Вызывающий ждёт, пока его пачка не будет закоммичена.
+    """
+
+    def __init__(self) -> None:
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.max_depth = 0
+        self.batches = 0
+        self.rows = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if not self.running:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, row: Tuple[tuple, str]) -> int:
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((row, fut))
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return await fut
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + SAVE_FLUSH_INTERVAL
+            while len(batch) < SAVE_BATCH_SIZE:
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[Tuple[tuple, str], asyncio.Future]]) -> None:
+        try:
+            ids = await _run(_insert_sessions, [row for row, _ in batch])
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.batches += 1
+        self.rows += len(batch)
+        for (_, fut), session_id in zip(batch, ids):
+            if not fut.done():
+                fut.set_result(session_id)
+
+    async def stop(self) -> None:
+        # всё, что уже в очереди, дописывается до закрытия соединения
+        if self.running:
+            self._queue.put_nowait(None)
+            await self._task
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue_depth": self.max_depth,
+            "batches": self.batches,
+            "rows": self.rows,
+        }
+
+
+_writer = _SessionWriter()
+
+
+def save_queue_stats() -> dict:
+    return _writer.stats()
+
+
+async def init_db(archive: bool = True) -> None:
+    # archive=False — в остальных процессах бота архиватор не нужен: он один на базу
+    await _run(_init_db)
+    _writer.start()
+    if archive:
+        _archiver.start()
+
+
+async def migrate_db() -> None:
+    # для входного процесса при шардировании бота: схема обновляется один раз до запуска
+    # воркеров, иначе они мигрируют одновременно и падают на «duplicate column»
+    await _run(_init_db)
+    await _run(_close_db)
+
+
+# Вызываются после каждого сохранения: (session_id, данные анкеты) — так, например,
+# пополняется индекс похожих сессий (app/services/similar.py)
+_save_listeners: List[Callable[[int, dict], Awaitable[Any]]] = []
+
+
+def add_save_listener(listener: Callable[[int, dict], Awaitable[Any]]) -> None:
+    _save_listeners.append(listener)
+
+
+async def save_session(user_id: int, data: dict, gpt_reply: str) -> int:
+    row = _session_row(user_id, data, gpt_reply)
+    if _writer.running:
+        session_id = await _writer.submit(row)
+    else:
+        session_id = (await _run(_insert_sessions, [row]))[0]
+    for listener in _save_listeners:
+        try:
+            await listener(session_id, data)
+        except Exception:
+            logger.exception("Save listener failed for session %s", session_id)
+    return session_id
+
+
+async def get_last_sessions(user_id: int, limit: int = 5) -> List[Tuple[int, str, str]]:
+    return await _run(_get_last_sessions, user_id, limit)
+
+
+async def get_sessions_page(user_id: Optional[int] = None, before: Optional[Tuple[int, int]] = None,
+                            limit: int = 5) -> List[SessionPageRow]:
+    return await _run(_get_sessions_page, user_id, before, limit)
+
+
+async def get_latest_session(user_id: int) -> Optional[Tuple[str, str, str, str, str, str, str]]:
+    return await _run(_get_latest_session, user_id)
+
+
+async def get_session_reply(session_id: int) -> Optional[str]:
+    return await _run(_get_session_reply, session_id)
+
+
+async def get_sessions_after(after_id: int, limit: int = 1000) -> List[Tuple]:
+    return await _run(_get_sessions_after, after_id, limit)
+
+
+async def search_sessions(query: str, limit: int = 5, offset: int = 0) -> List[SearchRow]:
+    return await _run(_search_sessions, query, limit, offset)
+
+
+async def close_db() -> None:
+    await _archiver.stop()
+    await _writer.stop()
+    await _run(_close_db)
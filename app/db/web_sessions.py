@@ -0,0 +1,180 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+WEB_SESSION_STORE = os.getenv("WEB_SESSION_STORE", "memory")
+WEB_SESSION_DB = os.getenv("WEB_SESSION_DB", "web_sessions.db")
+# Сессия, к которой не обращались столько секунд, считается брошенной
+WEB_SESSION_TTL = float(os.getenv("WEB_SESSION_TTL", str(2 * 3600)))
+WEB_SESSION_MAX = int(os.getenv("WEB_SESSION_MAX", "10000"))
+
+SessionState = Tuple[str, Dict]
+
+
+class SessionStore(ABC):
+    """
+    Состояние диалогов веб-чата по session_id: шаг сценария и собранные ответы.
+    """
+
+    @abstractmethod
+    async def get(self, sid: str) -> Optional[SessionState]:
+        ...
+
+    @abstractmethod
+    async def put(self, sid: str, state: str, user_data: Dict) -> None:
+        ...
+
+    @abstractmethod
+    async def delete(self, sid: str) -> None:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+
+class _Record:
+    __slots__ = ("state", "user_data", "touched")
+
+    def __init__(self, state: str, user_data: Dict, touched: float) -> None:
+        self.state = state
+        self.user_data = user_data
+        self.touched = touched
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Хранилище в памяти процесса. Порядок OrderedDict — порядок последнего обращения,
+    поэтому и переполнение (LRU), и истёкший TTL вытесняются с одного конца.
+    """
+
+    def __init__(self, max_sessions: int = WEB_SESSION_MAX, ttl: float = WEB_SESSION_TTL) -> None:
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._items: "OrderedDict[str, _Record]" = OrderedDict()
+
+    def _evict(self, now: float) -> None:
+        while self._items:
+            sid, rec = next(iter(self._items.items()))
+            if len(self._items) <= self.max_sessions and now - rec.touched < self.ttl:
+                break
+            del self._items[sid]
+
+    async def get(self, sid: str) -> Optional[SessionState]:
+        now = time.monotonic()
+        self._evict(now)
+        rec = self._items.get(sid)
+        if rec is None:
+            return None
+        rec.touched = now
+        self._items.move_to_end(sid)
+        return rec.state, rec.user_data
+
+    async def put(self, sid: str, state: str, user_data: Dict) -> None:
+        now = time.monotonic()
+        self._items[sid] = _Record(state, user_data, now)
+        self._items.move_to_end(sid)
+        self._evict(now)
+
+    async def delete(self, sid: str) -> None:
+        self._items.pop(sid, None)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Хранилище в файле SQLite: его видят все воркеры uvicorn на хосте, и сессии
+    переживают перезапуск. Истёкшие записи удаляются при записи, не чаще раза в минуту.
+    """
+
+    def __init__(self, path: str = WEB_SESSION_DB, ttl: float = WEB_SESSION_TTL) -> None:
+        self.path = path
+        self.ttl = ttl
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._next_purge = 0.0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS web_sessions (
+                    sid TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS web_sessions_updated ON web_sessions (updated_at)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _get(self, sid: str) -> Optional[SessionState]:
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            row = conn.execute(
+                "SELECT state, data FROM web_sessions WHERE sid = ? AND updated_at >= ?",
+                (sid, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE web_sessions SET updated_at = ? WHERE sid = ?", (now, sid))
+            conn.commit()
+        return row[0], json.loads(row[1])
+
+    def _put(self, sid: str, state: str, user_data: Dict) -> None:
+        now = time.time()
+        data = json.dumps(user_data, ensure_ascii=False)
+        with self._lock:
+            conn = self._db()
+            conn.execute(
+                "INSERT OR REPLACE INTO web_sessions (sid, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                (sid, state, data, now),
+            )
+            if now >= self._next_purge:
+                conn.execute("DELETE FROM web_sessions WHERE updated_at < ?", (now - self.ttl,))
+                self._next_purge = now + 60
+            conn.commit()
+
+    def _delete(self, sid: str) -> None:
+        with self._lock:
+            conn = self._db()
+            conn.execute("DELETE FROM web_sessions WHERE sid = ?", (sid,))
+            conn.commit()
+
+    def _close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    async def get(self, sid: str) -> Optional[SessionState]:
+        return await asyncio.to_thread(self._get, sid)
+
+    async def put(self, sid: str, state: str, user_data: Dict) -> None:
+        await asyncio.to_thread(self._put, sid, state, user_data)
+
+    async def delete(self, sid: str) -> None:
+        await asyncio.to_thread(self._delete, sid)
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self._close)
+
+
+def make_session_store(kind: str = WEB_SESSION_STORE) -> SessionStore:
+    if kind == "memory":
+        return MemorySessionStore()
+    if kind == "sqlite":
+        return SqliteSessionStore()
+    raise ValueError(f"Unknown WEB_SESSION_STORE: {kind}")
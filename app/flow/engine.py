@@ -1,4 +1,4 @@
-from typing import Dict, Tuple, Optional
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 
 S_ENTER_DIAGNOSIS      = "entering_diagnosis"
 S_ENTER_ANALYSES       = "entering_analyses"
@@ -14,19 +14,26 @@ S_DEEP_Q3              = "deep_question_3"
 S_DEEP_Q4              = "deep_question_4"
 S_DONE                 = "done"
 
+# Побочные действия после шага: их выполняет канал (бот или веб)
+DO_GPT1 = "DO_GPT1"
+DO_GPT_FINAL = "DO_GPT_FINAL"
+
+NO_ANSWERS = {"нет", "no", "-", "—", "неа"}
+
+_ANALYSES_QUESTION = (
+    "Есть ли у вас анализы? 📄\n"
+    "— Вы можете прислать фото\n"
+    "— Или ввести текстом (например: «Гемоглобин — 130, Сахар — 5.4»)\n\n"
+    "Если у вас нет анализов, просто напишите «нет».\n\n"
+    "Также, пожалуйста, укажите дату, когда были сданы анализы."
+)
+
 PROMPTS: Dict[str, str] = {
     S_ENTER_DIAGNOSIS: (
         "Есть ли у вас диагноз, который вы бы хотели обсудить?\n\n"
         "Если да, опишите его, или напишите «нет», если диагноза нет."
     ),
-    S_ENTER_ANALYSES: (
-        "Хорошо, давайте перейдем к анализам.\n\n"
-        "Есть ли у вас анализы? 📄\n"
-        "— Вы можете прислать фото\n"
-        "— Или ввести текстом (например: «Гемоглобин — 130, Сахар — 5.4»)\n\n"
-        "Если у вас нет анализов, просто напишите «нет».\n\n"
-        "Также, пожалуйста, укажите дату, когда были сданы анализы."
-    ),
+    S_ENTER_ANALYSES: "Хорошо, давайте перейдем к анализам.\n\n" + _ANALYSES_QUESTION,
     S_ENTER_SYMPTOMS: (
         "Теперь давайте поговорим о симптомах.\n\n"
         "Какие симптомы беспокоят вас в первую очередь?\n"
@@ -56,59 +63,59 @@ PROMPTS: Dict[str, str] = {
     S_DEEP_Q4: "Когда вы в последний раз чувствовали, что не можете что-то «переварить», «удержать» или «выразить»?",
 }
 
-def start_session() -> Tuple[str, str, Dict]:
-    state = S_ENTER_DIAGNOSIS
-    return state, PROMPTS[state], {}
 
-def step(state: str, message: str, data: Dict) -> Tuple[str, str, Dict, Optional[str]]:
-    msg = (message or "").strip()
-
-    if state == S_ENTER_DIAGNOSIS:
-        data["diagnosis"] = msg.lower()
-        return S_ENTER_ANALYSES, PROMPTS[S_ENTER_ANALYSES], data, None
+def _analyses_value(msg: str) -> str:
+    return "нет" if not msg or msg.lower() in NO_ANSWERS else msg
 
-    if state == S_ENTER_ANALYSES:
-        data["analyses"] = msg if msg else "нет"
-        return S_ENTER_SYMPTOMS, PROMPTS[S_ENTER_SYMPTOMS], data, None
 
-    if state == S_ENTER_SYMPTOMS:
-        data["symptoms"] = msg
-        return S_ENTER_ONSET, PROMPTS[S_ENTER_ONSET], data, None
+def _after_diagnosis(data: Dict) -> str:
+    if data.get("diagnosis") in NO_ANSWERS:
+        return PROMPTS[S_ENTER_ANALYSES]
+    return "Спасибо за информацию. Переходим к анализам.\n\n" + _ANALYSES_QUESTION
 
-    if state == S_ENTER_ONSET:
-        data["onset"] = msg
-        return S_ENTER_CONTEXT, PROMPTS[S_ENTER_CONTEXT], data, None
 
-    if state == S_ENTER_CONTEXT:
-        data["context"] = msg
-        return S_ENTER_PSYCHO, PROMPTS[S_ENTER_PSYCHO], data, None
+class Step(NamedTuple):
+    state: str                                    # на каком шаге ждём ответ
+    field: str                                    # куда в данные сессии кладётся ответ
+    next: str                                     # следующий шаг
+    special: Optional[str] = None                 # побочное действие для канала
+    clean: Optional[Callable[[str], str]] = None  # нормализация ответа
+    prompt: Optional[Callable[[Dict], str]] = None  # вопрос следующего шага, если он зависит от ответа
 
-    if state == S_ENTER_PSYCHO:
-        data["psycho_state"] = msg
-        return S_ENTER_LIFE_EVENTS, PROMPTS[S_ENTER_LIFE_EVENTS], data, None
 
-    if state == S_ENTER_LIFE_EVENTS:
-        data["life_events"] = msg
-        return S_WAIT_FOLLOWUP, "", data, "DO_GPT1"
+# Сценарий анкеты по порядку шагов — единственное место, где он описан
+FLOW: List[Step] = [
+    Step(S_ENTER_DIAGNOSIS, "diagnosis", S_ENTER_ANALYSES, clean=str.lower, prompt=_after_diagnosis),
+    Step(S_ENTER_ANALYSES, "analyses", S_ENTER_SYMPTOMS, clean=_analyses_value),
+    Step(S_ENTER_SYMPTOMS, "symptoms", S_ENTER_ONSET),
+    Step(S_ENTER_ONSET, "onset", S_ENTER_CONTEXT),
+    Step(S_ENTER_CONTEXT, "context", S_ENTER_PSYCHO),
+    Step(S_ENTER_PSYCHO, "psycho_state", S_ENTER_LIFE_EVENTS),
+    Step(S_ENTER_LIFE_EVENTS, "life_events", S_WAIT_FOLLOWUP, special=DO_GPT1),
+    Step(S_WAIT_FOLLOWUP, "follow_up_answer", S_DEEP_Q1),
+    Step(S_DEEP_Q1, "deep_q1", S_DEEP_Q2),
+    Step(S_DEEP_Q2, "deep_q2", S_DEEP_Q3),
+    Step(S_DEEP_Q3, "deep_q3", S_DEEP_Q4),
+    Step(S_DEEP_Q4, "deep_q4", S_DONE, special=DO_GPT_FINAL),
+]
 
-    if state == S_WAIT_FOLLOWUP:
-        data["follow_up_answer"] = msg
-        return S_DEEP_Q1, PROMPTS[S_DEEP_Q1], data, None
+STEPS: Dict[str, Step] = {s.state: s for s in FLOW}
 
-    if state == S_DEEP_Q1:
-        data["deep_q1"] = msg
-        return S_DEEP_Q2, PROMPTS[S_DEEP_Q2], data, None
 
-    if state == S_DEEP_Q2:
-        data["deep_q2"] = msg
-        return S_DEEP_Q3, PROMPTS[S_DEEP_Q3], data, None
+def start_session() -> Tuple[str, str, Dict]:
+    state = S_ENTER_DIAGNOSIS
+    return state, PROMPTS[state], {}
 
-    if state == S_DEEP_Q3:
-        data["deep_q3"] = msg
-        return S_DEEP_Q4, PROMPTS[S_DEEP_Q4], data, None
+def step(state: str, message: str, data: Dict) -> Tuple[str, str, Dict, Optional[str]]:
+    msg = (message or "").strip()
 
-    if state == S_DEEP_Q4:
-        data["deep_q4"] = msg
-        return S_DONE, "", data, "DO_GPT_FINAL"
+    current = STEPS.get(state)
+    if current is None:
+        return S_ENTER_DIAGNOSIS, PROMPTS[S_ENTER_DIAGNOSIS], data, None
 
-    return S_ENTER_DIAGNOSIS, PROMPTS[S_ENTER_DIAGNOSIS], data, None
+    data[current.field] = current.clean(msg) if current.clean else msg
+    if current.special:
+        # ответ формирует модель, вопрос следующего шага канал не показывает
+        return current.next, "", data, current.special
+    reply = current.prompt(data) if current.prompt else PROMPTS.get(current.next, "")
+    return current.next, reply, data, None
@@ -1,26 +1,53 @@
 import os
-import asyncio
-from typing import Optional, Tuple, List, Dict
-from openai import OpenAI
+from typing import Optional, List, Dict, AsyncIterator
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, NOT_GIVEN
 
 import httpx, certifi
 
+from app.services.llm_retry import RETRY_STATUSES, until_deadline, with_retries
+from app.services.prompts import chat_messages, first_pass_prompt
+
 def _env(name: str, default: Optional[str] = None) -> Optional[str]:
     v = os.getenv(name)
     return v.strip() if isinstance(v, str) else default
 
-def _make_client() -> OpenAI:
+# Один клиент на процесс: пул keep-alive соединений переживает запросы,
+# TLS-рукопожатие не повторяется на каждой попытке.
+_client: Optional[AsyncOpenAI] = None
+
+def _make_client() -> AsyncOpenAI:
     key = _env("OPENAI_API_KEY") or ""
     base_url = _env("OPENAI_BASE") or _env("OPENAI_API_BASE")
     org = _env("OPENAI_ORG") or _env("OPENAI_ORGANIZATION")
     if not key:
         raise RuntimeError("OPENAI_API_KEY is required")
 
-    http = httpx.Client(
+    http = httpx.AsyncClient(
         verify=certifi.where(),
         timeout=httpx.Timeout(30.0, connect=10.0, read=30.0),
+        limits=httpx.Limits(
+            max_connections=int(_env("OPENAI_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=int(_env("OPENAI_MAX_KEEPALIVE", "10")),
+            keepalive_expiry=float(_env("OPENAI_KEEPALIVE_EXPIRY", "60")),
+        ),
     )
-    return OpenAI(api_key=key, base_url=base_url, organization=org, http_client=http)
+    # повторы делаем сами (app/services/llm_retry.py): с джиттером и в пределах дедлайна
+    return AsyncOpenAI(api_key=key, base_url=base_url, organization=org, http_client=http, max_retries=0)
+
+def _get_client() -> AsyncOpenAI:
+    global _client
+    if _client is None:
+        _client = _make_client()
+    return _client
+
+async def init_client() -> None:
+    _get_client()
+
+async def close_client() -> None:
+    global _client
+    client, _client = _client, None
+    if client is not None:
+        await client.close()
 
 def _current_chat_model() -> str:
     return (
@@ -29,35 +56,38 @@ def _current_chat_model() -> str:
         or "gpt-4o"
     )
 
-def _sdk_chat_sync(messages: List[Dict[str, str]], model: Optional[str] = None, **kwargs) -> Dict:
+def _retryable(e: BaseException) -> bool:
+    if isinstance(e, APIStatusError):
+        return e.status_code in RETRY_STATUSES
+    return isinstance(e, APIConnectionError)  # сюда же относится APITimeoutError
+
+
+async def _sdk_chat_stream(messages: List[Dict[str, str]], model: Optional[str] = None, **kwargs) -> AsyncIterator[str]:
     req_model = model or _current_chat_model()
     temperature = float(kwargs.get("temperature", _env("OPENAI_TEMPERATURE", "0.7")))
     max_tokens = kwargs.get("max_tokens")
 
-    last_err = None
-    for _ in range(3):
-        try:
-            with _make_client() as client:
-                resp = client.chat.completions.create(
-                    model=req_model,
-                    messages=messages,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                )
-            return {
-                "choices": [{
-                    "message": {
-                        "content": resp.choices[0].message.content,
-                        "role": resp.choices[0].message.role or "assistant",
-                    }
-                }]
-            }
-        except Exception as e:
-            last_err = e
-    raise last_err
+    client = _get_client()
+    # повторяем только установку стрима: после первого токена повтор продублировал бы текст
+    stream = await with_retries(lambda timeout: client.chat.completions.create(
+        model=req_model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+        timeout=NOT_GIVEN if timeout is None else timeout,
+    ), _retryable)
+
+    async with stream:
+        async for chunk in until_deadline(stream):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
 
 
 
+# Поднять при любой правке промптов ниже: по версии инвалидируется кэш ответов (llm_cache.py)
+PROMPT_VERSION = 2
+
 SYSTEM_PROMPT = """
 Ты — внимательный и чуткий помощник по здоровью и самоощущению. Твоя задача — помогать человеку понять его состояние
 с двух сторон: медицинской (куда обратиться, что проверить, какие вопросы задать врачу) и психоэмоциональной
@@ -102,49 +132,19 @@ SYSTEM_PROMPT = """
 
 
 
-def _split_answer_and_followup(text: str) -> Tuple[str, Optional[str]]:
-    if "\n---\n" in text:
-        a, b = text.split("\n---\n", 1)
-        return a.strip(), (b.strip() or None)
-    lines = text.strip().splitlines()
-    for i in range(len(lines) - 1, -1, -1):
-        low = lines[i].lower()
-        if low.startswith("вопрос:") or low.startswith("уточняющий вопрос:"):
-            main = "\n".join(lines[:i]).strip()
-            q = lines[i].split(":", 1)[1].strip() if ":" in lines[i] else lines[i].strip()
-            return main, (q or None)
-    return text.strip(), None
-
-
-async def generate_gpt_response(user_data: dict) -> Tuple[str, Optional[str]]:
-    diagnosis = user_data.get("diagnosis", "не указан")
-    prompt = f"""
-Пользователь рассказал о своём состоянии.
-Диагноз: {diagnosis}
-Симптомы: {user_data.get('symptoms')}
-Когда началось: {user_data.get('onset')}
-Контекст: {user_data.get('context')}
-Анализы: {user_data.get('analyses')}
-Детали анализов: {user_data.get('analysis_details')}
-Эмоциональный фон: {user_data.get('psycho_state')}
-Важные события: {user_data.get('life_events')}
-
+_FIRST_PASS_INSTRUCTIONS = """
 Сформируй ответ строго в заданной структуре (8 разделов), без markdown и без звёздочек.
 В каждом разделе будь конкретным и практичным. В разделе «Куда обратиться» предложи первичный маршрут и базовые обследования.
 В разделе «Красные флаги» укажи ситуации, когда нужна срочная помощь. В конце добавь обязательную финальную строку-предупреждение.
 Заверши одним коротким уточняющим вопросом на отдельной строке после разделителя \n---\n.
-""".strip()
+"""
+
 
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": prompt},
-    ]
-    result = await asyncio.to_thread(_sdk_chat_sync, messages, None)
-    content = result["choices"][0]["message"]["content"].strip()
-    return _split_answer_and_followup(content)
+def _first_pass_messages(user_data: dict, draft: Optional[str] = None) -> List[Dict[str, str]]:
+    return chat_messages(SYSTEM_PROMPT, first_pass_prompt(user_data, _FIRST_PASS_INSTRUCTIONS, draft))
 
 
-async def generate_final_gpt_response(user_data: dict) -> str:
+def _final_messages(user_data: dict) -> List[Dict[str, str]]:
     prompt = f"""
 Дополнительные ответы пользователя.
 Ответ на уточняющий вопрос: {user_data.get('follow_up_answer', '—')}
@@ -161,10 +161,17 @@ async def generate_final_gpt_response(user_data: dict) -> str:
 - в «Для разговора с врачом» сформулируй 3–5 конкретных вопросов.
 Закончить обязательной строкой-предупреждением.
 """.strip()
+    return chat_messages(SYSTEM_PROMPT, prompt)
+
+
+def stream_gpt_response(user_data: dict, draft: Optional[str] = None) -> AsyncIterator[str]:
+    return _sdk_chat_stream(_first_pass_messages(user_data, draft))
+
+
+def stream_final_gpt_response(user_data: dict) -> AsyncIterator[str]:
+    return _sdk_chat_stream(_final_messages(user_data))
+
 
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": prompt},
-    ]
-    result = await asyncio.to_thread(_sdk_chat_sync, messages, None)
-    return result["choices"][0]["message"]["content"].strip()
+def cache_params() -> Dict:
+    # от чего зависит ответ на первый запрос, кроме самих ответов анкеты
+    return {"model": _current_chat_model(), "temperature": float(_env("OPENAI_TEMPERATURE", "0.7")), "prompt": PROMPT_VERSION}
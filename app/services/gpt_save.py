@@ -1,7 +1,17 @@
 import os
+import json
+import time
+import uuid
 import asyncio
-from typing import Optional, Tuple, List, Dict
+import tempfile
+from typing import Optional, List, Dict, AsyncIterator
 from gigachat import GigaChat
+from gigachat.exceptions import AuthenticationError, ResponseError
+
+import httpx
+
+from app.services.prompts import chat_messages, first_pass_prompt
+from app.services.llm_retry import RETRY_STATUSES, parse_retry_after, until_deadline, with_retries
 
 
 
@@ -11,20 +21,154 @@ def _env(name: str, default: Optional[str] = None) -> Optional[str]:
     return v.strip() if isinstance(v, str) else default
 
 
-def _make_client() -> GigaChat:
+def _auth_key() -> str:
     key = _env("GIGA_AUTH_KEY") or _env("GIGACHAT_AUTH_KEY") or ""
-    scope = _env("GIGA_SCOPE", "GIGACHAT_API_PERS")
-    ca_bundle = _env("SSL_CERT_FILE", "russian_trusted_root_ca_pem.crt")
     if not key:
         raise RuntimeError("GIGA_AUTH_KEY is required (Authorization key from Sber Studio)")
+    return key
+
+
+def _make_client(access_token: Optional[str] = None, timeout: Optional[float] = None) -> GigaChat:
+    key = _auth_key()
+    scope = _env("GIGA_SCOPE", "GIGACHAT_API_PERS")
+    ca_bundle = _env("SSL_CERT_FILE", "russian_trusted_root_ca_pem.crt")
+    extra = {} if timeout is None else {"timeout": timeout}
+    # credentials оставляем: если токен всё-таки отзовут, SDK сам сходит за новым
     return GigaChat(
         credentials=key,
         scope=scope,
+        access_token=access_token,
         ca_bundle_file=ca_bundle,
-        verify_ssl_certs=True
+        verify_ssl_certs=True,
+        **extra
     )
 
 
+class _TokenCache:
+    """
+    Кэш OAuth access token GigaChat (живёт ~30 минут).
+    Фоновая задача обновляет токен заранее, до истечения срока, чтобы запрос
+    пользователя не ждал похода в OAuth. Если задан GIGA_TOKEN_CACHE, токен
+    дополнительно хранится в файле и переиспользуется соседними воркерами.
+    """
+
+    def __init__(self) -> None:
+        self.access_token: Optional[str] = None
+        self.expires_at: float = 0.0  # unix time, секунды
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _margin() -> float:
+        return float(_env("GIGA_TOKEN_REFRESH_MARGIN", "120"))
+
+    @staticmethod
+    def _path() -> Optional[str]:
+        return _env("GIGA_TOKEN_CACHE") or None
+
+    def _valid(self, margin: float = 0.0) -> bool:
+        return bool(self.access_token) and self.expires_at - margin > time.time()
+
+    def _load_from_disk(self) -> None:
+        path = self._path()
+        if not path:
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if float(data.get("expires_at", 0)) > self.expires_at and data.get("access_token"):
+            self.access_token = data["access_token"]
+            self.expires_at = float(data["expires_at"])
+
+    def _save_to_disk(self) -> None:
+        path = self._path()
+        if not path:
+            return
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".giga_token")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"access_token": self.access_token, "expires_at": self.expires_at}, f)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    async def _fetch(self) -> None:
+        url = _env("GIGA_AUTH_URL", "https://ngw.devices.sberbank.ru:9443/api/v2/oauth")
+        ca_bundle = _env("SSL_CERT_FILE", "russian_trusted_root_ca_pem.crt")
+        async with httpx.AsyncClient(verify=ca_bundle, timeout=httpx.Timeout(15.0, connect=5.0)) as http:
+            resp = await http.post(
+                url,
+                headers={
+                    "Authorization": f"Basic {_auth_key()}",
+                    "RqUID": str(uuid.uuid4()),
+                    "Accept": "application/json",
+                },
+                data={"scope": _env("GIGA_SCOPE", "GIGACHAT_API_PERS")},
+            )
+        resp.raise_for_status()
+        data = resp.json()
+        self.access_token = data["access_token"]
+        self.expires_at = float(data["expires_at"]) / 1000.0  # в ответе миллисекунды
+        self._save_to_disk()
+
+    async def _refresh(self, margin: float) -> None:
+        async with self._lock:
+            # пока ждали лок, токен мог обновить другой запрос или другой воркер
+            self._load_from_disk()
+            if not self._valid(margin):
+                await self._fetch()
+
+    async def get(self) -> str:
+        if not self._valid(self._margin() / 2):
+            self._load_from_disk()
+        if not self._valid():
+            # холодный старт или фоновое обновление не успело — единственный случай,
+            # когда OAuth оказывается на пути запроса
+            await self._refresh(0.0)
+        return self.access_token
+
+    async def _run(self) -> None:
+        while True:
+            margin = self._margin()
+            try:
+                await self._refresh(margin)
+                delay = max(self.expires_at - margin - time.time(), 1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                delay = 10.0
+            await asyncio.sleep(delay)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+_tokens = _TokenCache()
+
+
+async def init_client() -> None:
+    _tokens.start()
+
+
+async def close_client() -> None:
+    await _tokens.stop()
+
+
 def _current_chat_model() -> str:
     return (
         _env("GIGA_CHAT_MODEL")
@@ -36,6 +180,12 @@ def _current_chat_model() -> str:
 
 
 
+# Поднять при любой правке промптов ниже: по версии инвалидируется кэш ответов (llm_cache.py)
+PROMPT_VERSION = 2
+
+FIRST_TEMPERATURE = 0.6
+FINAL_TEMPERATURE = 0.8
+
 SYSTEM_PROMPT = """
 Ты — внимательный и чуткий помощник по здоровью и самоощущению. Твоя задача — помогать человеку понять его состояние
 с двух сторон: медицинской (куда обратиться, что проверить, какие вопросы задать врачу) и психоэмоциональной
@@ -86,55 +236,61 @@ SYSTEM_PROMPT = """
 
 
 
-def _sdk_chat_sync(messages: List[Dict[str, str]], model: Optional[str] = None, **kwargs) -> Dict:
-    req = {"messages": messages, "model": model or _current_chat_model()}
-    req.update(kwargs)
-    with _make_client() as gc:
-        resp = gc.chat(req)
-        return {
-            "choices": [
-                {
-                    "message": {
-                        "content": resp.choices[0].message.content,
-                        "role": resp.choices[0].message.role or "assistant",
-                    }
-                }
-            ]
-        }
-
-
+# ResponseError SDK: args = (url, status_code, content, headers)
+def _retryable(e: BaseException) -> bool:
+    if isinstance(e, AuthenticationError):
+        return False
+    if isinstance(e, ResponseError):
+        return len(e.args) > 1 and e.args[1] in RETRY_STATUSES
+    return isinstance(e, httpx.TransportError)
 
 
-def _split_answer_and_followup(text: str) -> Tuple[str, Optional[str]]:
-    if "\n---\n" in text:
-        a, b = text.split("\n---\n", 1)
-        return a.strip(), (b.strip() or None)
-    lines = text.strip().splitlines()
-    for i in range(len(lines) - 1, -1, -1):
-        low = lines[i].lower()
-        if low.startswith("вопрос:") or low.startswith("уточняющий вопрос:"):
-            main = "\n".join(lines[:i]).strip()
-            q = lines[i].split(":", 1)[1].strip() if ":" in lines[i] else lines[i].strip()
-            return main, (q or None)
-    return text.strip(), None
+def _retry_after(e: BaseException) -> Optional[float]:
+    if isinstance(e, ResponseError) and len(e.args) > 3:
+        return parse_retry_after(e.args[3])
+    return None
 
 
-
-
-async def generate_gpt_response(user_data: dict) -> Tuple[str, Optional[str]]:
-    diagnosis = user_data.get("diagnosis", "не указан")
-
-    prompt = f"""
-Пользователь рассказал о своём состоянии.
-Диагноз: {diagnosis}
-Симптомы: {user_data.get('symptoms')}
-Когда началось: {user_data.get('onset')}
-Контекст: {user_data.get('context')}
-Анализы: {user_data.get('analyses')}
-Детали анализов: {user_data.get('analysis_details')}
-Эмоциональный фон: {user_data.get('psycho_state')}
-Важные события: {user_data.get('life_events')}
-
+async def _sdk_chat_stream(messages: List[Dict[str, str]], model: Optional[str] = None, **kwargs) -> AsyncIterator[str]:
+    req = {"messages": messages, "model": model or _current_chat_model()}
+    req.update(kwargs)
+    token = await _tokens.get()
+
+    # повторяем только установку стрима вместе с первым чанком: ошибки SDK
+    # (429, 5xx) всплывают на первом чтении, а после него повтор продублировал бы текст
+    async def attempt(timeout: Optional[float]):
+        gc = _make_client(token, timeout)
+        it = gc.astream(req).__aiter__()
+        try:
+            return gc, it, await it.__anext__()
+        except StopAsyncIteration:
+            return gc, it, None
+        except BaseException:
+            await it.aclose()
+            await gc.aclose()
+            raise
+
+    gc, it, first = await with_retries(attempt, _retryable, _retry_after)
+    try:
+        if first is None:
+            return
+
+        async def rest():
+            yield first
+            async for chunk in it:
+                yield chunk
+
+        async for chunk in until_deadline(rest()):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        await it.aclose()
+        await gc.aclose()
+
+
+
+
+_FIRST_PASS_INSTRUCTIONS = """
 Сформируй ответ строго в заданной структуре (8 разделов), без markdown и без звёздочек.
 Используй рамку PNEI (нервная регуляция, стресс-гормоны/HPA, иммунитет, сон/ритмы).
 Не используй ГНМ как медицинскую модель; если пользователь её упомянет — кратко отметь недоказанность и при желании
@@ -146,18 +302,14 @@ async def generate_gpt_response(user_data: dict) -> Tuple[str, Optional[str]]:
 Заверши ОДНИМ очень коротким уточняющим вопросом (до 12 слов) — на отдельной строке после разделителя
 ---
 пример: «Что усиливает это ощущение чаще всего?».
-""".strip()
+"""
 
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user",  "content": prompt},
-    ]
-    result = await asyncio.to_thread(_sdk_chat_sync, messages, None, temperature=0.6)
-    content = result["choices"][0]["message"]["content"].strip()
-    return _split_answer_and_followup(content)
 
+def _first_pass_messages(user_data: dict, draft: Optional[str] = None) -> List[Dict[str, str]]:
+    return chat_messages(SYSTEM_PROMPT, first_pass_prompt(user_data, _FIRST_PASS_INSTRUCTIONS, draft))
 
-async def generate_final_gpt_response(user_data: dict) -> str:
+
+def _final_messages(user_data: dict) -> List[Dict[str, str]]:
     prev_reply = (user_data.get("gpt_reply") or "").strip()
 
     prompt = f"""
@@ -183,9 +335,17 @@ async def generate_final_gpt_response(user_data: dict) -> str:
 ❗ Это не медицинская консультация. При ухудшении состояния обратитесь к врачу.
 """.strip()
 
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user",   "content": prompt},
-    ]
-    result = await asyncio.to_thread(_sdk_chat_sync, messages, None, temperature=0.8)
-    return result["choices"][0]["message"]["content"].strip()
+    return chat_messages(SYSTEM_PROMPT, prompt)
+
+
+def stream_gpt_response(user_data: dict, draft: Optional[str] = None) -> AsyncIterator[str]:
+    return _sdk_chat_stream(_first_pass_messages(user_data, draft), temperature=FIRST_TEMPERATURE)
+
+
+def stream_final_gpt_response(user_data: dict) -> AsyncIterator[str]:
+    return _sdk_chat_stream(_final_messages(user_data), temperature=FINAL_TEMPERATURE)
+
+
+def cache_params() -> Dict:
+    # от чего зависит ответ на первый запрос, кроме самих ответов анкеты
+    return {"model": _current_chat_model(), "temperature": FIRST_TEMPERATURE, "prompt": PROMPT_VERSION}
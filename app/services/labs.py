@@ -0,0 +1,172 @@
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# Каноническое название → синонимы (рус/англ, сокращения с бланков разных лабораторий).
+# Короткие латинские обозначения вроде K/Na/Ca сюда сознательно не входят: в OCR-шуме
+# они совпадают с чем попало.
+ANALYTES: Dict[str, List[str]] = {
+    "Гемоглобин": ["гемоглобин", "hemoglobin", "haemoglobin", "hgb", "hb"],
+    "Эритроциты": ["эритроциты", "red blood cells", "rbc"],
+    "Лейкоциты": ["лейкоциты", "white blood cells", "wbc"],
+    "Тромбоциты": ["тромбоциты", "platelets", "plt"],
+    "Гематокрит": ["гематокрит", "hematocrit", "hct"],
+    "СОЭ": ["соэ", "скорость оседания эритроцитов", "esr"],
+    "Нейтрофилы": ["нейтрофилы", "neutrophils", "neut"],
+    "Лимфоциты": ["лимфоциты", "lymphocytes", "lymph", "lym"],
+    "Моноциты": ["моноциты", "monocytes", "mono"],
+    "Эозинофилы": ["эозинофилы", "eosinophils", "eos"],
+    "Базофилы": ["базофилы", "basophils", "baso"],
+    "MCV": ["mcv", "средний объем эритроцита", "средний объём эритроцита"],
+    "MCH": ["mch", "среднее содержание гемоглобина"],
+    "MCHC": ["mchc", "средняя концентрация гемоглобина"],
+    "Глюкоза": ["глюкоза", "сахар", "glucose", "glu"],
+    "HbA1c": ["гликированный гемоглобин", "гликозилированный гемоглобин", "hba1c"],
+    "Холестерин общий": ["холестерин общий", "общий холестерин", "холестерин", "cholesterol", "chol"],
+    "ЛПНП": ["лпнп", "холестерин лпнп", "ldl"],
+    "ЛПВП": ["лпвп", "холестерин лпвп", "hdl"],
+    "Триглицериды": ["триглицериды", "triglycerides", "trig"],
+    "АЛТ": ["алт", "аланинаминотрансфераза", "alt", "alat"],
+    "АСТ": ["аст", "аспартатаминотрансфераза", "ast", "asat"],
+    "Билирубин общий": ["билирубин общий", "общий билирубин", "билирубин", "bilirubin"],
+    "Креатинин": ["креатинин", "creatinine", "crea"],
+    "Мочевина": ["мочевина", "urea"],
+    "Мочевая кислота": ["мочевая кислота", "uric acid"],
+    "Общий белок": ["общий белок", "белок общий", "total protein"],
+    "Железо": ["сывороточное железо", "железо", "iron"],
+    "Ферритин": ["ферритин", "ferritin"],
+    "ТТГ": ["ттг", "тиреотропный гормон", "tsh"],
+    "Т4 свободный": ["т4 свободный", "свободный т4", "free t4", "ft4"],
+    "Т3 свободный": ["т3 свободный", "свободный т3", "free t3", "ft3"],
+    "Витамин D": ["витамин d", "25-oh витамин d", "25(oh)d", "vitamin d"],
+    "Витамин B12": ["витамин b12", "витамин в12", "цианокобаламин", "vitamin b12", "b12"],
+    "Кортизол": ["кортизол", "cortisol"],
+    "СРБ": ["с-реактивный белок", "c-реактивный белок", "срб", "c-reactive protein", "crp"],
+    "Калий": ["калий", "potassium"],
+    "Натрий": ["натрий", "sodium"],
+    "Кальций": ["кальций", "calcium"],
+    "Магний": ["магний", "magnesium"],
+}
+
+_UNITS = [
+    r"[×x*]?\s*10\s*[\^*]?\s*\d+\s*/\s*[лl]", r"г/дл", r"g/dl", r"г/л", r"g/l", r"мг/дл", r"mg/dl",
+    r"мг/л", r"mg/l", r"ммоль/л", r"mmol/l", r"мкмоль/л", r"[µμu]mol/l", r"нмоль/л", r"nmol/l",
+    r"пмоль/л", r"pmol/l", r"мкг/л", r"[µμu]g/l", r"нг/мл", r"ng/ml", r"пг/мл", r"pg/ml",
+    r"мк?ме/мл", r"м?к?[мm]?[еe]д/[лl]", r"[µμu]?iu/ml", r"u/l", r"мм/ч", r"mm/h", r"фл", r"fl",
+    r"пг", r"pg", r"%",
+]
+_NUM = r"\d+(?:[.,]\d+)?"
+
+# Все синонимы собираются в одно регулярное выражение при импорте; длинные варианты
+# стоят раньше, поэтому «гликированный гемоглобин» не распознаётся как «гемоглобин».
+_SYNONYM_TO_NAME = {syn: name for name, syns in ANALYTES.items() for syn in syns}
+_ANALYTE_RE = re.compile(
+    r"(?<!\w)(" + "|".join(re.escape(s) for s in sorted(_SYNONYM_TO_NAME, key=len, reverse=True)) + r")(?!\w)",
+    re.IGNORECASE,
+)
+_UNIT = r"(?:" + "|".join(_UNITS) + r")"
+_REF = rf"(?:{_NUM}\s*[-–—]\s*{_NUM}|[<>≤≥]\s*{_NUM})"
+_VALUE_RE = re.compile(
+    rf"(?P<value>[<>≤≥]?\s*{_NUM})\s*(?P<unit>{_UNIT})?"
+    rf"(?:[\s(\[]*(?:норма|референс\w*|ref\w*)?[:\s]*(?P<ref>{_REF})[\s)\]]*(?P<unit2>{_UNIT})?)?",
+    re.IGNORECASE,
+)
+_DATE_RE = re.compile(r"(?<!\d)(\d{1,2}[./-]\d{1,2}[./-](?:\d{4}|\d{2}))(?!\d)")
+
+
+class LabRow(NamedTuple):
+    analyte: str
+    value: str
+    unit: Optional[str]
+    reference: Optional[str]
+    date: Optional[str]
+
+
+def _clean_number(s: str) -> str:
+    return re.sub(r"\s+", "", s).replace(",", ".")
+
+
+# Слово из трёх и более букв: строка, где после разбора осталось такое слово, несёт
+# что-то кроме показателей (заключение, жалобу, УЗИ) и целиком идёт в промпт
+_WORD_RE = re.compile(r"[^\W\d_]{3,}")
+
+
+def _parse(text: str) -> Tuple[List[LabRow], List[str]]:
+    rows: List[LabRow] = []
+    rest: List[str] = []
+    seen = set()
+    doc_date = None
+    m = _DATE_RE.search(text or "")
+    if m:
+        doc_date = m.group(1)
+
+    for line in (text or "").splitlines():
+        matches = list(_ANALYTE_RE.finditer(line))
+        line_date = _DATE_RE.search(line)
+        leftover = list(line)
+        if line_date:
+            leftover[line_date.start(1):line_date.end(1)] = " " * len(line_date.group(1))
+        for i, match in enumerate(matches):
+            # значение ищем между названием и следующим анализом в той же строке
+            end = matches[i + 1].start() if i + 1 < len(matches) else len(line)
+            segment = line[match.end():end]
+            if line_date:
+                segment = segment.replace(line_date.group(1), " ")
+            vm = _VALUE_RE.search(segment)
+            if not vm:
+                continue
+            leftover[match.start():match.end()] = " " * (match.end() - match.start())
+            leftover[match.end() + vm.start():match.end() + vm.end()] = " " * (vm.end() - vm.start())
+            name = _SYNONYM_TO_NAME[match.group(1).lower()]
+            value = _clean_number(vm.group("value"))
+            if (name, value) in seen:
+                continue
+            seen.add((name, value))
+            unit = vm.group("unit") or vm.group("unit2")
+            ref = vm.group("ref")
+            rows.append(LabRow(
+                analyte=name,
+                value=value,
+                unit=re.sub(r"\s+", "", unit) if unit else None,
+                reference=re.sub(r"\s*[-–—]\s*", "–", ref.strip()).replace(",", ".") if ref else None,
+                date=line_date.group(1) if line_date else doc_date,
+            ))
+        if _WORD_RE.search("".join(leftover)):
+            line = line.strip()
+            if line not in rest:
+                rest.append(line)
+    return rows, rest
+
+
+def extract_lab_rows(text: str) -> List[LabRow]:
+    return _parse(text)[0]
+
+
+def format_lab_table(rows: List[LabRow]) -> str:
+    lines = []
+    dates = {r.date for r in rows}
+    common_date = dates.pop() if len(dates) == 1 else None
+    if common_date:
+        lines.append(f"Дата: {common_date}")
+    for r in rows:
+        line = f"{r.analyte}: {r.value}"
+        if r.unit:
+            line += f" {r.unit}"
+        if r.reference:
+            line += f" (норма {r.reference})"
+        if r.date and not common_date:
+            line += f", {r.date}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def analyses_for_prompt(text: Optional[str]) -> Optional[str]:
+    # в промпт идёт компактная таблица, а после неё — строки, которые в неё не попали:
+    # показатели не из словаря, заключения, слова пользователя. Если не распознали
+    # ничего — исходный текст как есть
+    rows, rest = _parse(text or "")
+    if not rows:
+        return text
+    table = format_lab_table(rows)
+    if rest:
+        table += "\nОстальное из текста:\n" + "\n".join(rest)
+    return table
@@ -0,0 +1,356 @@
+import asyncio
+import importlib
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from app.services.llm_cache import LLM_CACHE_PROVIDERS, LlmCache, cache_key, llm_cache
+from app.services.similar import REUSE_FOLLOWUP, SIM_INDEX, SimilarIndex, similar_index
+from app.services.streaming import FOLLOWUP_SEPARATOR, split_answer_and_followup
+
+logger = logging.getLogger(__name__)
+
+# Порядок — предпочтение: первый настроенный провайдер основной, остальные запасные
+LLM_PROVIDERS = [p.strip() for p in os.getenv("LLM_PROVIDERS", "openai,gigachat").split(",") if p.strip()]
+# Дублировать запрос запасному провайдеру, если основной не начал отвечать за p95 своего времени
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+# Бюджет до первого токена, пока статистики для p95 ещё не набралось, секунды
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "8"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+LLM_LATENCY_MIN_SAMPLES = 20
+# При доле ошибок выше порога провайдер уходит в конец очереди на LLM_COOLDOWN секунд
+LLM_ERROR_THRESHOLD = float(os.getenv("LLM_ERROR_THRESHOLD", "0.5"))
+LLM_COOLDOWN = float(os.getenv("LLM_COOLDOWN", "30"))
+
+FIRST_PASS = "first"
+FINAL = "final"
+
+
+class ProviderStats:
+    __slots__ = ("calls", "errors", "error_rate", "down_until", "_first_token")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.error_rate = 0.0  # экспоненциальное среднее, свежие вызовы весят больше
+        self.down_until = 0.0
+        self._first_token: deque = deque(maxlen=LLM_LATENCY_WINDOW)
+
+    def ok(self, first_token: float) -> None:
+        self.calls += 1
+        self.error_rate *= 0.9
+        self._first_token.append(first_token)
+
+    def error(self) -> None:
+        self.calls += 1
+        self.errors += 1
+        self.error_rate = self.error_rate * 0.9 + 0.1
+        if self.error_rate > LLM_ERROR_THRESHOLD:
+            self.down_until = time.monotonic() + LLM_COOLDOWN
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def p95(self) -> Optional[float]:
+        if len(self._first_token) < LLM_LATENCY_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._first_token)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "error_rate": round(self.error_rate, 3),
+            "p95_first_token": self.p95(),
+            "healthy": self.healthy,
+        }
+
+
+class LlmProvider(ABC):
+    """
+    Провайдер модели: свой клиент и свои промпты. Ответ отдаётся только стримом,
+    обычный ответ роутер собирает из него сам.
+    """
+
+    name = ""
+
+    def __init__(self) -> None:
+        self.stats = ProviderStats()
+
+    @abstractmethod
+    def configured(self) -> bool:
+        ...
+
+    async def init(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    def stream(self, kind: str, user_data: dict, draft: Optional[str] = None) -> AsyncIterator[str]:
+        ...
+
+    @abstractmethod
+    def cache_params(self) -> Dict[str, Any]:
+        # модель, температура, версия промпта — всё, кроме ответов анкеты, от чего зависит ответ
+        ...
+
+
+class _BackendProvider(LlmProvider):
+    # бэкенды — модули app/services/gpt*.py с одинаковым набором функций
+    module = ""
+    env_keys: Tuple[str, ...] = ()
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._backend = None
+
+    def _get_backend(self):
+        if self._backend is None:
+            self._backend = importlib.import_module(self.module)
+        return self._backend
+
+    def configured(self) -> bool:
+        return any(os.getenv(k) for k in self.env_keys)
+
+    async def init(self) -> None:
+        await self._get_backend().init_client()
+
+    async def close(self) -> None:
+        if self._backend is not None:
+            await self._backend.close_client()
+
+    def stream(self, kind: str, user_data: dict, draft: Optional[str] = None) -> AsyncIterator[str]:
+        backend = self._get_backend()
+        if kind == FINAL:
+            return backend.stream_final_gpt_response(user_data)
+        return backend.stream_gpt_response(user_data, draft)
+
+    def cache_params(self) -> Dict[str, Any]:
+        return self._get_backend().cache_params()
+
+
+class OpenAIProvider(_BackendProvider):
+    name = "openai"
+    module = "app.services.gpt"
+    env_keys = ("OPENAI_API_KEY",)
+
+
+class GigaChatProvider(_BackendProvider):
+    name = "gigachat"
+    module = "app.services.gpt_save"
+    env_keys = ("GIGA_AUTH_KEY", "GIGACHAT_AUTH_KEY")
+
+
+PROVIDERS = {p.name: p for p in (OpenAIProvider, GigaChatProvider)}
+
+
+class _Attempt:
+    __slots__ = ("provider", "stream", "started")
+
+    def __init__(self, provider: LlmProvider, stream: AsyncIterator[str]) -> None:
+        self.provider = provider
+        self.stream = stream
+        self.started = time.monotonic()
+
+    async def first(self) -> str:
+        try:
+            delta = await self.stream.__anext__()
+        except StopAsyncIteration:
+            delta = ""
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.provider.stats.error()
+            raise
+        self.provider.stats.ok(time.monotonic() - self.started)
+        return delta
+
+    async def close(self) -> None:
+        try:
+            await self.stream.aclose()
+        except Exception:
+            pass
+
+
+class LlmRouter:
+    """
+    Выбирает провайдера для запроса. Основной — первый здоровый по порядку
+    LLM_PROVIDERS; если он падает до первого токена, запрос уходит следующему.
+    С LLM_HEDGE, если основной молчит дольше p95 своего времени до первого токена,
+    параллельно стартует запасной, и ответ берётся у того, кто начал раньше.
+    После первого токена провайдер уже не меняется — иначе текст задвоится.
+    Первый разбор для провайдеров из LLM_CACHE_PROVIDERS берётся из кэша, если
+    такая же анкета уже встречалась. Иначе, с SIM_INDEX=1, ищется похожая сохранённая
+    сессия: её ответ идёт модели черновиком, а для простых анкет — пользователю как есть.
+    """
+
+    def __init__(self, providers: List[LlmProvider], hedge: bool = LLM_HEDGE,
+                 cache: Optional[LlmCache] = None, cached: Iterable[str] = (),
+                 similar: Optional[SimilarIndex] = None) -> None:
+        self.providers = providers
+        self.hedge = hedge
+        self.cache = cache
+        self.cached = set(cached)
+        self.similar = similar
+        self.hedged = 0
+        self.failovers = 0
+
+    @classmethod
+    def from_env(cls) -> "LlmRouter":
+        providers = [PROVIDERS[name]() for name in LLM_PROVIDERS if name in PROVIDERS]
+        return cls([p for p in providers if p.configured()], cache=llm_cache, cached=LLM_CACHE_PROVIDERS,
+                   similar=similar_index if SIM_INDEX else None)
+
+    def _ordered(self) -> List[LlmProvider]:
+        return sorted(self.providers, key=lambda p: not p.stats.healthy)
+
+    async def init(self) -> None:
+        for provider in self.providers:
+            await provider.init()
+        if self.similar is not None:
+            await self.similar.start()
+
+    async def close(self) -> None:
+        for provider in self.providers:
+            await provider.close()
+        if self.similar is not None:
+            await self.similar.stop()
+        if self.cache is not None:
+            self.cache.close()
+
+    def _cache_keys(self, kind: str, providers: List[LlmProvider], user_data: dict) -> Dict[str, str]:
+        # кэшируется только первый разбор: финальный зависит от личных ответов и не повторяется
+        if kind != FIRST_PASS or self.cache is None:
+            return {}
+        return {p.name: cache_key(p.cache_params(), user_data) for p in providers if p.name in self.cached}
+
+    async def _race(self, kind: str, user_data: dict, primary: LlmProvider,
+                    backup: Optional[LlmProvider], draft: Optional[str] = None) -> Tuple[_Attempt, str]:
+        attempts: Dict[asyncio.Task, _Attempt] = {}
+
+        def launch(provider: LlmProvider) -> None:
+            attempt = _Attempt(provider, provider.stream(kind, user_data, draft))
+            attempts[asyncio.create_task(attempt.first())] = attempt
+
+        launch(primary)
+        budget = (primary.stats.p95() or LLM_HEDGE_AFTER) if self.hedge and backup else None
+        pending = set(attempts)
+        last_err: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=budget, return_when=asyncio.FIRST_COMPLETED)
+                budget = None
+                if not done:
+                    # основной не уложился в бюджет — дублируем запрос запасному
+                    self.hedged += 1
+                    launch(backup)
+                    pending = {t for t, a in attempts.items() if not t.done()}
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        winner = attempts.pop(task)
+                        return winner, task.result()
+                    last_err = task.exception()
+                    logger.warning("LLM provider %s failed: %r", attempts[task].provider.name, last_err)
+                if not pending and backup is not None and len(attempts) == 1:
+                    self.failovers += 1
+                    launch(backup)
+                    pending = {t for t, a in attempts.items() if not t.done()}
+            raise last_err
+        finally:
+            for task, attempt in attempts.items():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await attempt.close()
+
+    async def stream(self, kind: str, user_data: dict) -> AsyncIterator[str]:
+        providers = self._ordered()
+        if not providers:
+            raise RuntimeError("No LLM provider configured (OPENAI_API_KEY / GIGA_AUTH_KEY)")
+
+        keys = self._cache_keys(kind, providers, user_data)
+        if keys:
+            reply = await self.cache.get(list(keys.values()))
+            if reply is not None:
+                yield reply
+                return
+
+        draft = None
+        if kind == FIRST_PASS and self.similar is not None:
+            match = await self.similar.lookup(user_data)
+            if match is not None and match.reusable:
+                yield match.reply + FOLLOWUP_SEPARATOR + REUSE_FOLLOWUP
+                return
+            draft = match.reply if match is not None else None
+
+        last_err: Optional[BaseException] = None
+        for i in range(0, len(providers), 2):
+            backup = providers[i + 1] if i + 1 < len(providers) else None
+            try:
+                attempt, first = await self._race(kind, user_data, providers[i], backup, draft)
+            except Exception as e:
+                last_err = e
+                continue
+            parts = [first]
+            try:
+                if first:
+                    yield first
+                async for delta in attempt.stream:
+                    parts.append(delta)
+                    yield delta
+            except Exception:
+                attempt.provider.stats.error()
+                raise
+            finally:
+                await attempt.close()
+            key = keys.get(attempt.provider.name)
+            reply = "".join(parts)
+            if key and reply.strip():
+                await self.cache.put(key, reply)
+            return
+        raise last_err
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "providers": {p.name: p.stats.snapshot() for p in self.providers},
+            "hedged": self.hedged,
+            "failovers": self.failovers,
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "similar": self.similar.stats() if self.similar is not None else None,
+        }
+
+
+router = LlmRouter.from_env()
+
+
+async def init_client() -> None:
+    await router.init()
+
+
+async def close_client() -> None:
+    await router.close()
+
+
+def stream_gpt_response(user_data: dict) -> AsyncIterator[str]:
+    return router.stream(FIRST_PASS, user_data)
+
+
+def stream_final_gpt_response(user_data: dict) -> AsyncIterator[str]:
+    return router.stream(FINAL, user_data)
+
+
+async def generate_gpt_response(user_data: dict) -> Tuple[str, Optional[str]]:
+    text = "".join([delta async for delta in stream_gpt_response(user_data)])
+    return split_answer_and_followup(text.strip())
+
+
+async def generate_final_gpt_response(user_data: dict) -> str:
+    text = "".join([delta async for delta in stream_final_gpt_response(user_data)])
+    return text.strip()
@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.flow.engine import NO_ANSWERS
+
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", "llm_cache.db")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX = int(os.getenv("LLM_CACHE_MAX", "512"))
+# Кэш включается по провайдерам: при высокой температуре одинаковый ввод и так даёт разные
+# ответы, и повтор одного и того же текста — осознанное решение. Пример: "openai,gigachat"
+LLM_CACHE_PROVIDERS = {p.strip() for p in os.getenv("LLM_CACHE_PROVIDERS", "").split(",") if p.strip()}
+
+# Поля анкеты, из которых собирается первый запрос к модели
+FIRST_PASS_FIELDS = (
+    "diagnosis", "analyses", "analysis_details", "symptoms",
+    "onset", "context", "psycho_state", "life_events",
+)
+
+# «нет», прочерк, пустой ответ и «не указан» для модели значат одно и то же
+_PLACEHOLDERS = NO_ANSWERS | {"", "none", "не указан", "не указано", "нету", "ничего", "n/a"}
+
+
+def normalize(value: Any) -> str:
+    text = " ".join(str(value or "").split()).casefold().replace("ё", "е").strip(" .,!")
+    return "" if text in _PLACEHOLDERS else text
+
+
+def cache_key(params: Dict[str, Any], user_data: dict) -> str:
+    # params — модель, температура и версия промпта провайдера
+    fields = {name: normalize(user_data.get(name)) for name in FIRST_PASS_FIELDS}
+    payload = json.dumps({"params": params, "fields": fields}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LlmCache:
+    """
+    Кэш ответов модели по точному совпадению нормализованного ввода. Горячие записи
+    держатся в памяти (LRU на `max_entries`), все — в SQLite, чтобы пережить
+    перезапуск и быть общими для воркеров. Записи старше `ttl` не отдаются.
+    """
+
+    def __init__(self, path: str = LLM_CACHE_DB, ttl: float = LLM_CACHE_TTL,
+                 max_entries: int = LLM_CACHE_MAX) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_replies (
+                    key TEXT PRIMARY KEY,
+                    reply TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_replies_created_at ON llm_replies (created_at)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _remember(self, key: str, reply: str, created_at: float) -> None:
+        self._memory[key] = (reply, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, key: str, now: float) -> Optional[str]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            if now - entry[1] < self.ttl:
+                self._memory.move_to_end(key)
+                return entry[0]
+            del self._memory[key]
+        row = self._db().execute(
+            "SELECT reply, created_at FROM llm_replies WHERE key = ? AND created_at > ?",
+            (key, now - self.ttl),
+        ).fetchone()
+        if row is None:
+            return None
+        self._remember(key, row[0], row[1])
+        self.disk_hits += 1
+        return row[0]
+
+    def _get(self, keys: List[str]) -> Optional[str]:
+        # ключей несколько — по одному на провайдера, ответ любого из них подходит
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                reply = self._lookup(key, now)
+                if reply is not None:
+                    self.hits += 1
+                    return reply
+            self.misses += 1
+            return None
+
+    def _put(self, key: str, reply: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._remember(key, reply, now)
+            conn = self._db()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_replies (key, reply, created_at) VALUES (?, ?, ?)",
+                (key, reply, now),
+            )
+            conn.execute("DELETE FROM llm_replies WHERE created_at <= ?", (now - self.ttl,))
+            conn.commit()
+
+    async def get(self, keys: List[str]) -> Optional[str]:
+        return await asyncio.to_thread(self._get, keys)
+
+    async def put(self, key: str, reply: str) -> None:
+        await asyncio.to_thread(self._put, key, reply)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+llm_cache = LlmCache()
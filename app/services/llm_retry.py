@@ -0,0 +1,155 @@
+import asyncio
+import os
+import random
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Optional, TypeVar
+
+import httpx
+
+T = TypeVar("T")
+
+# Сколько всего ждём ответ модели с момента, когда запрос получил слот, секунды
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "120"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+# Дедлайн едет вместе с контекстом задачи: его видит и роутер, и HTTP-запрос внутри бэкенда
+_deadline: ContextVar[Optional[float]] = ContextVar("llm_deadline", default=None)
+
+
+@contextmanager
+def _deadline_at(at: float) -> Iterator[None]:
+    outer = _deadline.get()
+    # вложенный дедлайн не может отодвинуть внешний
+    token = _deadline.set(at if outer is None else min(at, outer))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def deadline(seconds: float = LLM_DEADLINE):
+    return _deadline_at(time.monotonic() + seconds)
+
+
+def remaining() -> Optional[float]:
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def check_deadline() -> None:
+    left = remaining()
+    if left is not None and left <= 0:
+        raise TimeoutError("LLM deadline exceeded")
+
+
+async def until_deadline(stream: AsyncIterator[T], seconds: Optional[float] = None) -> AsyncIterator[T]:
+    """
+    Читает стрим не дольше дедлайна: зависшее чтение прерывается TimeoutError.
+    Без `seconds` действует дедлайн из контекста (deadline()) — так бэкенды читают
+    уже начатый ответ модели. С `seconds` дедлайн задаётся здесь, и только на время
+    шага: так оборачиваются генераторы, которые сами отдают управление наружу (SSE).
+    `with deadline()` вокруг их yield сломался бы, если генератор закроют из
+    другой задачи.
+    """
+    at = None if seconds is None else time.monotonic() + seconds
+    it = stream.__aiter__()
+    try:
+        while True:
+            with _deadline_at(at) if at is not None else nullcontext():
+                check_deadline()
+                left = remaining()
+                try:
+                    if left is None:
+                        item = await it.__anext__()
+                    else:
+                        item = await asyncio.wait_for(it.__anext__(), left)
+                except StopAsyncIteration:
+                    return
+            yield item
+    finally:
+        aclose = getattr(it, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def status_of(exc: BaseException) -> Optional[int]:
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    return parse_retry_after(getattr(getattr(exc, "response", None), "headers", None))
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retryable(exc: BaseException) -> bool:
+    status = status_of(exc)
+    if status is not None:
+        return status in RETRY_STATUSES
+    return isinstance(exc, httpx.TransportError)
+
+
+def backoff(attempt: int) -> float:
+    # «полный» джиттер: одновременно упавшие запросы не возвращаются к провайдеру разом
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+
+async def with_retries(call: Callable[[Optional[float]], Awaitable[T]],
+                       is_retryable: Callable[[BaseException], bool] = retryable,
+                       get_retry_after: Callable[[BaseException], Optional[float]] = retry_after,
+                       attempts: int = LLM_RETRIES) -> T:
+    """
+    Вызывает call(timeout) с повторами при временных ошибках. timeout — сколько осталось
+    до дедлайна (None, если дедлайна нет); пауза между попытками растёт экспоненциально,
+    но не меньше Retry-After провайдера. Если пауза не укладывается в дедлайн,
+    повтора не будет — сразу поднимается последняя ошибка.
+    """
+    attempt = 0
+    while True:
+        check_deadline()
+        left = remaining()
+        try:
+            if left is None:
+                return await call(None)
+            return await asyncio.wait_for(call(left), left)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            attempt += 1
+            if attempt >= attempts or not is_retryable(e):
+                raise
+            delay = max(backoff(attempt - 1), get_retry_after(e) or 0.0)
+            left = remaining()
+            if left is not None and delay >= left:
+                raise
+            await asyncio.sleep(delay)
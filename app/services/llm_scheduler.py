@@ -0,0 +1,186 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Dict, Hashable, List, Optional, Set
+
+# Сколько запросов к модели выполняется одновременно — держим чуть ниже лимита провайдера.
+# Лимит на весь инстанс: процессы, которые ходят к модели, делят его через share_llm_slots().
+# Отдельно запущенный веб (BOT_MODE=polling) — отдельный инстанс со своим лимитом
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+# Меньше — раньше: финальный ответ завершает уже начатую сессию, его ждут дольше всех
+PRIORITY_FINAL = 0
+PRIORITY_FIRST = 1
+
+
+class LlmCancelled(Exception):
+    """Запрос к модели отменён: пользователь начал заново или ушёл."""
+
+
+class Ticket:
+    """
+    Место в очереди к модели. positions() отдаёт номер в очереди при каждом его
+    изменении и завершается, когда слот выдан; release() обязателен в любом случае.
+    Работа, запущенная через run(), отменяется вызовом abort() — например, из
+    LlmScheduler.cancel(), когда пользователь нажал «Начать заново».
+    """
+
+    __slots__ = ("user", "priority", "seq", "position", "granted", "released", "aborted", "queued_at",
+                 "_scheduler", "_wake", "_task")
+
+    def __init__(self, scheduler: "LlmScheduler", user: Hashable, priority: int, seq: int) -> None:
+        self._scheduler = scheduler
+        self.user = user
+        self.priority = priority
+        self.seq = seq
+        self.position = 0
+        self.granted = False
+        self.released = False
+        self.aborted = False
+        self.queued_at = time.monotonic()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __lt__(self, other: "Ticket") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def _notify(self) -> None:
+        self._wake.set()
+
+    async def positions(self) -> AsyncIterator[int]:
+        last = 0
+        while True:
+            # сначала сброс, потом проверка: слот, выданный, пока потребитель стоял
+            # на yield (например, редактировал сообщение), не должен потеряться
+            self._wake.clear()
+            if self.granted:
+                return
+            if self.position != last:
+                last = self.position
+                yield last
+                continue
+            await self._wake.wait()
+
+    async def wait(self) -> None:
+        async for _ in self.positions():
+            pass
+
+    async def run(self, work: Awaitable[Any]) -> Any:
+        # работа идёт в отдельной задаче: abort() отменяет её, а не обработчик, который её ждёт
+        if self.aborted:
+            work.close()
+            raise LlmCancelled()
+        self._task = asyncio.ensure_future(work)
+        try:
+            return await self._task
+        except asyncio.CancelledError:
+            if self.aborted:
+                raise LlmCancelled() from None
+            raise
+        finally:
+            self._task = None
+
+    def abort(self) -> None:
+        self.aborted = True
+        if self._task is not None:
+            self._task.cancel()
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self._scheduler._release(self)
+
+
+class LlmScheduler:
+    """
+    Общая очередь запросов к модели: не больше `limit` одновременно, порядок — по
+    приоритету, затем по времени постановки. У одного пользователя одновременно
+    выполняется не больше одного запроса, следующий ждёт, не занимая слот.
+    """
+
+    def __init__(self, limit: int = LLM_MAX_CONCURRENCY) -> None:
+        self.limit = limit
+        self._waiting: List[Ticket] = []
+        self._busy: Set[Hashable] = set()
+        self._running = 0
+        self._tickets: Set[Ticket] = set()
+        self._seq = itertools.count()
+        self.granted = 0
+        self.cancelled = 0
+        self.max_wait = 0.0
+
+    def submit(self, user: Hashable, priority: int = PRIORITY_FIRST) -> Ticket:
+        ticket = Ticket(self, user, priority, next(self._seq))
+        self._tickets.add(ticket)
+        heapq.heappush(self._waiting, ticket)
+        self._dispatch()
+        return ticket
+
+    def _dispatch(self) -> None:
+        deferred = []
+        while self._running < self.limit and self._waiting:
+            ticket = heapq.heappop(self._waiting)
+            if ticket.user in self._busy:
+                deferred.append(ticket)
+                continue
+            self._running += 1
+            self._busy.add(ticket.user)
+            ticket.granted = True
+            self.granted += 1
+            self.max_wait = max(self.max_wait, time.monotonic() - ticket.queued_at)
+            ticket._notify()
+        for ticket in deferred:
+            heapq.heappush(self._waiting, ticket)
+
+        for i, ticket in enumerate(sorted(self._waiting), 1):
+            if ticket.position != i:
+                ticket.position = i
+                ticket._notify()
+
+    def _release(self, ticket: Ticket) -> None:
+        self._tickets.discard(ticket)
+        if ticket.granted:
+            self._running -= 1
+            self._busy.discard(ticket.user)
+        else:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+        self._dispatch()
+
+    def cancel(self, user: Hashable) -> int:
+        # и ждущие в очереди, и уже выполняющиеся запросы пользователя
+        tickets = [t for t in self._tickets if t.user == user and not t.aborted]
+        for ticket in tickets:
+            ticket.abort()
+        self.cancelled += len(tickets)
+        return len(tickets)
+
+    @asynccontextmanager
+    async def slot(self, user: Hashable, priority: int = PRIORITY_FIRST) -> AsyncIterator[Ticket]:
+        ticket = self.submit(user, priority)
+        try:
+            await ticket.wait()
+            yield ticket
+        finally:
+            ticket.release()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "running": self._running,
+            "waiting": len(self._waiting),
+            "granted": self.granted,
+            "cancelled": self.cancelled,
+            "max_wait": self.max_wait,
+        }
+
+
+llm_scheduler = LlmScheduler()
+
+
+def share_llm_slots(processes: int) -> None:
+    # очередь у каждого процесса своя: шарды бота (bot/shard.py) и веб при BOT_MODE=webhook
+    # делят LLM_MAX_CONCURRENCY между собой, а не открывают к провайдеру по столько же каждый
+    llm_scheduler.limit = max(1, LLM_MAX_CONCURRENCY // processes)
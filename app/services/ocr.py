@@ -1,11 +1,296 @@
-from PIL import Image
+from PIL import Image, ImageOps
+import fitz
 import pytesseract
+import asyncio
 import io
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
 
-async def extract_text_from_photo(photo_bytes: bytes) -> str:
+logger = logging.getLogger(__name__)
+
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "2"))
+OCR_QUEUE_SIZE = int(os.getenv("OCR_QUEUE_SIZE", "8"))
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "60"))
+
+# Минимальная длинная сторона фото, на которой мелкий текст бланка ещё читается
+OCR_MIN_LONG_SIDE = int(os.getenv("OCR_MIN_LONG_SIDE", "1280"))
+# К какому разрешению приводим кадр: считаем, что на фото лист A4 по ширине
+OCR_TARGET_DPI = int(os.getenv("OCR_TARGET_DPI", "300"))
+OCR_PAGE_WIDTH_INCHES = 8.27
+OCR_MAX_UPSCALE = float(os.getenv("OCR_MAX_UPSCALE", "1.5"))
+OCR_DETECT_ROTATION = os.getenv("OCR_DETECT_ROTATION", "0") == "1"
+
+OCR_PDF_MAX_PAGES = int(os.getenv("OCR_PDF_MAX_PAGES", "20"))
+# Страница с текстовым слоем короче этого считается сканом и уходит в OCR
+OCR_PDF_MIN_TEXT = int(os.getenv("OCR_PDF_MIN_TEXT", "30"))
+
+
+class OcrBusyError(Exception):
+    pass
+
+
+class PdfReadError(Exception):
+    pass
+
+
+def pick_photo_size(sizes: Sequence[Any]) -> Any:
+    # Telegram присылает несколько размеров одного фото; берём самый маленький из достаточных
+    ordered = sorted(sizes, key=lambda p: p.width * p.height)
+    for size in ordered:
+        if max(size.width, size.height) >= OCR_MIN_LONG_SIDE:
+            return size
+    return ordered[-1]
+
+
+def _otsu_threshold(gray: Image.Image) -> int:
+    hist = gray.histogram()
+    total = sum(hist)
+    sum_all = sum(i * h for i, h in enumerate(hist))
+    sum_bg = 0.0
+    weight_bg = 0
+    best, threshold = 0.0, 127
+    for i, h in enumerate(hist):
+        weight_bg += h
+        if weight_bg == 0:
+            continue
+        weight_fg = total - weight_bg
+        if weight_fg == 0:
+            break
+        sum_bg += i * h
+        mean_bg = sum_bg / weight_bg
+        mean_fg = (sum_all - sum_bg) / weight_fg
+        between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+        if between > best:
+            best, threshold = between, i
+    return threshold
+
+
+def preprocess_image(image: Image.Image) -> Tuple[Image.Image, Dict[str, float]]:
+    timings: Dict[str, float] = {}
+
+    t = time.perf_counter()
+    image = ImageOps.exif_transpose(image)
+    timings["orient"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    gray = image.convert("L")
+    timings["grayscale"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    target_width = OCR_TARGET_DPI * OCR_PAGE_WIDTH_INCHES
+    scale = min(target_width / min(gray.size), OCR_MAX_UPSCALE)
+    if abs(scale - 1.0) > 0.1:
+        size = (max(1, round(gray.width * scale)), max(1, round(gray.height * scale)))
+        gray = gray.resize(size, Image.LANCZOS if scale < 1 else Image.BICUBIC)
+    timings["resize"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    gray = ImageOps.autocontrast(gray, cutoff=1)
+    threshold = _otsu_threshold(gray)
+    binary = gray.point(lambda v: 255 if v > threshold else 0, mode="1")
+    timings["binarize"] = time.perf_counter() - t
+
+    if OCR_DETECT_ROTATION:
+        t = time.perf_counter()
+        try:
+            osd = pytesseract.image_to_osd(binary, output_type=pytesseract.Output.DICT)
+            if osd.get("rotate"):
+                binary = binary.rotate(-osd["rotate"], expand=True)
+        except pytesseract.TesseractError:
+            pass
+        timings["rotation"] = time.perf_counter() - t
+
+    return binary, timings
+
+
+def _ocr_image(photo_bytes: bytes, timeout: float) -> Tuple[str, Dict[str, float]]:
+    # выполняется в процессе-воркере; timeout убивает зависший tesseract
+    t = time.perf_counter()
+    image = Image.open(io.BytesIO(photo_bytes))
+    image.load()
+    timings = {"decode": time.perf_counter() - t}
+
+    image, stages = preprocess_image(image)
+    timings.update(stages)
+
+    t = time.perf_counter()
+    text = pytesseract.image_to_string(
+        image, lang="rus+eng", config=f"--dpi {OCR_TARGET_DPI}", timeout=timeout
+    )
+    timings["tesseract"] = time.perf_counter() - t
+    return text.strip(), timings
+
+
+def _ocr_pdf_page(page_pdf: bytes, timeout: float) -> Tuple[str, Dict[str, float]]:
+    # рендер скана тоже делаем в воркере: это такая же тяжёлая CPU-работа, как OCR
+    t = time.perf_counter()
+    with fitz.open(stream=page_pdf, filetype="pdf") as doc:
+        pix = doc[0].get_pixmap(dpi=OCR_TARGET_DPI, colorspace=fitz.csGRAY)
+        image = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    timings = {"render": time.perf_counter() - t}
+
+    image, stages = preprocess_image(image)
+    timings.update(stages)
+
+    t = time.perf_counter()
+    text = pytesseract.image_to_string(
+        image, lang="rus+eng", config=f"--dpi {OCR_TARGET_DPI}", timeout=timeout
+    )
+    timings["tesseract"] = time.perf_counter() - t
+    return text.strip(), timings
+
+
+def _split_pdf(pdf_bytes: bytes) -> Tuple[int, List[str], Dict[int, bytes]]:
+    # текстовый слой первых OCR_PDF_MAX_PAGES страниц и сканы — каждый отдельным
+    # одностраничным PDF: в воркер уходит только его страница, а не весь документ
+    try:
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            if doc.needs_pass:
+                raise PdfReadError("PDF is password-protected")
+            pages = [doc[i].get_text().strip() for i in range(min(doc.page_count, OCR_PDF_MAX_PAGES))]
+            scans = {}
+            for i, text in enumerate(pages):
+                if len(text) < OCR_PDF_MIN_TEXT:
+                    with fitz.open() as page:
+                        page.insert_pdf(doc, from_page=i, to_page=i)
+                        scans[i] = page.tobytes(garbage=3, deflate=True)
+            return doc.page_count, pages, scans
+    except PdfReadError:
+        raise
+    except Exception as e:
+        # битый файл: fitz поднимает FileDataError (RuntimeError) или внутренние mupdf.FzError*
+        raise PdfReadError(str(e)) from e
+
+
+class OcrPool:
+    """
+    Пул процессов для Tesseract, чтобы распознавание не блокировало event loop.
+    Одновременно выполняется не больше `workers` задач, ещё `queue_size` ждут
+    своей очереди; сверх этого новые задачи отклоняются с OcrBusyError.
+    """
+
+    def __init__(self, workers: int, queue_size: int) -> None:
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+        self._slots = asyncio.Semaphore(workers)
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args: Any, timeout: float = OCR_TIMEOUT,
+                  on_queued: Optional[Callable[[int], Awaitable[Any]]] = None) -> Any:
+        if self.pending >= self.workers + self.queue_size:
+            raise OcrBusyError("OCR queue is full")
+
+        self.pending += 1
+        submitted = False
+        try:
+            if on_queued is not None and self._slots.locked():
+                await on_queued(self.pending - self.workers)
+            await self._slots.acquire()
+            try:
+                job = self._get_executor().submit(fn, *args)
+            except BaseException:
+                self._slots.release()
+                raise
+            submitted = True
+            # процесс не прервать: по таймауту или отмене задача в пуле доработает сама,
+            # и слот вместе со счётчиком освобождается, только когда она действительно
+            # закончилась — иначе в пуле окажется больше задач, чем `workers`
+            loop = asyncio.get_running_loop()
+            job.add_done_callback(lambda _: self._call_done(loop))
+            return await asyncio.wait_for(asyncio.wrap_future(job), timeout)
+        finally:
+            if not submitted:
+                self.pending -= 1
+
+    def _call_done(self, loop: asyncio.AbstractEventLoop) -> None:
+        # колбэк future пула вызывается из его служебного потока
+        try:
+            loop.call_soon_threadsafe(self._done)
+        except RuntimeError:
+            pass  # loop уже закрыт при остановке
+
+    def _done(self) -> None:
+        self.pending -= 1
+        self._slots.release()
+
+    def shutdown(self) -> None:
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pool = OcrPool(OCR_WORKERS, OCR_QUEUE_SIZE)
+
+
+def share_ocr_pool(processes: int) -> None:
+    # несколько процессов бота (bot/shard.py) делят OCR_WORKERS между собой,
+    # а не заводят по OCR_WORKERS процессов Tesseract каждый
+    global _pool
+    workers = max(1, OCR_WORKERS // processes)
+    if workers != _pool.workers:
+        _pool.shutdown()
+        _pool = OcrPool(workers, max(1, OCR_QUEUE_SIZE // processes))
+
+
+def shutdown_ocr_pool() -> None:
+    _pool.shutdown()
+
+
+async def extract_text_from_photo(photo_bytes: bytes,
+                                  on_queued: Optional[Callable[[int], Awaitable[Any]]] = None) -> str:
     try:
-        image = Image.open(io.BytesIO(photo_bytes))
-        text = pytesseract.image_to_string(image, lang="rus+eng")
-        return text.strip()
+        text, timings = await _pool.run(
+            _ocr_image, photo_bytes, OCR_TIMEOUT, timeout=OCR_TIMEOUT + 5, on_queued=on_queued
+        )
+        logger.info("OCR %d bytes: %s", len(photo_bytes),
+                    ", ".join(f"{k}={v * 1000:.0f}ms" for k, v in timings.items()))
+        return text
+    except OcrBusyError:
+        raise
+    except asyncio.TimeoutError:
+        return "❌ Не удалось распознать текст с фото: распознавание заняло слишком много времени."
     except Exception as e:
         return f"❌ Не удалось распознать текст с фото. Ошибка: {e}"
+
+
+async def extract_text_from_pdf(pdf_bytes: bytes) -> AsyncIterator[Tuple[int, int, str]]:
+    """
+    Отдаёт (номер страницы, всего страниц в документе, текст) по порядку страниц.
+    Текстовый слой берётся как есть, сканы распознаются параллельно в пуле OCR.
+    Обрабатываются только первые OCR_PDF_MAX_PAGES страниц.
+    """
+    total, layers, scans = await asyncio.to_thread(_split_pdf, pdf_bytes)
+    # не больше задач, чем воркеров: один документ не должен забивать общую очередь
+    slots = asyncio.Semaphore(_pool.workers)
+
+    async def ocr_page(index: int) -> str:
+        async with slots:
+            try:
+                text, timings = await _pool.run(
+                    _ocr_pdf_page, scans[index], OCR_TIMEOUT, timeout=OCR_TIMEOUT + 5
+                )
+            except OcrBusyError:
+                raise
+            except Exception:
+                return f"❌ Страница {index + 1} не распознана."
+        logger.info("OCR pdf page %d: %s", index + 1,
+                    ", ".join(f"{k}={v * 1000:.0f}ms" for k, v in timings.items()))
+        return text
+
+    tasks = {i: asyncio.create_task(ocr_page(i)) for i in scans}
+    try:
+        for i, layer in enumerate(layers):
+            text = await tasks[i] if i in tasks else layer
+            yield i + 1, total, text
+    finally:
+        for task in tasks.values():
+            task.cancel()
@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from app.services.ocr import extract_text_from_photo, extract_text_from_pdf
+
+OCR_CACHE_DB = os.getenv("OCR_CACHE_DB", "ocr_cache.db")
+OCR_CACHE_MAX_BYTES = int(os.getenv("OCR_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class OcrCache:
+    """
+    Кэш результатов OCR в SQLite. Ключи — file_unique_id из Telegram (попадание
+    не требует даже скачивать фото) и sha256 содержимого (то же фото, присланное
+    заново, получает новый file_id). Вытеснение — LRU по суммарному размеру текстов.
+    """
+
+    def __init__(self, path: str = OCR_CACHE_DB, max_bytes: int = OCR_CACHE_MAX_BYTES) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS ocr_texts (
+                    content_hash TEXT PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS ocr_texts_last_used ON ocr_texts (last_used)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS ocr_files (
+                    file_unique_id TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL
+                )
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _touch(self, conn: sqlite3.Connection, digest: str) -> Optional[str]:
+        row = conn.execute("SELECT text FROM ocr_texts WHERE content_hash = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE ocr_texts SET last_used = ? WHERE content_hash = ?", (time.time(), digest))
+        return row[0]
+
+    def _get_by_file_id(self, file_unique_id: str) -> Optional[str]:
+        with self._lock:
+            conn = self._db()
+            row = conn.execute(
+                "SELECT content_hash FROM ocr_files WHERE file_unique_id = ?", (file_unique_id,)
+            ).fetchone()
+            text = self._touch(conn, row[0]) if row else None
+            conn.commit()
+            return text
+
+    def _get_by_hash(self, digest: str, file_unique_id: Optional[str]) -> Optional[str]:
+        with self._lock:
+            conn = self._db()
+            text = self._touch(conn, digest)
+            if text is not None and file_unique_id:
+                conn.execute(
+                    "INSERT OR REPLACE INTO ocr_files (file_unique_id, content_hash) VALUES (?, ?)",
+                    (file_unique_id, digest),
+                )
+            conn.commit()
+            return text
+
+    def _put(self, digest: str, file_unique_id: Optional[str], text: str) -> None:
+        size = len(text.encode("utf-8"))
+        with self._lock:
+            conn = self._db()
+            conn.execute(
+                "INSERT OR REPLACE INTO ocr_texts (content_hash, text, size, last_used) VALUES (?, ?, ?, ?)",
+                (digest, text, size, time.time()),
+            )
+            if file_unique_id:
+                conn.execute(
+                    "INSERT OR REPLACE INTO ocr_files (file_unique_id, content_hash) VALUES (?, ?)",
+                    (file_unique_id, digest),
+                )
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_texts").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for digest, size in conn.execute("SELECT content_hash, size FROM ocr_texts ORDER BY last_used"):
+            victims.append((digest,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        conn.executemany("DELETE FROM ocr_texts WHERE content_hash = ?", victims)
+        conn.executemany("DELETE FROM ocr_files WHERE content_hash = ?", victims)
+
+    async def get_by_file_id(self, file_unique_id: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get_by_file_id, file_unique_id)
+
+    async def get_by_hash(self, digest: str, file_unique_id: Optional[str] = None) -> Optional[str]:
+        return await asyncio.to_thread(self._get_by_hash, digest, file_unique_id)
+
+    async def put(self, digest: str, file_unique_id: Optional[str], text: str) -> None:
+        await asyncio.to_thread(self._put, digest, file_unique_id, text)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+ocr_cache = OcrCache()
+
+
+async def extract_text_cached(file_unique_id: str, download: Callable[[], Awaitable[bytes]],
+                              on_queued: Optional[Callable[[int], Awaitable[Any]]] = None) -> str:
+    text = await ocr_cache.get_by_file_id(file_unique_id)
+    if text is not None:
+        ocr_cache.hits += 1
+        return text
+
+    photo_bytes = await download()
+    digest = content_hash(photo_bytes)
+    text = await ocr_cache.get_by_hash(digest, file_unique_id)
+    if text is not None:
+        ocr_cache.hits += 1
+        return text
+
+    ocr_cache.misses += 1
+    text = await extract_text_from_photo(photo_bytes, on_queued=on_queued)
+    if not text.startswith("❌"):
+        await ocr_cache.put(digest, file_unique_id, text)
+    return text
+
+
+async def extract_pdf_text_cached(file_unique_id: str, download: Callable[[], Awaitable[bytes]],
+                                  on_page: Callable[[int, int, str], Awaitable[Any]]) -> str:
+    text = await ocr_cache.get_by_file_id(file_unique_id)
+    if text is None:
+        pdf_bytes = await download()
+        digest = content_hash(pdf_bytes)
+        text = await ocr_cache.get_by_hash(digest, file_unique_id)
+    if text is not None:
+        ocr_cache.hits += 1
+        await on_page(1, 1, text)
+        return text
+
+    ocr_cache.misses += 1
+    parts = []
+    failed = False
+    async for page, total, page_text in extract_text_from_pdf(pdf_bytes):
+        failed = failed or page_text.startswith("❌")
+        parts.append(page_text)
+        await on_page(page, total, page_text)
+    text = "\n\n".join(parts)
+    if not failed:
+        await ocr_cache.put(digest, file_unique_id, text)
+    return text
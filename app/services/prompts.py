@@ -0,0 +1,39 @@
+from typing import Dict, List, Optional
+
+from app.services.labs import analyses_for_prompt
+
+# Общая часть промптов обоих бэкендов (gpt.py, gpt_save.py). Системные промпты и
+# инструкции у бэкендов свои; при правке текста здесь поднять PROMPT_VERSION в обоих.
+
+
+def first_pass_prompt(user_data: dict, instructions: str, draft: Optional[str] = None) -> str:
+    diagnosis = user_data.get("diagnosis", "не указан")
+    prompt = f"""
+Пользователь рассказал о своём состоянии.
+Диагноз: {diagnosis}
+Симптомы: {user_data.get('symptoms')}
+Когда началось: {user_data.get('onset')}
+Контекст: {user_data.get('context')}
+Анализы: {analyses_for_prompt(user_data.get('analyses'))}
+Детали анализов: {user_data.get('analysis_details')}
+Эмоциональный фон: {user_data.get('psycho_state')}
+Важные события: {user_data.get('life_events')}
+
+{instructions.strip()}
+""".strip()
+    if draft:
+        # ответ на похожую анкету (app/services/similar.py): дописать проще, чем писать с нуля
+        prompt += (
+            "\n\nЧерновик — ответ человеку с похожей историей:\n"
+            f"{draft}\n\n"
+            "Возьми его за основу: оставь то, что подходит, перепиши под данные этого пользователя "
+            "и убери всё, что к нему не относится. Структура и требования выше остаются в силе."
+        )
+    return prompt
+
+
+def chat_messages(system_prompt: str, prompt: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt},
+    ]
@@ -0,0 +1,483 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # не POSIX: считаем, что процесс один
+    fcntl = None
+
+from app.db.database import SESSION_FIELDS, add_save_listener, get_session_reply, get_sessions_after
+from app.services.llm_cache import normalize
+
+logger = logging.getLogger(__name__)
+
+# Индекс похожих сессий выключен, пока не задан SIM_INDEX=1
+SIM_INDEX = os.getenv("SIM_INDEX", "0") == "1"
+SIM_INDEX_PATH = os.getenv("SIM_INDEX_PATH", "similar_index.npz")
+SIM_DIM = int(os.getenv("SIM_DIM", "256"))
+# Косинусная близость, с которой прошлый ответ идёт модели черновиком
+SIM_DRAFT_THRESHOLD = float(os.getenv("SIM_DRAFT_THRESHOLD", "0.8"))
+# ...и с которой он отдаётся как есть — если и эта анкета, и та, на которую он был
+# написан, короткие и без диагноза и анализов
+SIM_REUSE_THRESHOLD = float(os.getenv("SIM_REUSE_THRESHOLD", "0.97"))
+SIM_TRIVIAL_CHARS = int(os.getenv("SIM_TRIVIAL_CHARS", "80"))
+SIM_BUILD_BATCH = 2000
+# Как часто подтягивать из базы сессии, сохранённые другими процессами, секунды
+SIM_SYNC_INTERVAL = float(os.getenv("SIM_SYNC_INTERVAL", "30"))
+# Как часто процесс-владелец переписывает файл индекса, если он изменился, секунды
+SIM_SAVE_INTERVAL = float(os.getenv("SIM_SAVE_INTERVAL", "600"))
+
+# По этим полям сравниваются анкеты: симптом, эмоциональный фон и обстоятельства.
+# Диагноз не сравнивается по близости, а должен совпасть (см. diagnosis_key)
+INDEX_FIELDS = ("symptoms", "onset", "context", "analyses", "analysis_details", "psycho_state", "life_events")
+NGRAMS = (3, 4)
+# Диагноз неизвестен (сессии, сохранённые до того, как его стали записывать)
+UNKNOWN_DIAGNOSIS = -1
+
+# Уточняющего вопроса у сохранённого ответа нет — для готового ответа задаём общий
+REUSE_FOLLOWUP = "Что из этого сильнее всего откликается в вашей ситуации?"
+
+
+def _text(data: Dict[str, Any]) -> str:
+    return " | ".join(value for value in (normalize(data.get(name)) for name in INDEX_FIELDS) if value)
+
+
+def vectorize(text: str, dim: int = SIM_DIM) -> np.ndarray:
+    # символьные n-граммы, разложенные по `dim` корзинам хэшем (crc32 — одинаковый в
+    # любом процессе, индекс можно хранить на диске); tf сублинейный
+    padded = f" {text} "
+    buckets = [
+        zlib.crc32(padded[i:i + n].encode("utf-8")) % dim
+        for n in NGRAMS
+        for i in range(len(padded) - n + 1)
+    ]
+    vec = np.bincount(buckets, minlength=dim).astype(np.float32) if buckets else np.zeros(dim, np.float32)
+    nz = vec > 0
+    vec[nz] = 1.0 + np.log(vec[nz])
+    return vec
+
+
+def diagnosis_key(data: Dict[str, Any]) -> int:
+    # «нет», прочерк и пустой ответ дают один ключ; похожей считается только сессия с тем же
+    # диагнозом, иначе черновиком стал бы ответ про болезнь, которой у человека нет
+    diagnosis = data.get("diagnosis")
+    if diagnosis is None:
+        return UNKNOWN_DIAGNOSIS
+    return zlib.crc32(normalize(diagnosis).encode("utf-8"))
+
+
+def _trivial(data: Dict[str, Any]) -> bool:
+    if data.get("diagnosis") is None or normalize(data.get("diagnosis")):
+        return False
+    if normalize(data.get("analyses")) or normalize(data.get("analysis_details")):
+        return False
+    return len(_text(data)) <= SIM_TRIVIAL_CHARS
+
+
+class _Item(NamedTuple):
+    session_id: int
+    text: str
+    diagnosis: int
+    trivial: bool
+
+
+def _item(session_id: int, data: Dict[str, Any]) -> _Item:
+    return _Item(session_id, _text(data), diagnosis_key(data), _trivial(data))
+
+
+class Match(NamedTuple):
+    session_id: int
+    score: float
+    reply: str
+    reusable: bool  # можно отдать без модели
+
+
+# Сколько строк матрицы обрабатывается за раз при пересчёте норм и записи файла
+SIM_CHUNK = 4096
+
+
+class _View(NamedTuple):
+    # согласованный снимок индекса: поиск читает его без блокировки, изменения
+    # публикуют новый снимок, а в общих буферах пишут только за его границей n
+    n: int
+    base: np.ndarray       # строки из файла индекса, отображённые в память только на чтение
+    tail: np.ndarray       # строки после файла, в памяти: tail[:n - len(base)]
+    ids: np.ndarray
+    norms: np.ndarray
+    diagnoses: np.ndarray
+    trivial: np.ndarray
+    idf: np.ndarray
+
+
+class _Saved(NamedTuple):
+    rows: np.ndarray
+    ids: np.ndarray
+    df: np.ndarray
+    diagnoses: np.ndarray
+    trivial: np.ndarray
+    synced_id: int
+
+
+def _grow(array: np.ndarray, size: int, fill: Any = 0) -> np.ndarray:
+    out = np.full((size, *array.shape[1:]), fill, array.dtype)
+    out[:len(array)] = array
+    return out
+
+
+class SimilarIndex:
+    """
+    Индекс сохранённых сессий для поиска похожих анкет. Вектор сессии — TF-IDF по
+    хэшированным символьным n-граммам; строки хранятся «сырыми» (tf), а idf и нормы
+    пересчитываются (кусками, не блокируя поиск), когда сессий становится на 5%
+    больше, — поиск остаётся умножением матрицы на вектор.
+    Строит индекс из базы и пишет его на диск один процесс — тот, что взял
+    блокировку `path`.lock; остальные (шарды бота, веб) ждут его файл и отображают
+    матрицу в память только на чтение, так что она лежит в памяти один раз на
+    машину. Сверх файла каждый процесс держит в памяти только хвост: свои новые
+    сессии и чужие, подтянутые из базы раз в SIM_SYNC_INTERVAL. Когда владелец
+    переписывает файл, хвост переезжает в него.
+    Для каждой сессии хранится ключ диагноза и признак «анкета была простой»: готовый
+    ответ отдаётся, только если простыми были обе анкеты.
+    """
+
+    def __init__(self, path: str = SIM_INDEX_PATH, dim: int = SIM_DIM) -> None:
+        self.path = path
+        self.rows_path = f"{path}.rows.npy"
+        self.dim = dim
+        self.ready = False
+        empty = np.zeros((0, dim), np.float32)
+        self._tail = np.zeros((1024, dim), np.float32)
+        self._ids = np.zeros(1024, np.int64)
+        self._norms = np.zeros(1024, np.float32)
+        self._diagnoses = np.full(1024, UNKNOWN_DIAGNOSIS, np.int64)
+        self._trivial = np.zeros(1024, np.bool_)
+        self._df = np.zeros(dim, np.float64)
+        self._view = _View(0, empty, self._tail, self._ids, self._norms, self._diagnoses, self._trivial,
+                           np.ones(dim, np.float32))
+        self._idf_n = 0
+        self._last_id = 0
+        # до какого id индекс сверен с базой; сохранённое здесь же после него — в _local
+        self._synced_id = 0
+        self._local: Set[int] = set()
+        self._saved_n = 0
+        self._file_mtime = 0.0
+        self._owner_file = None
+        self._pending: List[_Item] = []
+        # все изменения идут по одному; поиск этот замок не берёт
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._listening = False
+        self.lookups = 0
+        self.drafts = 0
+        self.reused = 0
+
+    @property
+    def _n(self) -> int:
+        return self._view.n
+
+    def _chunks(self, view: _View) -> Iterator[np.ndarray]:
+        for start in range(0, len(view.base), SIM_CHUNK):
+            yield view.base[start:start + SIM_CHUNK]
+        tail = view.tail[:view.n - len(view.base)]
+        for start in range(0, len(tail), SIM_CHUNK):
+            yield tail[start:start + SIM_CHUNK]
+
+    def _refresh_idf(self) -> None:
+        # под self._lock; поиск тем временем идёт по старому снимку
+        view = self._view
+        n = view.n
+        idf = (np.log((n + 1) / (self._df + 1)) + 1).astype(np.float32)
+        weights = idf * idf
+        norms = np.zeros(len(self._ids), np.float32)
+        pos = 0
+        for chunk in self._chunks(view):
+            norms[pos:pos + len(chunk)] = np.sqrt(np.einsum("ij,ij,j->i", chunk, chunk, weights))
+            pos += len(chunk)
+        self._norms = norms
+        self._idf_n = n
+        self._view = view._replace(norms=norms, idf=idf)
+
+    def _add(self, items: List[_Item]) -> None:
+        if not items:
+            return
+        vectors = np.stack([vectorize(item.text, self.dim) for item in items])
+        ids = np.array([item.session_id for item in items], np.int64)
+        with self._lock:
+            view = self._view
+            start, end = view.n, view.n + len(ids)
+            if end > len(self._ids):
+                size = max(end, len(self._ids) * 3 // 2)
+                self._ids = _grow(self._ids, size)
+                self._norms = _grow(self._norms, size)
+                self._diagnoses = _grow(self._diagnoses, size, UNKNOWN_DIAGNOSIS)
+                self._trivial = _grow(self._trivial, size)
+            base = len(view.base)
+            if end - base > len(self._tail):
+                self._tail = _grow(self._tail, max(end - base, len(self._tail) * 3 // 2))
+            self._tail[start - base:end - base] = vectors
+            self._ids[start:end] = ids
+            self._diagnoses[start:end] = [item.diagnosis for item in items]
+            self._trivial[start:end] = [item.trivial for item in items]
+            self._norms[start:end] = np.sqrt((vectors * vectors) @ (view.idf * view.idf))
+            self._df += (vectors > 0).sum(axis=0)
+            self._last_id = max(self._last_id, int(ids.max()))
+            self._view = _View(end, view.base, self._tail, self._ids, self._norms, self._diagnoses,
+                               self._trivial, view.idf)
+            if end >= self._idf_n * 1.05:
+                self._refresh_idf()
+
+    def _search(self, vec: np.ndarray, diagnosis: int, k: int = 3) -> List[Tuple[int, float, bool]]:
+        if diagnosis == UNKNOWN_DIAGNOSIS:
+            return []
+        view = self._view
+        n = view.n
+        if n == 0:
+            return []
+        query = vec * view.idf
+        qnorm = float(np.linalg.norm(query))
+        if qnorm == 0:
+            return []
+        weights = query * view.idf
+        dots = np.concatenate([view.base @ weights, view.tail[:n - len(view.base)] @ weights])
+        scores = dots / (view.norms[:n] * qnorm + 1e-9)
+        scores[view.diagnoses[:n] != diagnosis] = -1.0
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(view.ids[i]), float(scores[i]), bool(view.trivial[i])) for i in top]
+
+    def _read_file(self) -> Optional[_Saved]:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with np.load(self.path) as saved:
+                ids, df = saved["ids"], saved["df"]
+                diagnoses, trivial = saved["diagnoses"], saved["trivial"]
+                synced_id = int(saved["synced_id"])
+            if len(ids):
+                rows = np.load(self.rows_path, mmap_mode="r")
+            else:
+                rows = np.zeros((0, self.dim), np.float32)
+        except (OSError, KeyError, ValueError):
+            return None  # нет файла или он старого формата
+        # строки пишутся раньше метаданных: файл строк может оказаться длиннее
+        # (его начало — те же строки), а короче — только если его уже переписали снова
+        if rows.ndim != 2 or rows.shape[1] != self.dim or len(rows) < len(ids):
+            return None
+        self._file_mtime = mtime
+        return _Saved(rows[:len(ids)], ids, df, diagnoses, trivial, synced_id)
+
+    def _map(self, saved: _Saved) -> None:
+        # под self._lock: строки файла — в основу, из хвоста остаётся то, чего в файле нет
+        view = self._view
+        base = len(view.base)
+        tail_ids = view.ids[base:view.n]
+        keep = ~np.isin(tail_ids, saved.ids)
+        kept = view.tail[:view.n - base][keep]
+        n = len(saved.ids) + len(kept)
+        size = max(1024, n + 1024)
+        self._ids = _grow(np.concatenate([saved.ids, tail_ids[keep]]).astype(np.int64), size)
+        self._diagnoses = _grow(np.concatenate([saved.diagnoses, view.diagnoses[base:view.n][keep]])
+                                .astype(np.int64), size, UNKNOWN_DIAGNOSIS)
+        self._trivial = _grow(np.concatenate([saved.trivial, view.trivial[base:view.n][keep]])
+                              .astype(np.bool_), size)
+        self._norms = np.zeros(size, np.float32)
+        self._tail = _grow(np.ascontiguousarray(kept, np.float32), max(1024, len(kept) * 3 // 2))
+        self._df = saved.df.astype(np.float64) + (kept > 0).sum(axis=0)
+        self._last_id = int(self._ids[:n].max()) if n else 0
+        self._view = _View(n, saved.rows, self._tail, self._ids, self._norms, self._diagnoses,
+                           self._trivial, view.idf)
+        self._refresh_idf()
+        self._saved_n = len(saved.ids)
+
+    def _load(self, only_changed: bool = False) -> Optional[_Saved]:
+        if only_changed:
+            try:
+                if os.stat(self.path).st_mtime_ns == self._file_mtime:
+                    return None
+            except OSError:
+                return None
+        with self._lock:
+            saved = self._read_file()
+            if saved is not None:
+                self._map(saved)
+            return saved
+
+    def _save(self) -> None:
+        with self._lock:
+            view = self._view
+            synced_id = self._synced_id
+            tmp_rows = f"{self.rows_path}.{os.getpid()}.tmp"
+            out = np.lib.format.open_memmap(tmp_rows, mode="w+", dtype=np.float32, shape=(view.n, self.dim))
+            pos = 0
+            for chunk in self._chunks(view):
+                out[pos:pos + len(chunk)] = chunk
+                pos += len(chunk)
+            out.flush()
+            del out
+            os.replace(tmp_rows, self.rows_path)
+            tmp = f"{self.path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp, ids=view.ids[:view.n], df=self._df, diagnoses=view.diagnoses[:view.n],
+                     trivial=view.trivial[:view.n], synced_id=np.int64(synced_id))
+            os.replace(tmp, self.path)
+            # свой хвост — тоже в только что записанный файл
+            saved = self._read_file()
+            if saved is not None:
+                self._map(saved)
+
+    def _acquire_owner(self) -> bool:
+        if self.owner:
+            return True
+        f = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._owner_file = f
+        return True
+
+    def _release_owner(self) -> None:
+        f, self._owner_file = self._owner_file, None
+        if f is not None:
+            f.close()
+
+    @property
+    def owner(self) -> bool:
+        return fcntl is None or self._owner_file is not None
+
+    async def _pull(self) -> None:
+        while True:
+            batch = await get_sessions_after(self._synced_id, SIM_BUILD_BATCH)
+            if not batch:
+                return
+            # сверка с _local — без await между ней и сдвигом _synced_id, см. _on_saved
+            self._synced_id = batch[-1][0]
+            items = [_item(row[0], dict(zip(SESSION_FIELDS, row[1:]))) for row in batch
+                     if row[0] not in self._local]
+            self._local = {i for i in self._local if i > self._synced_id}
+            await asyncio.to_thread(self._add, items)
+
+    async def _adopt(self, only_changed: bool = False) -> bool:
+        # файл владельца становится основой индекса; _synced_id и _local меняются
+        # только здесь, в event loop, как и в _pull и _on_saved
+        saved = await asyncio.to_thread(self._load, only_changed)
+        if saved is None:
+            return False
+        # всё, что владелец сверил с базой, в файле есть; его сессии сверх этого — тоже
+        self._synced_id = max(self._synced_id, saved.synced_id)
+        self._local.update(int(i) for i in saved.ids[saved.ids > self._synced_id])
+        self._local = {i for i in self._local if i > self._synced_id}
+        return True
+
+    async def _build(self) -> None:
+        # из базы индекс строит только владелец; остальные ждут его файл
+        while True:
+            if await asyncio.to_thread(self._acquire_owner):
+                await self._adopt()
+                break
+            if await self._adopt():
+                break
+            await asyncio.sleep(SIM_SYNC_INTERVAL)
+        await self._pull()
+        # сохранённое, пока шла сборка, могло не попасть в последнюю пачку
+        pending, self._pending = self._pending, []
+        pending = [item for item in pending if item.session_id > self._synced_id]
+        self._local.update(item.session_id for item in pending)
+        self.ready = True
+        await asyncio.to_thread(self._add, pending)
+        # файл пишется и для пустой базы: без него остальные процессы не начнут
+        if self.owner and (self._n != self._saved_n or not self._file_mtime):
+            await asyncio.to_thread(self._save)
+        logger.info("Similar-session index ready: %d sessions", self._n)
+
+    async def _sync_loop(self) -> None:
+        saved_at = time.monotonic()
+        while True:
+            await asyncio.sleep(SIM_SYNC_INTERVAL)
+            try:
+                # владелец завершился — его место занимает следующий процесс
+                if not self.owner and await asyncio.to_thread(self._acquire_owner):
+                    logger.info("Similar-session index: this process now writes %s", self.path)
+                if not self.owner:
+                    await self._adopt(only_changed=True)
+                await self._pull()
+                if self.owner and self._n != self._saved_n and time.monotonic() - saved_at >= SIM_SAVE_INTERVAL:
+                    await asyncio.to_thread(self._save)
+                    saved_at = time.monotonic()
+            except Exception:
+                logger.exception("Similar-session index sync failed")
+
+    async def _run_build(self) -> None:
+        try:
+            await self._build()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Similar-session index build failed")
+            return
+        await self._sync_loop()
+
+    async def start(self) -> None:
+        if self._task is None:
+            if not self._listening:
+                add_save_listener(self._on_saved)
+                self._listening = True
+            self._task = asyncio.create_task(self._run_build())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        if self.ready and self.owner and self._n != self._saved_n:
+            await asyncio.to_thread(self._save)
+        self._release_owner()
+
+    async def _on_saved(self, session_id: int, data: dict) -> None:
+        if not self.ready:
+            if self._task is not None and not self._task.done():
+                self._pending.append(_item(session_id, data))
+            return
+        if session_id <= self._synced_id:
+            return  # уже пришла (или придёт) из базы через _pull
+        self._local.add(session_id)
+        await asyncio.to_thread(self._add, [_item(session_id, data)])
+
+    async def lookup(self, data: Dict[str, Any]) -> Optional[Match]:
+        if not self.ready:
+            return None
+        self.lookups += 1
+        candidates = await asyncio.to_thread(self._search, vectorize(_text(data), self.dim), diagnosis_key(data))
+        for session_id, score, source_trivial in candidates:
+            if score < SIM_DRAFT_THRESHOLD:
+                break
+            # сессия могла уехать в архив — тогда берём следующую по близости
+            reply = await get_session_reply(session_id)
+            if reply:
+                reusable = score >= SIM_REUSE_THRESHOLD and source_trivial and _trivial(data)
+                if reusable:
+                    self.reused += 1
+                else:
+                    self.drafts += 1
+                return Match(session_id, score, reply, reusable)
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "sessions": self._n,
+            "lookups": self.lookups,
+            "drafts": self.drafts,
+            "reused": self.reused,
+        }
+
+
+similar_index = SimilarIndex()
@@ -0,0 +1,55 @@
+from typing import Optional, Tuple
+
+FOLLOWUP_SEPARATOR = "\n---\n"
+
+
+def split_answer_and_followup(text: str) -> Tuple[str, Optional[str]]:
+    if FOLLOWUP_SEPARATOR in text:
+        a, b = text.split(FOLLOWUP_SEPARATOR, 1)
+        return a.strip(), (b.strip() or None)
+    lines = text.strip().splitlines()
+    for i in range(len(lines) - 1, -1, -1):
+        low = lines[i].lower()
+        if low.startswith("вопрос:") or low.startswith("уточняющий вопрос:"):
+            main = "\n".join(lines[:i]).strip()
+            q = lines[i].split(":", 1)[1].strip() if ":" in lines[i] else lines[i].strip()
+            return main, (q or None)
+    return text.strip(), None
+
+
+class FollowupSplitter:
+    """
+    Принимает дельты стрима и возвращает ту часть ответа, которую уже можно показать.
+    Хвост, похожий на начало разделителя «---», придерживается, а всё после разделителя
+    (уточняющий вопрос) не показывается вовсе — его отдаёт finish().
+    """
+
+    def __init__(self) -> None:
+        self.text = ""
+        self._shown = 0
+        self._cut: Optional[int] = None
+
+    def feed(self, delta: str) -> str:
+        self.text += delta
+        if self._cut is not None:
+            return ""
+
+        idx = self.text.find(FOLLOWUP_SEPARATOR, max(0, self._shown - len(FOLLOWUP_SEPARATOR)))
+        if idx != -1:
+            self._cut = idx
+            safe = idx
+        else:
+            safe = len(self.text)
+            for k in range(len(FOLLOWUP_SEPARATOR) - 1, 0, -1):
+                if self.text.endswith(FOLLOWUP_SEPARATOR[:k]):
+                    safe -= k
+                    break
+
+        if safe <= self._shown:
+            return ""
+        out = self.text[self._shown:safe]
+        self._shown = safe
+        return out
+
+    def finish(self) -> Tuple[str, Optional[str]]:
+        return split_answer_and_followup(self.text)
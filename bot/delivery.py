@@ -0,0 +1,116 @@
+import asyncio
+import os
+import re
+import time
+from typing import List, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+from aiogram.utils.text_decorations import html_decoration
+
+# Telegram режет сообщения длиннее 4096 символов (считает в UTF-16), оставляем запас под эмодзи
+TG_MESSAGE_LIMIT = int(os.getenv("TG_MESSAGE_LIMIT", "4000"))
+# Чаще раза в секунду редактировать одно сообщение Telegram не даёт
+TG_EDIT_INTERVAL = float(os.getenv("TG_EDIT_INTERVAL", "1.5"))
+
+# Начало раздела ответа: «1) Карта возможных причин», «0) Дополнения к разбору» ...
+_SECTION_START = re.compile(r"\n(?=[ \t]*\d{1,2}\)\s)")
+
+
+def _cut_position(text: str, limit: int) -> int:
+    window = text[:limit + 1]
+    min_chunk = limit // 4
+
+    sections = [m.start() for m in _SECTION_START.finditer(window)]
+    if sections and sections[-1] >= min_chunk:
+        return sections[-1]
+    for sep in ("\n\n", "\n", " "):
+        pos = window.rfind(sep)
+        if pos >= min_chunk:
+            return pos
+    return limit
+
+
+def split_message(text: str, limit: int = TG_MESSAGE_LIMIT) -> List[str]:
+    chunks = []
+    rest = text.strip()
+    while len(rest) > limit:
+        cut = _cut_position(rest, limit)
+        chunks.append(rest[:cut].rstrip())
+        rest = rest[cut:].lstrip()
+    if rest:
+        chunks.append(rest)
+    return chunks
+
+
+class StreamingReply:
+    """
+    Ответ, который показывается по мере генерации: плейсхолдер редактируется на месте
+    не чаще TG_EDIT_INTERVAL, а при переполнении текст переезжает в следующее сообщение,
+    разрезанный по границе раздела. Текст экранируется под ParseMode.HTML бота.
+    """
+
+    def __init__(self, message: Message, placeholder: str,
+                 interval: float = TG_EDIT_INTERVAL, limit: int = TG_MESSAGE_LIMIT) -> None:
+        self._message = message
+        self._placeholder = placeholder
+        self._interval = interval
+        self._limit = limit
+        self._text = ""
+        self._sent: List[Message] = []
+        self._shown: List[str] = []
+        self._next_edit = 0.0
+
+    async def start(self) -> None:
+        msg = await self._message.answer(self._placeholder)
+        self._sent.append(msg)
+        self._shown.append(self._placeholder)
+
+    async def status(self, text: str) -> None:
+        # пока текста ещё нет, в плейсхолдере можно показать статус, например место в очереди
+        if not self._text and time.monotonic() >= self._next_edit:
+            if await self._show(0, text, final=False):
+                self._next_edit = time.monotonic() + self._interval
+
+    async def push(self, delta: str) -> None:
+        if not delta:
+            return
+        self._text += delta
+        if time.monotonic() >= self._next_edit:
+            await self._flush(final=False)
+
+    async def finish(self, text: Optional[str] = None) -> None:
+        if text is not None:
+            self._text = text
+        await self._flush(final=True)
+
+    async def _flush(self, final: bool) -> None:
+        chunks = split_message(self._text, self._limit) or ["—"]
+        for i, chunk in enumerate(chunks):
+            if i < len(self._shown) and self._shown[i] == chunk:
+                continue
+            if not await self._show(i, chunk, final):
+                return
+        self._next_edit = time.monotonic() + self._interval
+
+    async def _show(self, i: int, chunk: str, final: bool) -> bool:
+        while True:
+            try:
+                if i < len(self._sent):
+                    await self._sent[i].edit_text(html_decoration.quote(chunk))
+                    self._shown[i] = chunk
+                else:
+                    self._sent.append(await self._message.answer(html_decoration.quote(chunk)))
+                    self._shown.append(chunk)
+                return True
+            except TelegramRetryAfter as e:
+                if not final:
+                    # промежуточные правки не обязательны — просто подождём со следующей
+                    self._next_edit = time.monotonic() + e.retry_after
+                    return False
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    self._shown[i] = chunk
+                    return True
+                raise
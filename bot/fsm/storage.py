@@ -0,0 +1,405 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+FSM_DB = os.getenv("FSM_DB", "fsm.db")
+# Как часто накопленные изменения уходят в базу, секунды
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "5000"))
+# Через сколько секунд запись в кэше сверяется с базой: её мог изменить другой процесс
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "1"))
+# Контекст, который не менялся столько секунд, считается брошенным; 0 — не удалять
+FSM_IDLE_TIMEOUT = float(os.getenv("FSM_IDLE_TIMEOUT", str(24 * 3600)))
+FSM_REAP_INTERVAL = float(os.getenv("FSM_REAP_INTERVAL", "600"))
+# Строковые поля длиннее порога (в байтах UTF-8) хранятся отдельными файлами
+FSM_BLOB_DIR = os.getenv("FSM_BLOB_DIR", "fsm_blobs")
+FSM_BLOB_THRESHOLD = int(os.getenv("FSM_BLOB_THRESHOLD", "2048"))
+
+logger = logging.getLogger(__name__)
+
+ExpireCallback = Callable[[StorageKey, Optional[str], Dict[str, Any]], Awaitable[Any]]
+
+
+class _Entry:
+    __slots__ = ("state", "data", "version", "checked")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], version: Optional[float]) -> None:
+        self.state = state
+        self.data = data
+        self.version = version  # updated_at строки в базе; None — строки нет
+        self.checked = time.monotonic()
+
+
+class _BlobStore:
+    """
+    Файлы с крупными значениями полей; имя файла — sha256 содержимого, так что
+    одинаковый текст у разных пользователей хранится один раз. Файлы общие для всех
+    процессов, поэтому put() и удаление вызываются только под блокировкой записи
+    базы (BEGIN IMMEDIATE), см. SqliteStorage._write и _collect.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
+    def put(self, value: str) -> str:
+        body = value.encode("utf-8")
+        key = hashlib.sha256(body).hexdigest()
+        path = self._file(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(body)
+            os.replace(tmp, path)
+        return key
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            with open(self._file(key), "rb") as f:
+                return f.read().decode("utf-8")
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+
+class SqliteStorage(BaseStorage):
+    """
+    FSM-хранилище aiogram в SQLite. Чтение идёт через кэш в памяти, а записи только
+    помечают ключ грязным: фоновая задача раз в FSM_FLUSH_INTERVAL пишет последнее
+    значение каждого ключа одной транзакцией, так что серия update_data за один шаг
+    стоит одну запись. При закрытии всё несохранённое сбрасывается на диск.
+
+    Запись в кэше, к которой обращаются позже чем через FSM_CACHE_TTL после
+    последней сверки, сверяется с updated_at в базе и перечитывается, если строку
+    изменил или удалил другой процесс. Так пользователь может перейти к другому
+    процессу (шард перезапустили, сообщение пришло на другой инстанс), если тот
+    успел сбросить изменения. Одновременную обработку одного пользователя в двух
+    процессах это не покрывает: записи не блокируются и побеждает последняя,
+    поэтому апдейты пользователя должны идти через один процесс (bot/shard.py),
+    а вебхук не запускается в нескольких воркерах uvicorn.
+
+    Поля длиннее FSM_BLOB_THRESHOLD (текст анализов, ответы GPT) пишутся в файлы,
+    а в записи остаётся ссылка {"__blob__": ключ}. Контексты, простоявшие без
+    изменений дольше FSM_IDLE_TIMEOUT, удаляет фоновая задача start_reaper().
+    """
+
+    def __init__(self, path: str = FSM_DB, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 cache_size: int = FSM_CACHE_SIZE, blob_dir: str = FSM_BLOB_DIR,
+                 blob_threshold: int = FSM_BLOB_THRESHOLD, cache_ttl: float = FSM_CACHE_TTL) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.reloads = 0
+        self.blob_threshold = blob_threshold
+        self.reaped = 0
+        self._blobs = _BlobStore(blob_dir)
+        self._cache: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._dirty: Set[str] = set()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._reaper: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny,
+        ))
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS fsm (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL
+                )
+            """)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(fsm)")}
+            if "updated_at" not in columns:
+                conn.execute("ALTER TABLE fsm ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS fsm_updated_at ON fsm (updated_at)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_blob_refs (
+                    key TEXT NOT NULL,
+                    blob TEXT NOT NULL,
+                    PRIMARY KEY (key, blob)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS fsm_blob_refs_blob ON fsm_blob_refs (blob)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def migrate(self) -> None:
+        # схема создаётся при первом обращении; несколько процессов готовят её заранее, в одном
+        with self._lock:
+            self._db()
+
+    def _pack(self, data: Dict[str, Any]) -> Tuple[str, Set[str]]:
+        packed, refs = {}, set()
+        for name, value in data.items():
+            if isinstance(value, str) and len(value.encode("utf-8")) > self.blob_threshold:
+                ref = self._blobs.put(value)
+                refs.add(ref)
+                value = {"__blob__": ref}
+            packed[name] = value
+        return json.dumps(packed, ensure_ascii=False), refs
+
+    def _unpack(self, raw: str) -> Dict[str, Any]:
+        data = json.loads(raw)
+        for name, value in data.items():
+            if isinstance(value, dict) and set(value) == {"__blob__"}:
+                data[name] = self._blobs.get(value["__blob__"])
+        return data
+
+    def _load(self, key: str) -> _Entry:
+        with self._lock:
+            row = self._db().execute("SELECT state, data, updated_at FROM fsm WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return _Entry(None, {}, None)
+        return _Entry(row[0], self._unpack(row[1]), row[2])
+
+    def _version(self, key: str) -> Optional[float]:
+        with self._lock:
+            row = self._db().execute("SELECT updated_at FROM fsm WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _release(self, conn: sqlite3.Connection, keys: Iterable[str]) -> Set[str]:
+        # снимает ссылки ключей на файлы; возвращает файлы, которые после этого могли осиротеть
+        old: Set[str] = set()
+        for key in keys:
+            old.update(r[0] for r in conn.execute("SELECT blob FROM fsm_blob_refs WHERE key = ?", (key,)))
+            conn.execute("DELETE FROM fsm_blob_refs WHERE key = ?", (key,))
+        return old
+
+    def _collect(self, conn: sqlite3.Connection, candidates: Iterable[str]) -> None:
+        # проверка ссылок и удаление — под блокировкой записи базы: другой процесс,
+        # чей put() увидел файл на диске и не стал его писать, держит ту же блокировку,
+        # пока не закоммитит ссылку, так что файл не удалится у него из-под ног
+        candidates = list(candidates)
+        if not candidates:
+            return
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for blob in candidates:
+                if conn.execute("SELECT 1 FROM fsm_blob_refs WHERE blob = ? LIMIT 1", (blob,)).fetchone() is None:
+                    self._blobs.delete(blob)
+
+    def _write(self, rows: List[Tuple[str, Optional[str], Optional[Dict[str, Any]]]]) -> float:
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            with conn:
+                # файлы пишутся внутри транзакции, а удаляются после коммита: ссылка в базе
+                # не может остаться без файла
+                conn.execute("BEGIN IMMEDIATE")
+                packed = [(key, state) + (self._pack(data) if data is not None else (None, set()))
+                          for key, state, data in rows]
+                orphans = self._release(conn, [key for key, *_ in packed])
+                for key, state, raw, refs in packed:
+                    if raw is None:
+                        # пустой контекст (нет ни состояния, ни данных) просто удаляется
+                        conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+                        continue
+                    conn.execute(
+                        "INSERT OR REPLACE INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                        (key, state, raw, now),
+                    )
+                    conn.executemany("INSERT OR IGNORE INTO fsm_blob_refs (key, blob) VALUES (?, ?)",
+                                     [(key, ref) for ref in refs])
+            self._collect(conn, orphans)
+        return now
+
+    def _expired(self, cutoff: float) -> List[Tuple[str, Optional[str], str]]:
+        with self._lock:
+            return self._db().execute(
+                "SELECT key, state, data FROM fsm WHERE updated_at < ?", (cutoff,)
+            ).fetchall()
+
+    def _drop(self, keys: List[str], cutoff: float) -> int:
+        with self._lock:
+            conn = self._db()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                # контекст могли обновить, пока шло автосохранение — такие не трогаем
+                stale = [r[0] for r in conn.execute(
+                    f"SELECT key FROM fsm WHERE key IN ({','.join('?' * len(keys))}) AND updated_at < ?",
+                    (*keys, cutoff),
+                )]
+                orphans = self._release(conn, stale)
+                conn.executemany("DELETE FROM fsm WHERE key = ?", [(key,) for key in stale])
+            self._collect(conn, orphans)
+        return len(stale)
+
+    async def _entry(self, key: StorageKey) -> Tuple[str, _Entry]:
+        k = self._key(key)
+        entry = self._cache.get(k)
+        if entry is not None and k not in self._dirty and time.monotonic() - entry.checked > self.cache_ttl:
+            version = await asyncio.to_thread(self._version, k)
+            entry.checked = time.monotonic()
+            # свои несохранённые изменения важнее: их в базе ещё нет
+            if version != entry.version and k not in self._dirty:
+                self.reloads += 1
+                if self._cache.get(k) is entry:
+                    del self._cache[k]
+                entry = None
+        if entry is None:
+            loaded = await asyncio.to_thread(self._load, k)
+            # пока читали, ключ могли записать — тогда кэш уже свежее базы
+            entry = self._cache.get(k) or loaded
+            self._cache[k] = entry
+        self._cache.move_to_end(k)
+        self._trim()
+        return k, entry
+
+    def _trim(self) -> None:
+        # вытесняем только чистые записи: грязные сначала должны попасть в базу.
+        # Последняя — та, с которой сейчас работают, её не трогаем.
+        if len(self._cache) <= self.cache_size:
+            return
+        for k in list(self._cache)[:-1]:
+            if len(self._cache) <= self.cache_size:
+                break
+            if k not in self._dirty:
+                del self._cache[k]
+
+    def _mark_dirty(self, k: str, entry: _Entry) -> None:
+        # запись могли вытеснить, пока другой обработчик ждал чтения из базы
+        self._cache[k] = entry
+        self._dirty.add(k)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        rows = []
+        for k in keys:
+            entry = self._cache[k]
+            empty = entry.state is None and not entry.data
+            rows.append((k, entry.state, None if empty else entry.data))
+        try:
+            written_at = await asyncio.to_thread(self._write, rows)
+        except Exception:
+            self._dirty |= keys
+            raise
+        for k, _, data in rows:
+            entry = self._cache.get(k)
+            if entry is not None:
+                # своя запись — не повод перечитывать
+                entry.version = written_at if data is not None else None
+                entry.checked = time.monotonic()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, entry = await self._entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(k, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, entry = await self._entry(key)
+        return entry.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k, entry = await self._entry(key)
+        entry.data = data.copy()
+        self._mark_dirty(k, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, entry = await self._entry(key)
+        return entry.data.copy()
+
+    @staticmethod
+    def _storage_key(k: str) -> StorageKey:
+        bot_id, chat_id, user_id, thread_id, business_connection_id, destiny = k.split(":", 5)
+        return StorageKey(
+            bot_id=int(bot_id), chat_id=int(chat_id), user_id=int(user_id),
+            thread_id=int(thread_id) if thread_id else None,
+            business_connection_id=business_connection_id or None, destiny=destiny,
+        )
+
+    async def reap(self, idle_timeout: float = FSM_IDLE_TIMEOUT,
+                   on_expire: Optional[ExpireCallback] = None) -> int:
+        cutoff = time.time() - idle_timeout
+        expired = [row for row in await asyncio.to_thread(self._expired, cutoff) if row[0] not in self._dirty]
+        if not expired:
+            return 0
+        if on_expire is not None:
+            for k, state, raw in expired:
+                try:
+                    data = await asyncio.to_thread(self._unpack, raw)
+                    await on_expire(self._storage_key(k), state, data)
+                except Exception:
+                    logger.exception("FSM expire callback failed for %s", k)
+        keys = [k for k, _, _ in expired if k not in self._dirty]
+        if not keys:
+            return 0
+        dropped = await asyncio.to_thread(self._drop, keys, cutoff)
+        for k in keys:
+            if k not in self._dirty:
+                self._cache.pop(k, None)
+        self.reaped += dropped
+        return dropped
+
+    async def _reap_loop(self, idle_timeout: float, interval: float,
+                         on_expire: Optional[ExpireCallback]) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reap(idle_timeout, on_expire)
+            except Exception:
+                logger.exception("FSM reaper failed")
+
+    def start_reaper(self, on_expire: Optional[ExpireCallback] = None,
+                     idle_timeout: float = FSM_IDLE_TIMEOUT, interval: float = FSM_REAP_INTERVAL) -> None:
+        if idle_timeout > 0 and (self._reaper is None or self._reaper.done()):
+            self._reaper = asyncio.create_task(self._reap_loop(idle_timeout, interval, on_expire))
+
+    async def close(self) -> None:
+        reaper, self._reaper = self._reaper, None
+        if reaper is not None:
+            reaper.cancel()
+            try:
+                await reaper
+            except asyncio.CancelledError:
+                pass
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,246 @@
+import asyncio
+import logging
+import multiprocessing as mp
+import os
+import queue as queue_lib
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Число процессов-обработчиков; 1 — всё в одном процессе, как раньше
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+BOT_SHARD_QUEUE_SIZE = int(os.getenv("BOT_SHARD_QUEUE_SIZE", "200"))
+# Сколько апдейтов разных пользователей один процесс обрабатывает одновременно
+BOT_SHARD_CONCURRENCY = int(os.getenv("BOT_SHARD_CONCURRENCY", "32"))
+BOT_SHARD_STOP_TIMEOUT = float(os.getenv("BOT_SHARD_STOP_TIMEOUT", "15"))
+
+# Номер шарда в процессе-воркере; None — во входном процессе и без шардирования
+_shard_index: Optional[int] = None
+
+
+def runs_background_jobs() -> bool:
+    # архиватор сессий и уборщик FSM работают с общими файлами и нужны в одном
+    # экземпляре: без шардирования — в единственном процессе, иначе — в шарде 0
+    return _shard_index is None or _shard_index == 0
+
+
+def update_user_id(raw: Dict[str, Any]) -> Optional[int]:
+    # в апдейте ровно одно поле с событием, кроме update_id
+    for key, event in raw.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        sender = event.get("from") or event.get("user") or (event.get("message") or {}).get("from")
+        if sender and "id" in sender:
+            return sender["id"]
+        chat = event.get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+    return None
+
+
+def shard_of(raw: Dict[str, Any], shards: int) -> int:
+    user_id = update_user_id(raw)
+    key = user_id if user_id is not None else raw.get("update_id", 0)
+    return zlib.crc32(str(key).encode()) % shards
+
+
+def preempt(raw: Dict[str, Any]) -> int:
+    # «Начать заново» отменяет запрос к модели ещё на входе: в очереди пользователя
+    # этот апдейт ждал бы, пока модель не допишет ответ, который уже не нужен
+    from app.services.llm_scheduler import llm_scheduler
+    from bot.start import RESTART_BUTTON
+
+    text = (raw.get("message") or {}).get("text")
+    if text != RESTART_BUTTON:
+        return 0
+    return llm_scheduler.cancel(f"tg:{update_user_id(raw)}")
+
+
+async def _serve(index: int, workers: int, llm_processes: int, updates: "mp.Queue") -> None:
+    from aiogram.types import Update
+    from app.services.llm_scheduler import share_llm_slots
+    from app.services.ocr import share_ocr_pool
+    from bot.start import bot, dp
+
+    share_ocr_pool(workers)
+    share_llm_slots(llm_processes)
+
+    workflow_data = {"dispatcher": dp, "bots": [bot], **dp.workflow_data}
+    await dp.emit_startup(bot=bot, **workflow_data)
+
+    # апдейты одного пользователя идут строго по очереди, разных — параллельно;
+    # замок пользователя удаляется, когда его никто не держит и не ждёт
+    locks: Dict[Any, List[Any]] = {}
+    slots = asyncio.Semaphore(BOT_SHARD_CONCURRENCY)
+    tasks = set()
+
+    async def handle(raw: Dict[str, Any]) -> None:
+        key = update_user_id(raw)
+        entry = locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                update = Update.model_validate(raw, context={"bot": bot})
+                await dp.feed_update(bot, update)
+        except Exception:
+            logger.exception("Shard %d: update %s failed", index, raw.get("update_id"))
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del locks[key]
+            slots.release()
+
+    try:
+        while True:
+            raw = await asyncio.to_thread(updates.get)
+            if raw is None:
+                break
+            preempt(raw)
+            await slots.acquire()
+            task = asyncio.create_task(handle(raw))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks, timeout=BOT_SHARD_STOP_TIMEOUT)
+    finally:
+        await dp.emit_shutdown(bot=bot, **workflow_data)
+        await bot.session.close()
+
+
+def _worker_main(index: int, workers: int, llm_processes: int, updates: "mp.Queue") -> None:
+    global _shard_index
+    _shard_index = index
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve(index, workers, llm_processes, updates))
+
+
+async def prepare_shared_files() -> None:
+    # схемы общих баз — один раз во входном процессе, до запуска воркеров
+    from app.db.database import migrate_db
+    from bot.start import storage
+
+    await migrate_db()
+    await asyncio.to_thread(storage.migrate)
+
+
+class ShardPool:
+    """
+    Апдейты раскладываются по `workers` процессам по хэшу id пользователя, так что
+    один пользователь всегда попадает в один процесс (и в его кэш FSM), а его
+    апдейты обрабатываются по порядку. Упавший процесс перезапускается с той же
+    очередью; при частых падениях пауза перед перезапуском растёт до 30 секунд.
+    `llm_processes` — сколько всего процессов делят LLM_MAX_CONCURRENCY: сами
+    воркеры и, если он тоже ходит к модели, входной процесс.
+    """
+
+    def __init__(self, workers: int = BOT_WORKERS, queue_size: int = BOT_SHARD_QUEUE_SIZE,
+                 llm_processes: Optional[int] = None) -> None:
+        self._ctx = mp.get_context("spawn")
+        self._llm_processes = llm_processes or workers
+        self._queues = [self._ctx.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._procs: List[Optional[mp.Process]] = [None] * workers
+        self._restarts = [0] * workers
+        self._supervisor: Optional[asyncio.Task] = None
+        self.dropped = 0
+
+    def _spawn(self, index: int) -> None:
+        proc = self._ctx.Process(target=_worker_main, args=(index, len(self._queues), self._llm_processes, self._queues[index]),
+                                 name=f"bot-shard-{index}", daemon=True)
+        proc.start()
+        self._procs[index] = proc
+
+    def start(self) -> None:
+        for i in range(len(self._procs)):
+            self._spawn(i)
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    async def _supervise(self) -> None:
+        started = [time.monotonic()] * len(self._procs)
+        while True:
+            await asyncio.sleep(1)
+            for i, proc in enumerate(self._procs):
+                if proc is None or proc.is_alive():
+                    continue
+                # проработал минуту без падений — считаем, что серия падений закончилась
+                if time.monotonic() - started[i] > 60:
+                    self._restarts[i] = 0
+                delay = min(30, 2 ** self._restarts[i] - 1)
+                logger.error("Shard %d exited with code %s, restarting in %ds", i, proc.exitcode, delay)
+                self._procs[i] = None
+                self._restarts[i] += 1
+                asyncio.get_running_loop().call_later(delay, self._respawn, i, started)
+
+    def _respawn(self, index: int, started: List[float]) -> None:
+        if self._supervisor is None:
+            return
+        self._spawn(index)
+        started[index] = time.monotonic()
+
+    def put(self, raw: Dict[str, Any]) -> bool:
+        try:
+            self._queues[shard_of(raw, len(self._queues))].put_nowait(raw)
+            return True
+        except queue_lib.Full:
+            self.dropped += 1
+            return False
+
+    async def put_wait(self, raw: Dict[str, Any]) -> None:
+        # блокируется, пока у процесса заполнена очередь: так поллинг притормаживает сам
+        await asyncio.to_thread(self._queues[shard_of(raw, len(self._queues))].put, raw)
+
+    async def stop(self, timeout: float = BOT_SHARD_STOP_TIMEOUT) -> None:
+        supervisor, self._supervisor = self._supervisor, None
+        if supervisor is not None:
+            supervisor.cancel()
+            await asyncio.gather(supervisor, return_exceptions=True)
+        deadline = time.monotonic() + timeout
+        for q, proc in zip(self._queues, self._procs):
+            if proc is None or not proc.is_alive():
+                continue
+            # блокирующий put на event loop повесил бы остановку, если очередь забита
+            try:
+                await asyncio.to_thread(q.put, None, True, max(0.0, deadline - time.monotonic()))
+            except queue_lib.Full:
+                logger.warning("Shard queue full, terminating %s", proc.name)
+                proc.terminate()
+        for q, proc in zip(self._queues, self._procs):
+            if proc is not None:
+                await asyncio.to_thread(proc.join, max(0.0, deadline - time.monotonic()))
+                if proc.is_alive():
+                    proc.terminate()
+            # несчитанные апдейты в очереди мёртвого воркера не должны держать выход процесса
+            q.cancel_join_thread()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "workers": sum(1 for p in self._procs if p is not None and p.is_alive()),
+            "restarts": sum(self._restarts),
+            "dropped": self.dropped,
+        }
+
+
+async def run_polling(workers: int = BOT_WORKERS) -> None:
+    # входной процесс только получает апдейты и раздаёт их; обработчики живут в воркерах
+    from bot.start import bot, dp
+
+    await prepare_shared_files()
+    pool = ShardPool(workers)
+    pool.start()
+    offset = None
+    allowed = dp.resolve_used_update_types()
+    try:
+        while True:
+            try:
+                batch = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed)
+            except Exception:
+                logger.exception("get_updates failed")
+                await asyncio.sleep(5)
+                continue
+            for update in batch:
+                await pool.put_wait(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                offset = update.update_id + 1
+    finally:
+        await pool.stop()
+        await bot.session.close()
@@ -7,22 +7,39 @@ from aiogram import Bot, Dispatcher, F, types
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.types import (
     Message, ReplyKeyboardMarkup, KeyboardButton, PhotoSize,
-    FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, InputFile
+    FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, InputFile, CallbackQuery
 )
 from aiogram.utils.markdown import hpre
+from aiogram.utils.text_decorations import html_decoration
 from aiogram.utils.token import validate_token
+from aiogram.dispatcher.event.bases import SkipHandler
 
+from app.flow.engine import (
+    STEPS, start_session, step, S_ENTER_ANALYSES, S_WAIT_FOLLOWUP, DO_GPT1, DO_GPT_FINAL
+)
 from bot.fsm.states import SessionStates
-from app.services.gpt import generate_gpt_response, generate_final_gpt_response
-from app.db.database import init_db, save_session
-from app.services.ocr import extract_text_from_photo
+from bot.fsm.storage import SqliteStorage
+from bot.delivery import StreamingReply
+from bot.shard import runs_background_jobs
+from app.services.llm import (
+    stream_gpt_response, stream_final_gpt_response, init_client, close_client
+)
+from app.services.streaming import FollowupSplitter
+from app.services.llm_scheduler import llm_scheduler, LlmCancelled, PRIORITY_FIRST, PRIORITY_FINAL
+from app.services.llm_retry import deadline
+from app.db.database import (
+    init_db, close_db, save_session, get_sessions_page, get_latest_session, search_sessions
+)
+from app.services.ocr import pick_photo_size, shutdown_ocr_pool, OcrBusyError, PdfReadError
+from app.services.ocr_cache import extract_text_cached, extract_pdf_text_cached, ocr_cache
 from app.services.pdf_generator import generate_session_pdf
 
 import asyncio
 import tempfile
+from typing import Optional
 from io import BytesIO
 
 
@@ -32,8 +49,14 @@ validate_token(TOKEN)
 
 ADMIN_IDS = [191586312]
 
+# Bot API не отдаёт боту файлы больше 20 МБ
+TG_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+# Перед удалением брошенной анкеты сохранить её как сессию, если ответ GPT уже получен
+FSM_AUTOSAVE = os.getenv("FSM_AUTOSAVE", "0") == "1"
+
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+storage = SqliteStorage()
+dp = Dispatcher(storage=storage)
 
 # Стартовое меню
 start_keyboard = ReplyKeyboardMarkup(
@@ -44,51 +67,20 @@ start_keyboard = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
-@dp.message(
-    SessionStates.entering_symptoms,
-    F.text.in_({"🚀 Начать", "ℹ️ Что это за бот?", "🔒 Конфиденциальность", "💾 Сохранить сессию", "🔄 Начать заново"})
-)
-@dp.message(
-    SessionStates.entering_onset,
-    F.text.in_({"🚀 Начать", "ℹ️ Что это за бот?", "🔒 Конфиденциальность", "💾 Сохранить сессию", "🔄 Начать заново"})
-)
-@dp.message(
-    SessionStates.entering_context,
-    F.text.in_({"🚀 Начать", "ℹ️ Что это за бот?", "🔒 Конфиденциальность", "💾 Сохранить сессию", "🔄 Начать заново"})
-)
-@dp.message(
-    SessionStates.entering_analyses,
-    F.text.in_({"🚀 Начать", "ℹ️ Что это за бот?", "🔒 Конфиденциальность", "💾 Сохранить сессию", "🔄 Начать заново"})
-)
-@dp.message(
-    SessionStates.analysis_details,
-    F.text.in_({"🚀 Начать", "ℹ️ Что это за бот?", "🔒 Конфиденциальность", "💾 Сохранить сессию", "🔄 Начать заново"})
-)
-@dp.message(
-    SessionStates.entering_psycho,
-    F.text.in_({"🚀 Начать", "ℹ️ Что это за бот?", "🔒 Конфиденциальность", "💾 Сохранить сессию", "🔄 Начать заново"})
-)
-@dp.message(
-    SessionStates.entering_life_events,
-    F.text.in_({"🚀 Начать", "ℹ️ Что это за бот?", "🔒 Конфиденциальность", "💾 Сохранить сессию", "🔄 Начать заново"})
-)
-@dp.message(
-    SessionStates.deep_question_1,
-    F.text.in_({"🚀 Начать", "ℹ️ Что это за бот?", "🔒 Конфиденциальность", "💾 Сохранить сессию", "🔄 Начать заново"})
-)
-@dp.message(
-    SessionStates.deep_question_2,
-    F.text.in_({"🚀 Начать", "ℹ️ Что это за бот?", "🔒 Конфиденциальность", "💾 Сохранить сессию", "🔄 Начать заново"})
-)
-@dp.message(
-    SessionStates.deep_question_3,
-    F.text.in_({"🚀 Начать", "ℹ️ Что это за бот?", "🔒 Конфиденциальность", "💾 Сохранить сессию", "🔄 Начать заново"})
-)
-@dp.message(
-    SessionStates.deep_question_4,
-    F.text.in_({"🚀 Начать", "ℹ️ Что это за бот?", "🔒 Конфиденциальность", "💾 Сохранить сессию", "🔄 Начать заново"})
-)
+# Шаги анкеты: состояние FSM бота ↔ шаг сценария из app/flow/engine.py
+_BOT_STATES = {name: getattr(SessionStates, name).state for name in STEPS}
+_FLOW_STATES = {bot_state: name for name, bot_state in _BOT_STATES.items()}
+# Пока ждём ответа на вопрос, кнопки меню не срабатывают, а не-текст не принимается.
+# «Начать заново» работает всегда: ею же пользователь останавливает ответ модели
+ANSWER_STATES = set(_FLOW_STATES) | {SessionStates.analysis_details.state}
+MENU_BUTTONS = {"🚀 Начать", "ℹ️ Что это за бот?", "🔒 Конфиденциальность", "💾 Сохранить сессию"}
+RESTART_BUTTON = "🔄 Начать заново"
+
+
+@dp.message(F.text.in_(MENU_BUTTONS))
 async def handle_unexpected_button(message: Message, state: FSMContext):
+    if await state.get_state() not in ANSWER_STATES:
+        raise SkipHandler()
     await message.answer("Пожалуйста, сначала ответьте на текущий вопрос.")
 
 
@@ -105,174 +97,149 @@ async def start(message: Message, state: FSMContext):
 
 @dp.message(F.text == "🚀 Начать")
 async def begin_session(message: Message, state: FSMContext):
-    await state.set_state(SessionStates.entering_diagnosis)
-    await message.answer(
-        "Есть ли у вас диагноз, который вы бы хотели обсудить?\n\n"
-        "Если да, опишите его, или напишите «нет», если диагноза нет."
-    )
+    flow_state, prompt, _ = start_session()
+    await state.set_state(_BOT_STATES[flow_state])
+    await message.answer(prompt)
 
 
-@dp.message(SessionStates.entering_diagnosis)
-async def handle_diagnosis(message: Message, state: FSMContext):
-    diagnosis = message.text.strip().lower()
-    await state.update_data(diagnosis=diagnosis)
+async def _answer_step(message: Message, state: FSMContext, flow_state: str, text: str, prefix: str = ""):
+    user_data = await state.get_data()
+    next_state, reply, user_data, special = step(flow_state, text, user_data)
+    await state.set_data(user_data)
+    if special:
+        await _SPECIALS[special](message, state, user_data)
+        return
+    await state.set_state(_BOT_STATES[next_state])
+    await message.answer(prefix + reply)
 
-    if diagnosis in ["нет", "no", "-", "—", "неа"]:
-        await state.set_state(SessionStates.entering_analyses)
-        await message.answer(
-            "Хорошо, давайте перейдем к анализам.\n\n"
-            "Есть ли у вас анализы? 📄\n"
-            "— Вы можете прислать фото\n"
-            "— Или ввести текстом (например: «Гемоглобин — 130, Сахар — 5.4»)\n\n"
-            "Если у вас нет анализов, просто напишите «нет».\n\n"
-            "Также, пожалуйста, укажите дату, когда были сданы анализы."
-        )
-    else:
-        await state.set_state(SessionStates.entering_analyses)
-        await message.answer(
-            "Спасибо за информацию. Переходим к анализам.\n\n"
-            "Есть ли у вас анализы? 📄\n"
-            "— Вы можете прислать фото\n"
-            "— Или ввести текстом (например: «Гемоглобин — 130, Сахар — 5.4»)\n\n"
-            "Если у вас нет анализов, просто напишите «нет».\n\n"
-            "Также, пожалуйста, укажите дату, когда были сданы анализы."
-        )
 
+@dp.message(F.text)
+async def handle_flow_answer(message: Message, state: FSMContext):
+    flow_state = _FLOW_STATES.get(await state.get_state())
+    if flow_state is None:
+        raise SkipHandler()
+    await _answer_step(message, state, flow_state, message.text)
 
-@dp.message(SessionStates.entering_analyses, F.text)
-async def handle_analysis_text(message: Message, state: FSMContext):
-    text = message.text.strip().lower()
 
-    if text in ["нет", "no", "-", "—", "неа"]:
-        await state.update_data(analyses="нет")
-        await state.set_state(SessionStates.entering_symptoms)
-        await message.answer(
-            "Теперь давайте поговорим о симптомах.\n\n"
-            "Какие симптомы беспокоят вас в первую очередь?\n"
-            "Примеры: головная боль, бессонница, тревожность, усталость, боль в животе и т.д.\n"
-            "Напишите ваш симптом в свободной форме."
-        )
-    else:
-        await state.update_data(analyses=message.text)
-        await state.set_state(SessionStates.entering_symptoms)
-        await message.answer(
-            "Теперь давайте поговорим о симптомах.\n\n"
-            "Какие симптомы беспокоят вас в первую очередь?\n"
-            "Примеры: головная боль, бессонница, тревожность, усталость, боль в животе и т.д.\n"
-            "Напишите ваш симптом в свободной форме."
-        )
+def _downloader(file_id: str):
+    async def download() -> bytes:
+        file = await bot.get_file(file_id)
+        data = await bot.download_file(file.file_path)
+        return data.read()
+    return download
 
 
 @dp.message(SessionStates.entering_analyses, F.photo)
 async def handle_analysis_photo(message: Message, state: FSMContext):
-    photo: PhotoSize = message.photo[-1]
-    file = await bot.get_file(photo.file_id)
-    photo_bytes = await bot.download_file(file.file_path)
+    photo: PhotoSize = pick_photo_size(message.photo)
+    await _recognize_analysis_image(message, state, photo.file_id, photo.file_unique_id)
 
-    text = await extract_text_from_photo(photo_bytes.read())
-    await state.update_data(analyses=text)
 
-    await state.set_state(SessionStates.entering_symptoms)
-    await message.answer(
-        f"Распознанный текст:\n\n{hpre(text)}\n\n"
-        "Теперь давайте поговорим о симптомах.\n\n"
-        "Какие симптомы беспокоят вас в первую очередь?\n"
-        "Примеры: головная боль, бессонница, тревожность, усталость, боль в животе и т.д.\n"
-        "Напишите ваш симптом в свободной форме."
-    )
+async def _recognize_analysis_image(message: Message, state: FSMContext, file_id: str, file_unique_id: str):
+    async def notify_queued(position: int):
+        await message.answer(f"⏳ Фото в очереди на распознавание (вы {position}-й). Это займёт немного больше времени.")
 
+    try:
+        text = await extract_text_cached(file_unique_id, _downloader(file_id), on_queued=notify_queued)
+    except OcrBusyError:
+        await message.answer(
+            "😔 Сейчас слишком много фото на распознавании. Пришлите фото ещё раз через минуту "
+            "или введите анализы текстом."
+        )
+        return
+    await _answer_step(message, state, S_ENTER_ANALYSES, text, prefix=f"Распознанный текст:\n\n{hpre(text)}\n\n")
 
 
-@dp.message(SessionStates.entering_symptoms)
-async def handle_custom_symptom(message: Message, state: FSMContext):
-    await state.update_data(symptoms=message.text)
-    await state.set_state(SessionStates.entering_onset)
-    await message.answer("Когда это началось? Можете указать точную дату или примерно: «месяц назад», «неделю назад» и т.д.")
 
+@dp.message(SessionStates.entering_analyses, F.document)
+async def handle_analysis_document(message: Message, state: FSMContext):
+    document = message.document
+    mime = document.mime_type or ""
 
-@dp.message(SessionStates.entering_onset)
-async def handle_onset(message: Message, state: FSMContext):
-    await state.update_data(onset=message.text)
-    await state.set_state(SessionStates.entering_context)
-    await message.answer("Что происходило в вашей жизни в тот момент?\n\n"
-                         "Были ли стрессовые события, перемены, конфликты, потери?")
+    if document.file_size and document.file_size > TG_DOWNLOAD_LIMIT:
+        await message.answer("Файл слишком большой (больше 20 МБ). Пришлите фото анализов или введите их текстом.")
+        return
+    if mime.startswith("image/"):
+        await _recognize_analysis_image(message, state, document.file_id, document.file_unique_id)
+        return
+    if mime != "application/pdf":
+        await message.answer("Пожалуйста, пришлите анализы в PDF, фото или введите их текстом.")
+        return
 
+    reply = StreamingReply(message, "📄 Читаю документ...")
+    await reply.start()
 
-@dp.message(SessionStates.entering_context)
-async def handle_context(message: Message, state: FSMContext):
-    await state.update_data(context=message.text)
-    await state.set_state(SessionStates.entering_psycho)
-    await message.answer(
-        "Теперь немного о вашем эмоциональном фоне.\n\n"
-        "Вы бы назвали своё состояние скорее:\n"
-        "— напряжённым\n"
-        "— опустошённым\n"
-        "— тревожным\n"
-        "Или опишите своими словами."
-    )
+    async def on_page(page: int, total: int, text: str):
+        await reply.push(f"— Страница {page} из {total} —\n{text}\n\n" if total > 1 else text)
 
+    try:
+        text = await extract_pdf_text_cached(document.file_unique_id, _downloader(document.file_id), on_page)
+    except OcrBusyError:
+        await reply.finish("😔 Сейчас слишком много документов на распознавании. Пришлите файл ещё раз через минуту "
+                           "или введите анализы текстом.")
+        return
+    except PdfReadError:
+        # битый или запароленный PDF
+        await reply.finish("❌ Не удалось прочитать PDF. Пришлите фото анализов или введите их текстом.")
+        return
+    await reply.finish()
+    await _answer_step(message, state, S_ENTER_ANALYSES, text)
 
-@dp.message(SessionStates.entering_psycho)
-async def handle_psycho_state(message: Message, state: FSMContext):
-    await state.update_data(psycho_state=message.text)
-    await state.set_state(SessionStates.entering_life_events)
-    await message.answer(
-        "Были ли недавние перемены в вашей жизни?\n\n"
-        "Переезд, развод, потеря близкого человека, увольнение, смена ролей?"
-    )
 
+async def _wait_llm_slot(ticket, reply: StreamingReply):
+    async for position in ticket.positions():
+        await reply.status(f"⏳ Сейчас много запросов — вы {position}-й в очереди. Ответ появится здесь.")
 
-@dp.message(SessionStates.entering_life_events)
-async def handle_life_events(message: Message, state: FSMContext):
-    await state.update_data(life_events=message.text)
-    user_data = await state.get_data()
 
-    await message.answer("🧠 Анализирую ваш запрос...")
+async def _run_llm(message: Message, reply: StreamingReply, priority: int, deltas, on_delta) -> bool:
+    # False — запрос отменён: пользователь нажал «Начать заново», пока ждал ответ
+    ticket = llm_scheduler.submit(f"tg:{message.from_user.id}", priority)
 
-    gpt_reply, follow_up = await generate_gpt_response(user_data)
-    await state.update_data(gpt_reply=gpt_reply, follow_up=follow_up)
+    async def work():
+        await _wait_llm_slot(ticket, reply)
+        with deadline():
+            async for delta in deltas():
+                await on_delta(delta)
 
-    await message.answer(gpt_reply)
+    try:
+        await ticket.run(work())
+        return True
+    except LlmCancelled:
+        await reply.push("\n\n⏹ Ответ остановлен.")
+        await reply.finish()
+        return False
+    finally:
+        ticket.release()
 
-    if follow_up:
-        await message.answer(follow_up)
 
-    await state.set_state(SessionStates.waiting_follow_up)
+async def _first_pass(message: Message, state: FSMContext, user_data: dict):
+    reply = StreamingReply(message, "🧠 Анализирую ваш запрос...")
+    await reply.start()
 
+    splitter = FollowupSplitter()
 
-@dp.message(SessionStates.waiting_follow_up)
-async def handle_follow_up_answer(message: Message, state: FSMContext):
-    await state.update_data(follow_up_answer=message.text)
-    await state.set_state(SessionStates.deep_question_1)
-    await message.answer("Теперь немного глубже. Что изменилось в вашей жизни до появления симптома?")
+    async def on_delta(delta: str):
+        await reply.push(splitter.feed(delta))
 
+    if not await _run_llm(message, reply, PRIORITY_FIRST, lambda: stream_gpt_response(user_data), on_delta):
+        return
+    gpt_reply, follow_up = splitter.finish()
+    await reply.finish(gpt_reply)
 
-@dp.message(SessionStates.deep_question_1)
-async def handle_deep_q1(message: Message, state: FSMContext):
-    await state.update_data(deep_q1=message.text)
-    await state.set_state(SessionStates.deep_question_2)
-    await message.answer("Есть ли ситуации, которые вызывают это же чувство — тревоги, обиды, стеснения?")
+    await state.update_data(gpt_reply=gpt_reply, follow_up=follow_up)
 
-@dp.message(SessionStates.deep_question_2)
-async def handle_deep_q2(message: Message, state: FSMContext):
-    await state.update_data(deep_q2=message.text)
-    await state.set_state(SessionStates.deep_question_3)
-    await message.answer("Если бы ваш симптом был образом или эмоцией — что бы это было?")
+    if follow_up:
+        await message.answer(html_decoration.quote(follow_up))
 
-@dp.message(SessionStates.deep_question_3)
-async def handle_deep_q3(message: Message, state: FSMContext):
-    await state.update_data(deep_q3=message.text)
-    await state.set_state(SessionStates.deep_question_4)
-    await message.answer("Когда вы в последний раз чувствовали, что не можете что-то «переварить», «удержать» или «выразить»?")
+    await state.set_state(_BOT_STATES[S_WAIT_FOLLOWUP])
 
-@dp.message(SessionStates.deep_question_4)
-async def handle_deep_q4(message: Message, state: FSMContext):
-    await state.update_data(deep_q4=message.text)
-    user_data = await state.get_data()
 
-    await message.answer("🧠 Обрабатываю ваши ответы...")
-    gpt_reply = await generate_final_gpt_response(user_data)
-    await message.answer(gpt_reply)
+async def _final_pass(message: Message, state: FSMContext, user_data: dict):
+    reply = StreamingReply(message, "🧠 Обрабатываю ваши ответы...")
+    await reply.start()
+    if not await _run_llm(message, reply, PRIORITY_FINAL, lambda: stream_final_gpt_response(user_data), reply.push):
+        return
+    await reply.finish()
 
     consult_markup = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -294,6 +261,8 @@ async def handle_deep_q4(message: Message, state: FSMContext):
     )
 
 
+_SPECIALS = {DO_GPT1: _first_pass, DO_GPT_FINAL: _final_pass}
+
 
 @dp.message(SessionStates.post_recommendations, F.text == "💾 Сохранить сессию")
 async def save_user_session(message: Message, state: FSMContext):
@@ -301,7 +270,7 @@ async def save_user_session(message: Message, state: FSMContext):
     user_id = message.from_user.id
     gpt_reply = user_data.get("gpt_reply", "—")
 
-    save_session(user_id, user_data, gpt_reply)
+    await save_session(user_id, user_data, gpt_reply)
 
     await state.clear()
     await message.answer("✅ Сессия успешно сохранена. Вы всегда можете вернуться к ней позже.",
@@ -322,22 +291,18 @@ async def privacy(message: Message):
         "Бот не заменяет врача. Вы всегда можете удалить свои данные."
     )
 
-@dp.message(F.text == "/sessions")
-async def show_sessions(message: Message):
-    import sqlite3
-    conn = sqlite3.connect("sessions.db")
-    c = conn.cursor()
-    c.execute("SELECT user_id, created_at, symptoms, psycho_state, gpt_reply FROM sessions ORDER BY created_at DESC LIMIT 5")
-    rows = c.fetchall()
-    conn.close()
+SESSIONS_PAGE_SIZE = 5
+
+
+async def _send_sessions_page(message: Message, before=None):
+    rows = await get_sessions_page(before=before, limit=SESSIONS_PAGE_SIZE)
 
     if not rows:
-        await message.answer("Пока нет сохранённых сессий.")
+        await message.answer("Пока нет сохранённых сессий." if before is None else "Больше сессий нет.")
         return
 
     for row in rows:
-        user_id, created_at, symptoms, psycho, gpt_reply = row
-
+        _, _, user_id, created_at, symptoms, psycho, gpt_reply = row
 
         try:
             user = await bot.get_chat(user_id)
@@ -354,18 +319,84 @@ async def show_sessions(message: Message):
             parse_mode="HTML"
         )
 
+    if len(rows) == SESSIONS_PAGE_SIZE:
+        last_id, last_ts = rows[-1][0], rows[-1][1]
+        await message.answer(
+            "Показать более ранние?",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="⬇️ Дальше", callback_data=f"sessions:{last_ts}:{last_id}")]
+            ])
+        )
+
+
+@dp.message(F.text == "/sessions")
+async def show_sessions(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    await _send_sessions_page(message)
+
+
+@dp.callback_query(F.data.startswith("sessions:"))
+async def show_sessions_next(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
+        return
+    _, ts, session_id = callback.data.split(":")
+    await callback.answer()
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await _send_sessions_page(callback.message, before=(int(ts), int(session_id)))
+
+
+
+async def _send_search_page(message: Message, query: str, offset: int = 0):
+    rows = await search_sessions(query, limit=SESSIONS_PAGE_SIZE, offset=offset)
+
+    if not rows:
+        await message.answer("Ничего не найдено." if offset == 0 else "Больше совпадений нет.")
+        return
+
+    lines = [f"🔎 Результаты {offset + 1}–{offset + len(rows)}:"]
+    for session_id, user_id, created_at, snippet in rows:
+        lines.append(f"\n#{session_id} · <code>{user_id}</code> · {created_at[:16]}\n{snippet}")
+
+    markup = None
+    if len(rows) == SESSIONS_PAGE_SIZE:
+        markup = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬇️ Дальше", callback_data=f"search:{offset + SESSIONS_PAGE_SIZE}")]
+        ])
+    await message.answer("\n".join(lines), reply_markup=markup)
+
+
+@dp.message(F.text.startswith("/search"))
+async def search_saved_sessions(message: Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    query = message.text.partition(" ")[2].strip()
+    if not query:
+        await message.answer("Использование: /search слова для поиска")
+        return
+    # запрос не влезает в callback_data (64 байта), поэтому живёт в данных FSM
+    await state.update_data(search_query=query)
+    await _send_search_page(message, query)
+
+
+@dp.callback_query(F.data.startswith("search:"))
+async def search_saved_sessions_next(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    query = (await state.get_data()).get("search_query")
+    if not query:
+        return
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await _send_search_page(callback.message, query, offset=int(callback.data.split(":")[1]))
 
 
 @dp.message(F.text == "/вернуться")
 async def restore_session(message: Message, state: FSMContext):
     user_id = message.from_user.id
 
-    import sqlite3
-    conn = sqlite3.connect("sessions.db")
-    c = conn.cursor()
-    c.execute("SELECT symptoms, onset, context, analyses, psycho_state, life_events, gpt_reply FROM sessions WHERE user_id = ? ORDER BY created_at DESC LIMIT 1", (user_id,))
-    row = c.fetchone()
-    conn.close()
+    row = await get_latest_session(user_id)
 
     if not row:
         await message.answer("❌ У вас пока нет сохранённых сессий.")
@@ -394,8 +425,9 @@ async def restore_session(message: Message, state: FSMContext):
         )
     )
 
-@dp.message(F.text == "🔄 Начать заново")
+@dp.message(F.text == RESTART_BUTTON)
 async def restart_session(message: Message, state: FSMContext):
+    llm_scheduler.cancel(f"tg:{message.from_user.id}")
     await state.clear()
     await message.answer(
         "🔄 Начинаем заново.\n\n"
@@ -438,25 +470,46 @@ async def test_pdf(message: Message):
     await message.answer_document(FSInputFile(tmp_path, filename="test_session_report.pdf"))
 
 
-@dp.message(SessionStates.entering_symptoms)
-@dp.message(SessionStates.entering_onset)
-@dp.message(SessionStates.entering_context)
-@dp.message(SessionStates.entering_analyses)
-@dp.message(SessionStates.analysis_details)
-@dp.message(SessionStates.entering_psycho)
-@dp.message(SessionStates.entering_life_events)
-@dp.message(SessionStates.deep_question_1)
-@dp.message(SessionStates.deep_question_2)
-@dp.message(SessionStates.deep_question_3)
-@dp.message(SessionStates.deep_question_4)
-@dp.message(SessionStates.post_recommendations)
+@dp.message()
 async def handle_unexpected_text(message: Message, state: FSMContext):
-    await message.answer("Пожалуйста, ответьте на вопрос, введя текст.")
+    current = await state.get_state()
+    if current in ANSWER_STATES or current == SessionStates.post_recommendations.state:
+        await message.answer("Пожалуйста, ответьте на вопрос, введя текст.")
+
+async def autosave_expired(key: StorageKey, state: Optional[str], user_data: dict):
+    if user_data.get("gpt_reply"):
+        await save_session(key.user_id, user_data, user_data["gpt_reply"])
+
+
+async def on_startup():
+    background = runs_background_jobs()
+    await init_db(archive=background)
+    await init_client()
+    if background:
+        storage.start_reaper(autosave_expired if FSM_AUTOSAVE else None)
+
+
+async def on_shutdown():
+    await close_client()
+    shutdown_ocr_pool()
+    ocr_cache.close()
+    await close_db()
+
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
 
 async def main():
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        # в режиме вебхука бота запускает web_fullbot_api: uvicorn web_fullbot_api:app
+        raise SystemExit("BOT_MODE=webhook: запустите web_fullbot_api через uvicorn")
+    from bot.shard import BOT_WORKERS, run_polling
+    if BOT_WORKERS > 1:
+        await run_polling(BOT_WORKERS)
+        return
     await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
-    init_db()
     asyncio.run(main())
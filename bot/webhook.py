@@ -0,0 +1,129 @@
+import asyncio
+import hmac
+import logging
+import os
+from typing import Any, Dict, List
+
+from aiogram.types import Update
+from fastapi import APIRouter, HTTPException, Request, Response
+
+from app.services.llm_scheduler import share_llm_slots
+from bot.shard import BOT_WORKERS, ShardPool, prepare_shared_files, preempt, shard_of
+from bot.start import bot, dp
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес, на который Telegram шлёт апдейты, без пути: https://bot.example.com
+WEBHOOK_BASE_URL = (os.getenv("WEBHOOK_BASE_URL") or "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Очередей столько, сколько апдейтов обрабатывается параллельно; апдейты одного
+# пользователя всегда попадают в одну очередь и идут по порядку
+WEBHOOK_QUEUES = int(os.getenv("WEBHOOK_QUEUES", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "100"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))
+# Число процессов веб-сервера — та же переменная, что читают uvicorn и gunicorn.
+# Вебхук поддерживает только один: запускать его с --workers больше 1 нельзя
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+
+class UpdateQueue:
+    """
+    Апдейты от Telegram раскладываются по `shards` ограниченным очередям по id
+    пользователя, каждую разбирает свой воркер через dp.feed_update. Переполненная
+    очередь отвечает 503 — Telegram повторит доставку позже.
+    """
+
+    def __init__(self, shards: int = WEBHOOK_QUEUES, size: int = WEBHOOK_QUEUE_SIZE) -> None:
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=size) for _ in range(shards)]
+        self._workers: List[asyncio.Task] = []
+        self.dropped = 0
+
+    def start(self) -> None:
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._run(q)) for q in self._queues]
+
+    def put(self, raw: Dict[str, Any]) -> bool:
+        preempt(raw)
+        queue = self._queues[shard_of(raw, len(self._queues))]
+        try:
+            queue.put_nowait(raw)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    async def _run(self, queue: asyncio.Queue) -> None:
+        while True:
+            raw = await queue.get()
+            try:
+                update = Update.model_validate(raw, context={"bot": bot})
+                await dp.feed_update(bot, update)
+            except Exception:
+                logger.exception("Update %s failed", raw.get("update_id"))
+            finally:
+                queue.task_done()
+
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT) -> None:
+        # сначала дорабатываем то, что уже принято: Telegram эти апдейты больше не пришлёт
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Webhook queues not drained in %.0fs", timeout)
+        workers, self._workers = self._workers, []
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": sum(q.qsize() for q in self._queues), "dropped": self.dropped}
+
+
+# при BOT_WORKERS > 1 апдейты обрабатываются в отдельных процессах (bot/shard.py);
+# веб-чат этого же процесса тоже ходит к модели и получает свою долю LLM_MAX_CONCURRENCY
+updates = ShardPool(llm_processes=BOT_WORKERS + 1) if BOT_WORKERS > 1 else UpdateQueue()
+router = APIRouter()
+
+
+@router.post(WEBHOOK_PATH)
+async def telegram_webhook(req: Request):
+    token = req.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    try:
+        raw = await req.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Bad JSON")
+    if not updates.put(raw):
+        return Response(status_code=503)
+    return Response(status_code=200)
+
+
+async def start_webhook() -> None:
+    assert WEBHOOK_SECRET, "WEBHOOK_SECRET не задан"
+    # апдейты одного пользователя попадали бы в разные процессы, а FSM-кэш
+    # (bot/fsm/storage.py) и шардирование рассчитаны на один процесс на пользователя
+    if WEB_CONCURRENCY > 1:
+        raise RuntimeError("BOT_MODE=webhook needs WEB_CONCURRENCY=1; use BOT_WORKERS to scale the bot")
+    workflow_data = {"dispatcher": dp, "bots": [bot], **dp.workflow_data}
+    if BOT_WORKERS <= 1:
+        await dp.emit_startup(bot=bot, **workflow_data)
+    else:
+        await prepare_shared_files()
+        share_llm_slots(BOT_WORKERS + 1)
+    updates.start()
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+
+async def stop_webhook() -> None:
+    # вебхук не снимаем: при скользящем перезапуске его обслуживают остальные инстансы
+    await updates.stop()
+    if BOT_WORKERS <= 1:
+        workflow_data = {"dispatcher": dp, "bots": [bot], **dp.workflow_data}
+        await dp.emit_shutdown(bot=bot, **workflow_data)
+    await bot.session.close()
@@ -0,0 +1,33 @@
+import unittest
+
+from app.services.labs import analyses_for_prompt, extract_lab_rows
+
+
+class AnalysesForPromptTest(unittest.TestCase):
+    def test_table_only(self):
+        text = "Гемоглобин 95 г/л (норма 120-160)\nГлюкоза 5,1 ммоль/л"
+        self.assertEqual(analyses_for_prompt(text), "Гемоглобин: 95 г/л (норма 120–160)\nГлюкоза: 5.1 ммоль/л")
+
+    def test_unrecognised_lines_kept(self):
+        text = "Гемоглобин 95 г/л\nПрокальцитонин 0.3 нг/мл\nУЗИ щитовидки: узел 5 мм\n123 456"
+        result = analyses_for_prompt(text)
+        self.assertTrue(result.startswith("Гемоглобин: 95 г/л\n"))
+        self.assertIn("Прокальцитонин 0.3 нг/мл", result)
+        self.assertIn("УЗИ щитовидки: узел 5 мм", result)
+        self.assertNotIn("123 456", result)
+
+    def test_comment_on_recognised_line_kept(self):
+        result = analyses_for_prompt("Гемоглобин 95, врач сказал анемия")
+        self.assertIn("врач сказал анемия", result)
+
+    def test_nothing_recognised(self):
+        self.assertEqual(analyses_for_prompt("всё в норме"), "всё в норме")
+        self.assertIsNone(analyses_for_prompt(None))
+
+    def test_extract_rows(self):
+        rows = extract_lab_rows("12.03.2024\nТТГ 2,5 мМЕ/л")
+        self.assertEqual([(r.analyte, r.value, r.date) for r in rows], [("ТТГ", "2.5", "12.03.2024")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import asyncio
+import time
+import unittest
+from typing import List, Optional
+from unittest import mock
+
+import httpx
+
+from app.services import llm_retry
+from app.services.llm_retry import deadline, parse_retry_after, until_deadline, with_retries
+
+
+def status_error(status: int, retry_after: Optional[str] = None) -> httpx.HTTPStatusError:
+    headers = {"retry-after": retry_after} if retry_after is not None else {}
+    request = httpx.Request("POST", "https://llm.example/v1/chat")
+    response = httpx.Response(status, headers=headers, request=request)
+    return httpx.HTTPStatusError("error", request=request, response=response)
+
+
+class WithRetriesTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # без джиттера: паузы в тестах определяет только Retry-After
+        patcher = mock.patch.object(llm_retry, "LLM_BACKOFF_BASE", 0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_retries_transient_error(self):
+        calls: List[Optional[float]] = []
+
+        async def call(timeout):
+            calls.append(timeout)
+            if len(calls) == 1:
+                raise status_error(503, "0")
+            return "ok"
+
+        self.assertEqual(await with_retries(call), "ok")
+        self.assertEqual(calls, [None, None])
+
+    async def test_no_retry_on_client_error(self):
+        calls = []
+
+        async def call(timeout):
+            calls.append(timeout)
+            raise status_error(400)
+
+        with self.assertRaises(httpx.HTTPStatusError):
+            await with_retries(call)
+        self.assertEqual(len(calls), 1)
+
+    async def test_retry_after_beyond_deadline(self):
+        calls = []
+
+        async def call(timeout):
+            calls.append(timeout)
+            raise status_error(429, "30")
+
+        started = time.monotonic()
+        with deadline(1):
+            with self.assertRaises(httpx.HTTPStatusError):
+                await with_retries(call)
+        # пауза не укладывается в дедлайн — ошибка сразу, без сна и второй попытки
+        self.assertEqual(len(calls), 1)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertLessEqual(calls[0], 1)
+
+    async def test_call_gets_remaining_time(self):
+        async def call(timeout):
+            await asyncio.sleep(5)
+
+        with deadline(0.1):
+            with self.assertRaises(asyncio.TimeoutError):
+                await with_retries(call)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after({"retry-after": "7"}), 7.0)
+        self.assertEqual(parse_retry_after({"retry-after-ms": "1500"}), 1.5)
+        self.assertIsNone(parse_retry_after({}))
+
+
+class UntilDeadlineTest(unittest.IsolatedAsyncioTestCase):
+    async def test_hung_stream(self):
+        async def stream():
+            yield "a"
+            await asyncio.sleep(5)
+            yield "b"
+
+        seen = []
+        with self.assertRaises(TimeoutError):
+            async for item in until_deadline(stream(), 0.1):
+                seen.append(item)
+        self.assertEqual(seen, ["a"])
+
+    async def test_context_deadline(self):
+        async def stream():
+            for item in ("a", "b"):
+                yield item
+
+        with deadline(1):
+            self.assertEqual([item async for item in until_deadline(stream())], ["a", "b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
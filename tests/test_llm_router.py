@@ -0,0 +1,90 @@
+import asyncio
+import unittest
+from typing import AsyncIterator, Dict, List, Optional
+from unittest import mock
+
+from app.services import llm
+from app.services.llm import FIRST_PASS, LlmProvider, LlmRouter
+
+
+class FakeProvider(LlmProvider):
+    def __init__(self, name: str, parts: List[str], delay: float = 0.0,
+                 error: Optional[Exception] = None) -> None:
+        super().__init__()
+        self.name = name
+        self.parts = parts
+        self.delay = delay
+        self.error = error
+        self.closed = False
+
+    def configured(self) -> bool:
+        return True
+
+    async def _stream(self) -> AsyncIterator[str]:
+        try:
+            await asyncio.sleep(self.delay)
+            if self.error is not None:
+                raise self.error
+            for part in self.parts:
+                yield part
+        finally:
+            self.closed = True
+
+    def stream(self, kind: str, user_data: dict, draft: Optional[str] = None) -> AsyncIterator[str]:
+        return self._stream()
+
+    def cache_params(self) -> Dict:
+        return {"model": self.name}
+
+
+async def collect(router: LlmRouter) -> str:
+    return "".join([delta async for delta in router.stream(FIRST_PASS, {})])
+
+
+class LlmRouterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_failover_on_primary_error(self):
+        primary = FakeProvider("a", ["нет"], error=ConnectionError("down"))
+        backup = FakeProvider("b", ["за", "пас"])
+        router = LlmRouter([primary, backup])
+
+        with self.assertLogs(llm.logger, "WARNING"):
+            self.assertEqual(await collect(router), "запас")
+        self.assertEqual(router.failovers, 1)
+        self.assertEqual(primary.stats.errors, 1)
+        self.assertEqual(backup.stats.calls, 1)
+
+    async def test_hedge_wins_when_primary_slow(self):
+        primary = FakeProvider("a", ["медленно"], delay=5)
+        backup = FakeProvider("b", ["быстро"])
+        router = LlmRouter([primary, backup], hedge=True)
+
+        with mock.patch.object(llm, "LLM_HEDGE_AFTER", 0.05):
+            reply = await asyncio.wait_for(collect(router), 2)
+        self.assertEqual(reply, "быстро")
+        self.assertEqual(router.hedged, 1)
+        # проигравший запрос отменён и закрыт, а не дочитан
+        self.assertTrue(primary.closed)
+
+    async def test_no_hedge_without_flag(self):
+        primary = FakeProvider("a", ["основной"], delay=0.1)
+        backup = FakeProvider("b", ["запас"])
+        router = LlmRouter([primary, backup])
+
+        with mock.patch.object(llm, "LLM_HEDGE_AFTER", 0.01):
+            self.assertEqual(await collect(router), "основной")
+        self.assertEqual(router.hedged, 0)
+        self.assertEqual(backup.stats.calls, 0)
+
+    async def test_both_fail_raises_last_error(self):
+        router = LlmRouter([
+            FakeProvider("a", [], error=ConnectionError("a down")),
+            FakeProvider("b", [], error=TimeoutError("b down")),
+        ])
+
+        with self.assertLogs(llm.logger, "WARNING"), self.assertRaises(TimeoutError) as ctx:
+            await collect(router)
+        self.assertEqual(str(ctx.exception), "b down")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import asyncio
+import unittest
+
+from app.services import llm_scheduler as sched
+from app.services.llm_scheduler import LlmScheduler
+
+
+class TicketPositionsTest(unittest.IsolatedAsyncioTestCase):
+    async def test_granted_while_consumer_suspended(self):
+        scheduler = LlmScheduler(limit=1)
+        a = scheduler.submit("a")
+        b = scheduler.submit("b")
+        self.assertTrue(a.granted)
+
+        async def consume():
+            async for _ in b.positions():
+                # слот освобождается, пока потребитель занят своим (правкой сообщения)
+                a.release()
+                await asyncio.sleep(0.1)
+
+        await asyncio.wait_for(consume(), 1)
+        self.assertTrue(b.granted)
+        b.release()
+        self.assertEqual(scheduler.stats()["running"], 0)
+
+    async def test_positions_follow_queue(self):
+        scheduler = LlmScheduler(limit=1)
+        a = scheduler.submit("a")
+        b = scheduler.submit("b")
+        c = scheduler.submit("c")
+        seen = []
+
+        async def consume():
+            async for position in c.positions():
+                seen.append(position)
+                if position == 2:
+                    a.release()
+                elif position == 1:
+                    b.release()
+
+        await asyncio.wait_for(consume(), 1)
+        self.assertEqual(seen, [2, 1])
+        self.assertTrue(c.granted)
+        c.release()
+
+
+class ShareLlmSlotsTest(unittest.TestCase):
+    def setUp(self):
+        self.limit = sched.llm_scheduler.limit
+        self.addCleanup(setattr, sched.llm_scheduler, "limit", self.limit)
+
+    def test_limit_divided_between_processes(self):
+        sched.share_llm_slots(3)
+        self.assertEqual(sched.llm_scheduler.limit, max(1, sched.LLM_MAX_CONCURRENCY // 3))
+
+    def test_at_least_one_slot(self):
+        sched.share_llm_slots(sched.LLM_MAX_CONCURRENCY + 1)
+        self.assertEqual(sched.llm_scheduler.limit, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
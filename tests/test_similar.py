@@ -0,0 +1,139 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from app.db import database
+from app.services import similar
+from app.services.similar import SimilarIndex, UNKNOWN_DIAGNOSIS, diagnosis_key, vectorize
+
+SHORT = {"symptoms": "болит голова", "onset": "вчера", "diagnosis": "нет", "analyses": "нет"}
+
+
+class VectorizeTest(unittest.TestCase):
+    def test_same_text_same_vector(self):
+        a = vectorize("болит голова", 64)
+        self.assertEqual(a.shape, (64,))
+        self.assertEqual(a.dtype, np.float32)
+        np.testing.assert_array_equal(a, vectorize("болит голова", 64))
+
+    def test_empty_text(self):
+        self.assertFalse(vectorize("", 64).any())
+
+    def test_sublinear_tf(self):
+        # n-грамма, встреченная k раз, весит 1 + ln k, а не k: «ааа» в « ааааа » — трижды
+        vec = vectorize("ааааа", 4096)
+        self.assertAlmostEqual(float(vec.max()), 1 + np.log(3), places=5)
+
+    def test_diagnosis_key(self):
+        self.assertEqual(diagnosis_key({}), UNKNOWN_DIAGNOSIS)
+        self.assertEqual(diagnosis_key({"diagnosis": "нет"}), diagnosis_key({"diagnosis": "-"}))
+        self.assertNotEqual(diagnosis_key({"diagnosis": "гастрит"}), diagnosis_key({"diagnosis": "нет"}))
+
+
+class SimilarIndexTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        patches = [
+            mock.patch.object(database, "DB_NAME", os.path.join(self.dir.name, "sessions.db")),
+            mock.patch.object(database, "_save_listeners", []),
+            mock.patch.object(similar, "SIM_SYNC_INTERVAL", 0.05),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        await database.init_db(archive=False)
+        self.indexes = []
+
+    async def asyncTearDown(self):
+        for index in self.indexes:
+            await index.stop()
+        await database.close_db()
+
+    async def _index(self) -> SimilarIndex:
+        index = SimilarIndex(os.path.join(self.dir.name, "index.npz"), dim=256)
+        self.indexes.append(index)
+        await index.start()
+        return index
+
+    async def _ready(self, index: SimilarIndex) -> None:
+        for _ in range(100):
+            if index.ready:
+                return
+            await asyncio.sleep(0.02)
+        self.fail("index not ready")
+
+    async def test_same_diagnosis_only(self):
+        await database.save_session(1, {**SHORT, "diagnosis": "мигрень"}, "про мигрень")
+        await database.save_session(2, {**SHORT, "diagnosis": "гипертония"}, "про давление")
+        index = await self._index()
+        await self._ready(index)
+
+        match = await index.lookup({**SHORT, "diagnosis": "гипертония"})
+        self.assertEqual(match.reply, "про давление")
+        self.assertIsNone(await index.lookup({**SHORT, "diagnosis": "астма"}))
+        # диагноз неизвестен — сравнивать не с чем
+        self.assertIsNone(await index.lookup({k: v for k, v in SHORT.items() if k != "diagnosis"}))
+
+    async def test_reuse_needs_both_trivial(self):
+        index = await self._index()
+        await self._ready(index)
+        await database.save_session(1, SHORT, "готовый ответ")
+
+        match = await index.lookup(SHORT)
+        self.assertEqual(match.reply, "готовый ответ")
+        self.assertTrue(match.reusable)
+
+        # эта анкета уже не простая — только черновик
+        with mock.patch.object(similar, "SIM_TRIVIAL_CHARS", 5):
+            match = await index.lookup(SHORT)
+        self.assertFalse(match.reusable)
+
+    async def test_source_not_trivial(self):
+        index = await self._index()
+        await self._ready(index)
+        # та анкета, на которую писался ответ, не была простой
+        with mock.patch.object(similar, "SIM_TRIVIAL_CHARS", 5):
+            await database.save_session(1, SHORT, "ответ")
+
+        match = await index.lookup(SHORT)
+        self.assertEqual(match.reply, "ответ")
+        self.assertFalse(match.reusable)
+
+    async def test_second_process_maps_owner_file(self):
+        await database.save_session(1, SHORT, "ответ")
+        owner = await self._index()
+        await self._ready(owner)
+        reader = await self._index()
+        await self._ready(reader)
+
+        self.assertTrue(owner.owner)
+        self.assertFalse(reader.owner)
+        self.assertIsInstance(reader._view.base, np.memmap)
+        self.assertEqual(reader._n, 1)
+
+        # сессия другого процесса приходит из базы, а после записи файла — из него, без дублей
+        with mock.patch.object(database, "_save_listeners", []):
+            await database.save_session(2, {**SHORT, "diagnosis": "мигрень"}, "про мигрень")
+        for _ in range(100):
+            if reader._n == 2:
+                break
+            await asyncio.sleep(0.02)
+        self.assertEqual(reader._n, 2)
+        await asyncio.to_thread(owner._save)
+        for _ in range(100):
+            if len(reader._view.base) == 2:
+                break
+            await asyncio.sleep(0.02)
+        self.assertEqual(len(reader._view.base), 2)
+        self.assertEqual(reader._n, 2)
+        match = await reader.lookup({**SHORT, "diagnosis": "мигрень"})
+        self.assertEqual(match.reply, "про мигрень")
+
+
+if __name__ == "__main__":
+    unittest.main()
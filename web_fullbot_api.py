@@ -1,22 +1,82 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
+import asyncio
+import json
+import os
 import uuid
 
 from app.flow.engine import (
     start_session, step, PROMPTS,
-    S_DONE, S_WAIT_FOLLOWUP
+    S_DONE, S_WAIT_FOLLOWUP, DO_GPT1, DO_GPT_FINAL
 )
-from app.services.gpt import generate_gpt_response, generate_final_gpt_response
+from app.services.llm import (
+    generate_gpt_response, generate_final_gpt_response,
+    stream_gpt_response, stream_final_gpt_response,
+    init_client, close_client
+)
+from app.services.streaming import FollowupSplitter
+from app.services.llm_scheduler import llm_scheduler, LlmCancelled, PRIORITY_FIRST, PRIORITY_FINAL
+from app.services.llm_retry import LLM_DEADLINE, deadline, until_deadline
+from app.db.web_sessions import make_session_store
+
+# BOT_MODE=webhook — Telegram-бот обслуживается этим же приложением
+BOT_MODE = os.getenv("BOT_MODE", "polling")
 
 app = FastAPI()
 
+sessions = make_session_store()
+
+if BOT_MODE == "webhook":
+    from bot.webhook import router as telegram_router, start_webhook, stop_webhook
+    app.include_router(telegram_router)
+
+
+@app.on_event("startup")
+async def on_startup():
+    await init_client()
+    if BOT_MODE == "webhook":
+        await start_webhook()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if BOT_MODE == "webhook":
+        await stop_webhook()
+    await close_client()
+    await sessions.close()
+
+
 @app.get("/api/ping")
 def ping():
     return {"ok": True}
 
 
-SESS: dict[str, dict] = {}
+async def _abort_on_disconnect(req: Request, ticket) -> None:
+    while not await req.is_disconnected():
+        await asyncio.sleep(1)
+    ticket.abort()
+
+
+async def _generate(req: Request, sid: str, priority: int, generate):
+    # ответ нужен, только пока клиент ждёт: оборвал соединение — запрос к модели отменяется
+    ticket = llm_scheduler.submit(f"web:{sid}", priority)
+
+    async def work():
+        await ticket.wait()
+        with deadline():
+            return await generate()
+
+    watcher = asyncio.create_task(_abort_on_disconnect(req, ticket))
+    try:
+        return await ticket.run(work())
+    except LlmCancelled:
+        raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        watcher.cancel()
+        ticket.release()
+
 
 @app.post("/api/chat")
 async def chat(req: Request):
@@ -27,35 +87,111 @@ async def chat(req: Request):
 
     sid = data.get("session_id") or str(uuid.uuid4())
     message = (data.get("message") or "").strip()
-    st = SESS.get(sid)
+    st = await sessions.get(sid)
 
     if st is None:
         state, reply, user_data = start_session()
-        SESS[sid] = {"state": state, "user_data": user_data}
+        await sessions.put(sid, state, user_data)
         return JSONResponse({"session_id": sid, "reply": reply, "done": False})
 
-    state = st["state"]
-    user_data = st["user_data"]
+    state, user_data = st
     next_state, reply, user_data, special = step(state, message, user_data)
 
-    if special == "DO_GPT1":
-        gpt_reply, follow_up = await generate_gpt_response(user_data)
-        st["state"] = S_WAIT_FOLLOWUP
-        st["user_data"] = user_data
+    if special == DO_GPT1:
+        gpt_reply, follow_up = await _generate(req, sid, PRIORITY_FIRST, lambda: generate_gpt_response(user_data))
+        user_data.update(gpt_reply=gpt_reply, follow_up=follow_up)
+        await sessions.put(sid, S_WAIT_FOLLOWUP, user_data)
         out = gpt_reply + (f"\n---\n{follow_up}" if (follow_up or "").strip() else "")
         return JSONResponse({"session_id": sid, "reply": out, "done": False})
 
-    if special == "DO_GPT_FINAL":
-        final = await generate_final_gpt_response(user_data)
-        SESS.pop(sid, None)
+    if special == DO_GPT_FINAL:
+        final = await _generate(req, sid, PRIORITY_FINAL, lambda: generate_final_gpt_response(user_data))
+        await sessions.delete(sid)
         return JSONResponse({"session_id": sid, "reply": final, "done": True})
 
-    st["state"] = next_state
-    st["user_data"] = user_data
+    await sessions.put(sid, next_state, user_data)
     if not reply and next_state in PROMPTS:
         reply = PROMPTS[next_state]
 
     return JSONResponse({"session_id": sid, "reply": reply, "done": next_state == S_DONE})
 
 
+def _sse(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.post("/api/chat/stream")
+async def chat_stream(req: Request):
+    try:
+        data = await req.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Bad JSON")
+
+    sid = data.get("session_id") or str(uuid.uuid4())
+    message = (data.get("message") or "").strip()
+
+    async def events():
+        st = await sessions.get(sid)
+
+        if st is None:
+            state, reply, user_data = start_session()
+            await sessions.put(sid, state, user_data)
+            yield _sse("done", {"session_id": sid, "reply": reply, "done": False})
+            return
+
+        state, user_data = st
+        next_state, reply, user_data, special = step(state, message, user_data)
+
+        if special in (DO_GPT1, DO_GPT_FINAL):
+            # пока модель пишет, сессия остаётся в прежнем состоянии: при обрыве можно повторить ответ
+            final = special == DO_GPT_FINAL
+            splitter = FollowupSplitter()
+            text = ""
+            deltas = None
+            ticket = llm_scheduler.submit(f"web:{sid}", PRIORITY_FINAL if final else PRIORITY_FIRST)
+            try:
+                async for position in ticket.positions():
+                    yield _sse("queue", {"position": position})
+                source = stream_final_gpt_response(user_data) if final else stream_gpt_response(user_data)
+                deltas = until_deadline(source, LLM_DEADLINE)
+                async for delta in deltas:
+                    text += delta
+                    visible = delta if final else splitter.feed(delta)
+                    if visible:
+                        yield _sse("delta", {"text": visible})
+            except Exception:
+                yield _sse("error", {"session_id": sid, "detail": "LLM error"})
+                return
+            finally:
+                if deltas is not None:
+                    await deltas.aclose()
+                ticket.release()
+
+            if final:
+                await sessions.delete(sid)
+                yield _sse("done", {"session_id": sid, "reply": text.strip(), "done": True})
+                return
+
+            gpt_reply, follow_up = splitter.finish()
+            user_data.update(gpt_reply=gpt_reply, follow_up=follow_up)
+            await sessions.put(sid, S_WAIT_FOLLOWUP, user_data)
+            out = gpt_reply + (f"\n---\n{follow_up}" if (follow_up or "").strip() else "")
+            yield _sse("done", {"session_id": sid, "reply": out, "done": False})
+            return
+
+        await sessions.put(sid, next_state, user_data)
+        if not reply and next_state in PROMPTS:
+            reply = PROMPTS[next_state]
+        yield _sse("done", {"session_id": sid, "reply": reply, "done": next_state == S_DONE})
+
+    # клиент ушёл — Starlette бросает генератор на yield, не закрывая его; закрываем сами,
+    # чтобы запрос к модели и место в очереди освободились сразу, а не при сборке мусора
+    stream = events()
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(stream.aclose),
+    )
+
 app.mount("/web", StaticFiles(directory="web_fullbot_static", html=True), name="static")
\ No newline at end of file